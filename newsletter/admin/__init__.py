@@ -6,6 +6,7 @@ from dry_newsletter.newsletter.models import Contact
 from dry_newsletter.newsletter.models import SMTPServer
 from dry_newsletter.newsletter.models import Newsletter
 from dry_newsletter.newsletter.models import MailingList
+from dry_newsletter.newsletter.models import Link
 from dry_newsletter.newsletter.models import ContactMailingStatus
 
 from dry_newsletter.newsletter.admin.contact import ContactAdmin
@@ -29,3 +30,4 @@ admin.site.register(MailingList, MailingListAdmin)
 
 if settings.DEBUG:
     admin.site.register(ContactMailingStatus)
+    admin.site.register(Link)
@@ -1,23 +1,17 @@
 """Mailer for dry_newsletter.newsletter"""
-import re
 import sys
 import time
+import asyncore
 import threading
-import mimetypes
 from random import sample
-from StringIO import StringIO
+from functools import partial
+from itertools import islice
 from datetime import datetime
 from datetime import timedelta
 from smtplib import SMTPRecipientsRefused
 
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEText import MIMEText
-from email.Encoders import encode_base64
-from email.MIMEAudio import MIMEAudio
-from email.MIMEBase import MIMEBase
-from email.MIMEImage import MIMEImage
-from email import message_from_file
-from html2text import html2text as html2text_orig
 from django.conf import settings
 from django.contrib.sites.models import Site
 from django.template import Context, Template
@@ -26,15 +20,49 @@ from django.template import loader
 from django.utils.encoding import smart_str
 from django.utils.encoding import smart_unicode
 from django.utils.timezone import utc
+from django.db.models import Min
 
+from dry_newsletter.newsletter.models import Contact
 from dry_newsletter.newsletter.models import Newsletter
+from dry_newsletter.newsletter.models import SentBitmap
+from dry_newsletter.newsletter.models import MailingRetry
 from dry_newsletter.newsletter.models import ContactMailingStatus
 from dry_newsletter.newsletter.utils.tokens import tokenize
+from dry_newsletter.newsletter.utils.bitmap import Bitmap
+from dry_newsletter.newsletter.utils.asyncsmtp import AsyncSMTPSession
+from dry_newsletter.newsletter.utils.pipeline import RenderPipeline
+from dry_newsletter.newsletter.utils.mime import MessageSkeleton
+from dry_newsletter.newsletter.utils.attachments import attachment_cache
+from dry_newsletter.newsletter.utils.attachments import build_attachment
+from dry_newsletter.newsletter.utils.render import RenderPlan
+from dry_newsletter.newsletter.utils.render import html2text
+from dry_newsletter.newsletter.utils.links import LinkRewriter
+from dry_newsletter.newsletter.utils.stats import stats
+from dry_newsletter.newsletter.utils.metrics import MailerMetrics
+from dry_newsletter.newsletter.utils.wakeup import get_listener
+from dry_newsletter.newsletter.utils.balancer import ServerBalancer
+from dry_newsletter.newsletter.utils.balancer import NoServerAvailable
+from dry_newsletter.newsletter.utils.retries import is_transient
+from dry_newsletter.newsletter.utils.statuses import StatusWriter
 from dry_newsletter.newsletter.settings import UNIQUE_KEY_LENGTH
 from dry_newsletter.newsletter.settings import UNIQUE_KEY_CHAR_SET
 from dry_newsletter.newsletter.settings import INCLUDE_UNSUBSCRIPTION
+from dry_newsletter.newsletter.settings import TRACKING_OPENS
+from dry_newsletter.newsletter.settings import TRACKING_LINKS
 from dry_newsletter.newsletter.settings import SLEEP_BETWEEN_SENDING
 from dry_newsletter.newsletter.settings import RESTART_CONNECTION_BETWEEN_SENDING
+from dry_newsletter.newsletter.settings import ASYNC_SMTP_SESSIONS
+from dry_newsletter.newsletter.settings import ASYNC_SMTP_TIMEOUT
+from dry_newsletter.newsletter.settings import RENDER_PROCESSES
+from dry_newsletter.newsletter.settings import EXPEDITION_CHUNK_SIZE
+from dry_newsletter.newsletter.settings import RETRY_MAX_ATTEMPTS
+
+
+# seconds an idle mailer waits for a notification before looking for work
+IDLE_TIME = 600
+# seconds before looking again after a notification, the transaction
+# saving the newsletter may not be committed when it arrives
+WAKEUP_RECHECK = 2
 
 
 if not hasattr(timedelta, 'total_seconds'):
@@ -46,31 +74,26 @@ else:
     total_seconds = lambda td: td.total_seconds()
 
 
-LINK_RE = re.compile(r"https?://([^ \n]+\n)+[^ \n]+", re.MULTILINE)
-
-def html2text(html):
-    """Use html2text but repair newlines cutting urls.
-    Need to use this hack until
-    https://github.com/aaronsw/html2text/issues/#issue/7 is not fixed"""
-    txt = html2text_orig(html)
-    links = list(LINK_RE.finditer(txt))
-    out = StringIO()
-    pos = 0
-    for l in links:
-        out.write(txt[pos:l.start()])
-        out.write(l.group().replace('\n', ''))
-        pos = l.end()
-    out.write(txt[pos:])
-    return out.getvalue()
-
 class NewsLetterSender(object):
+    # (index, count) of the contacts sent by this sender, all of them
+    # when None
+    shard = None
 
-    def __init__(self, newsletter, test=False, verbose=0):
+    def __init__(self, newsletter, test=False, verbose=0,
+                 processes=RENDER_PROCESSES):
         self.test = test
         self.verbose = verbose
+        self.processes = processes
         self.newsletter = newsletter
         self.newsletter_template = loader.get_template('newsletter/newsletter_detail.html')
         self.title_template = Template(self.newsletter.title)
+        self._domain = None
+        self._render_plan = None
+        self._link_rewriter = None
+        self._message_skeleton = None
+        self.attachments = None
+        self.retried = set()
+        self.status_writer = StatusWriter()
 
     def build_message(self, contact):
         """
@@ -78,9 +101,7 @@ class NewsLetterSender(object):
         a multipart alternative for text (plain, HTML) plus
         all the attached files.
         """
-        content_html = self.build_email_content(contact)
-
-        content_text = html2text(content_html)
+        content_html, content_text = self.build_email_contents(contact)
 
         message = MIMEMultipart()
 
@@ -94,25 +115,122 @@ class NewsLetterSender(object):
         message_alt.attach(MIMEText(smart_str(content_html), 'html', 'UTF-8'))
         message.attach(message_alt)
 
+        for attachment in self.newsletter.attachment_set.all():
+            message.attach(build_attachment(attachment.file_attachment.path,
+                                            attachment.title))
+
         for header, value in self.newsletter.server.custom_headers.items():
             message[header] = value
         return message
 
+    @property
+    def message_skeleton(self):
+        """MessageSkeleton of the newsletter, compiled once"""
+        if self._message_skeleton is None:
+            self._message_skeleton = MessageSkeleton(
+                self.newsletter.header_sender, self.newsletter.header_reply,
+                self.newsletter.server.custom_headers)
+        return self._message_skeleton
+
+    def build_envelope(self, contact):
+        """Build the (sender, recipient, message) to give to sendmail"""
+        if self.attachments is None:
+            self.attachments = self.build_attachments()
+        content_html, content_text = self.build_email_contents(contact)
+        with stats.timer('render'):
+            title = self.build_title_content(contact)
+        with stats.timer('mime'):
+            message = self.message_skeleton.render(
+                title, contact.mail_format(), content_text, content_html,
+                self.attachments)
+            if message is None:
+                message = self.build_message(contact).as_string()
+        return (smart_str(self.newsletter.header_sender),
+                contact.email,
+                message)
+
+    def build_attachments(self):
+        """Return the MIME parts of the attached files, encoded once
+        and shared by the messages"""
+        return [attachment_cache.get(attachment.file_attachment.path,
+                                     attachment.title)
+                for attachment in self.newsletter.attachment_set.all()]
+
+    def build_envelopes(self, contacts):
+        """iterator on (contact, envelope, exception) for the contacts,
+        rendered by a pool of processes if any"""
+        if self.processes > 1:
+            return RenderPipeline(self, processes=self.processes
+                                  ).envelopes(contacts)
+        return self.render_envelopes(contacts)
+
+    def render_envelopes(self, contacts):
+        for contact in contacts:
+            try:
+                envelope = self.build_envelope(contact)
+            except Exception, e:
+                yield contact, None, e
+            else:
+                yield contact, envelope, None
+
     def build_title_content(self, contact):
         """Generate the email title for a contact"""
         context = Context({'contact': contact, 'UNIQUE_KEY': ''.join(sample(UNIQUE_KEY_CHAR_SET, UNIQUE_KEY_LENGTH))})
         title = self.title_template.render(context)
         return title
 
+    @property
+    def domain(self):
+        """Domain of the current site, fetched once"""
+        if self._domain is None:
+            self._domain = Site.objects.get_current().domain
+        return self._domain
+
+    @property
+    def render_plan(self):
+        """RenderPlan of the newsletter, compiled once"""
+        if self._render_plan is None:
+            self._render_plan = RenderPlan(self.newsletter_template,
+                                           {'domain': self.domain,
+                                            'newsletter': self.newsletter,
+                                            'tracking_opens': TRACKING_OPENS,
+                                            'MEDIA_URL': settings.MEDIA_URL},
+                                           rewrite=self.rewrite_links)
+        return self._render_plan
+
+    def rewrite_links(self, html, uidb36, token, personal=None):
+        """Replace the links of the HTML by tracking urls"""
+        if not TRACKING_LINKS:
+            return html
+        if self._link_rewriter is None:
+            self._link_rewriter = LinkRewriter(self.newsletter, self.domain)
+        return self._link_rewriter.rewrite(html, uidb36, token, personal)
+
+    def build_email_contents(self, contact):
+        """Generate the HTML and text versions of the mail for a contact,
+        by splicing the render plan when the template allows it"""
+        if self.render_plan.usable:
+            with stats.timer('render'):
+                uidb36, token = tokenize(contact)
+                return self.render_plan.render({'contact': contact,
+                                                'uidb36': uidb36,
+                                                'token': token})
+        with stats.timer('render'):
+            content_html = self.build_email_content(contact)
+        with stats.timer('html2text'):
+            return content_html, html2text(content_html)
+
     def build_email_content(self, contact):
         """Generate the mail for a contact"""
         uidb36, token = tokenize(contact)
         context = Context({'contact': contact,
-                           'domain': Site.objects.get_current().domain,
+                           'domain': self.domain,
                            'newsletter': self.newsletter,
                            'uidb36': uidb36, 'token': token,
+                           'tracking_opens': TRACKING_OPENS,
                            'MEDIA_URL': settings.MEDIA_URL})
-        content = self.newsletter_template.render(context)
+        content = self.rewrite_links(self.newsletter_template.render(context),
+                                     uidb36, token)
         # link_site = render_to_string('newsletter/newsletter_link_site.html', context)
         # content = body_insertion(content, link_site)
 
@@ -123,18 +241,20 @@ class NewsLetterSender(object):
 
     def update_newsletter_status(self):
         """Update the status of the newsletter"""
+        self.status_writer.flush()
         if self.test:
             return
 
         if self.newsletter.status == Newsletter.WAITING:
             self.newsletter.status = Newsletter.SENDING
             
-        should_be_sent_mails = []
-        for ml in self.newsletter.mailing_lists.all():
-            should_be_sent_mails += ml.expedition_set() # Ricalcolo la expedition_list ma senza eliminare i contatti a cui la mail e gia stata spedita
-        should_be_sent_mails = set(should_be_sent_mails)
-            
-        if self.newsletter.status == Newsletter.SENDING and self.newsletter.mails_sent() >= len(should_be_sent_mails):
+        # Ricalcolo la expedition_list ma senza eliminare i contatti a cui la mail e gia stata spedita
+        should_be_sent_mails = Contact.objects.expedition_set(self.newsletter).count()
+        # the contacts which failed every retry will not get it
+        failed_mails = MailingRetry.objects.exhausted(self.newsletter).count()
+
+        if self.newsletter.status == Newsletter.SENDING and \
+               self.newsletter.mails_sent() + failed_mails >= should_be_sent_mails:
             self.newsletter.status = Newsletter.SENT
         self.newsletter.save()
 
@@ -155,96 +275,239 @@ class NewsLetterSender(object):
     @property
     def expedition_list(self):
         """Build the expedition list"""
+        return list(self.iter_expedition_list())
+
+    def expedition_queryset(self):
+        """Contacts of the mailing lists still waiting for the newsletter"""
         if self.test:
             return self.newsletter.test_contacts.all()
+        return Contact.objects.expedition_set(self.newsletter)
 
-        already_sent = ContactMailingStatus.objects.filter(status=ContactMailingStatus.SENT, newsletter=self.newsletter).values_list('contact__id', flat=True)
-
-        expedition_list = []
-        for ml in self.newsletter.mailing_lists.all():
-            contacts = ml.expedition_set().exclude(id__in=already_sent)
-            expedition_list += contacts
-        return sorted(set(expedition_list))
+    def sent_bitmap(self):
+        """Bitmap of the contacts already reached, empty in test mode"""
+        if self.test:
+            return Bitmap()
+        return SentBitmap.objects.bitmap(self.newsletter)
+
+    def iter_expedition_list(self, chunk_size=EXPEDITION_CHUNK_SIZE):
+        """Iterate over the expedition list in id order, fetching the
+        contacts by chunks after the last id seen, so the sending can
+        start at once and the memory stays bounded.
+
+        The contacts waiting for a retry are left to the retries, which
+        are given before each chunk when their time has come."""
+        sent = self.sent_bitmap()
+        retrying = self.retry_bitmap()
+        # a new run gives again the retries due
+        self.retried = set()
+        queryset = self.expedition_queryset().order_by('pk')
+        last_id = 0
+        while True:
+            for contact in self.due_retries(retrying):
+                yield contact
+            with stats.timer('contacts'):
+                chunk = list(queryset.filter(pk__gt=last_id)[:chunk_size])
+            for contact in chunk:
+                if contact.pk not in sent and contact.pk not in retrying:
+                    yield contact
+            if len(chunk) < chunk_size:
+                break
+            last_id = chunk[-1].pk
+        for contact in self.due_retries(retrying):
+            yield contact
+
+    def retry_bitmap(self):
+        """Bitmap of the contacts with a retry, empty in test mode"""
+        if self.test:
+            return Bitmap()
+        return Bitmap(MailingRetry.objects.filter(
+            newsletter=self.newsletter).values_list('contact', flat=True))
 
-    def update_contact_status(self, contact, exception):
+    def due_retries(self, retrying):
+        """Contacts of the retries due and not given yet"""
+        if self.test or not retrying:
+            return []
+        contacts = [retry.contact for retry in
+                    MailingRetry.objects.due(self.newsletter,
+                                             shard=self.shard)
+                    if retry.contact_id not in self.retried]
+        self.retried.update(contact.pk for contact in contacts)
+        return contacts
+
+    def expedition_count(self):
+        """Number of contacts in the expedition list, less the contacts
+        of the sent bitmap. The contacts reached which left the mailing
+        lists, or belong to other shards, make it a lower bound."""
+        return max(self.expedition_queryset().count() -
+                   len(self.sent_bitmap()), 0)
+
+    def update_contact_status(self, contact, exception, server=None):
+        """Record the outcome of a message. Temporary failures are
+        planned again and give None, until the attempts are exhausted"""
         if exception is None:
             status = (self.test
                       and ContactMailingStatus.SENT_TEST
                       or ContactMailingStatus.SENT)
+        elif not self.test and is_transient(exception):
+            print >>sys.stderr, 'smtp connection raises %s' % exception
+            if MailingRetry.objects.schedule(self.newsletter, contact,
+                                             exception):
+                return None
+            status = ContactMailingStatus.ERROR
         elif isinstance(exception, (UnicodeError, SMTPRecipientsRefused)):
             status = ContactMailingStatus.INVALID
             contact.valid = False
-            contact.save()
         else:
             # signal error
             print >>sys.stderr, 'smtp connection raises %s' % exception
             status = ContactMailingStatus.ERROR
 
-        ContactMailingStatus.objects.create(
-            newsletter=self.newsletter, contact=contact, status=status)
+        if contact.pk in self.retried:
+            retry = MailingRetry.objects.filter(newsletter=self.newsletter,
+                                                contact=contact)
+            if status == ContactMailingStatus.ERROR:
+                # not worth another attempt
+                retry.update(attempts=RETRY_MAX_ATTEMPTS)
+            else:
+                retry.delete()
+        self.status_writer.add(self.newsletter, contact, status, server)
+        return status
 
 
 class Mailer(NewsLetterSender):
     """Mailer for generating and sending newsletters
-    In test mode the mailer always send mails but do not log it"""
+    In test mode the mailer always send mails but do not log it.
+
+    A mailer can send a shard (index, count) of the expedition list,
+    within a budget of credits given by the process sharing the server
+    credits between the shards.
+
+    A newsletter with other servers is sent through a ServerBalancer,
+    the messages keeping the custom headers of the newsletter server."""
     smtp = None
+    _balancer = None
+
+    def __init__(self, newsletter, test=False, verbose=0,
+                 processes=RENDER_PROCESSES, shard=None, credits=None):
+        super(Mailer, self).__init__(newsletter, test=test, verbose=verbose,
+                                     processes=processes)
+        self.shard = shard
+        self.budget = credits
+        self.stop_event = threading.Event()
 
     def run(self):
         """Send the mails"""
         if not self.can_send:
             return
 
-        if not self.smtp:
+        if not self.smtp and not self.balancer:
             self.smtp_connect()
 
-        expedition_list = self.expedition_list
+        expedition_list = self.iter_expedition_list()
 
-        number_of_recipients = len(expedition_list)
         if self.verbose:
+            number_of_recipients = self.expedition_count()
             print '%i emails will be sent' % number_of_recipients
 
-        i = 1
-        for contact in expedition_list:
-            if self.verbose:
-                print '- Processing %s/%s (%s)' % (i, number_of_recipients, contact.pk)
-
-            try:
-                message = self.build_message(contact)
-                self.smtp.sendmail(smart_str(self.newsletter.header_sender), contact.email, message.as_string())
-            except Exception, e:
-                exception = e
-            else:
-                exception = None
+        try:
+            i = 1
+            for contact, envelope, exception in self.build_envelopes(
+                    expedition_list):
+                if self.stop_event.is_set():
+                    break
+                if self.verbose:
+                    print '- Processing %s/%s (%s)' % (i, number_of_recipients, contact.pk)
+
+                server = None
+                if exception is None:
+                    try:
+                        with stats.timer('sendmail'):
+                            server = self.sendmail(envelope)
+                    except Exception, e:
+                        exception = e
+                if isinstance(exception, NoServerAvailable) and \
+                       self.stop_event.is_set():
+                    # interrupted, the contact is left to the next run
+                    break
+
+                self.update_contact_status(contact, exception, server)
 
-            self.update_contact_status(contact, exception)
+                if SLEEP_BETWEEN_SENDING:
+                    time.sleep(SLEEP_BETWEEN_SENDING)
+                if RESTART_CONNECTION_BETWEEN_SENDING and self.smtp:
+                    self.smtp.quit()
+                    self.smtp_connect()
 
-            if SLEEP_BETWEEN_SENDING:
-                time.sleep(SLEEP_BETWEEN_SENDING)
-            if RESTART_CONNECTION_BETWEEN_SENDING:
+                i += 1
+        finally:
+            if self.smtp:
+                # given back to the pool, a new run takes another one
                 self.smtp.quit()
-                self.smtp_connect()
-
-            i += 1
-
-        self.smtp.quit()
+                self.smtp = None
+            if self.balancer:
+                self.balancer.close()
+            self.status_writer.flush()
         self.update_newsletter_status()
 
     def smtp_connect(self):
-        """Make a connection to the SMTP"""
-        self.smtp = self.newsletter.server.connect()
+        """Take a connection to the SMTP from the server pool"""
+        self.smtp = self.newsletter.server.connection_pool().acquire()
 
     @property
-    def expedition_list(self):
-        """Build the expedition list"""
-        credits = self.newsletter.server.credits()
+    def balancer(self):
+        """ServerBalancer of the servers of the newsletter, None when
+        it has a single server"""
+        if self._balancer is None:
+            self._balancer = False
+            servers = not self.test and self.newsletter.smtp_servers()
+            if servers and len(servers) > 1:
+                share = self.shard and 1.0 / self.shard[1] or 1.0
+                self._balancer = ServerBalancer(servers, share,
+                                                stop_event=self.stop_event)
+        return self._balancer or None
+
+    def sendmail(self, envelope):
+        """Send a message, return the server used when it is not the
+        server of the newsletter"""
+        if self.smtp:
+            self.smtp.sendmail(*envelope)
+            return None
+        server = self.balancer.sendmail(envelope)
+        if server.pk != self.newsletter.server_id:
+            return server
+        return None
+
+    def iter_expedition_list(self, chunk_size=EXPEDITION_CHUNK_SIZE):
+        """Iterate over the expedition list, within the server credits"""
+        credits = self.credits()
         if credits <= 0:
-            return []
-        return super(Mailer, self).expedition_list[:credits]
+            return iter([])
+        return islice(super(Mailer, self).iter_expedition_list(chunk_size),
+                      credits)
+
+    def expedition_count(self):
+        """Number of contacts in the expedition list"""
+        return max(min(self.credits(),
+                       super(Mailer, self).expedition_count()), 0)
+
+    def credits(self):
+        """Messages the mailer may send, the server credits or the
+        budget of the shard"""
+        if self.budget is not None:
+            return self.budget
+        if self.balancer:
+            return self.balancer.credits()
+        return self.newsletter.server.credits()
+
+    def expedition_queryset(self):
+        if self.shard is None or self.test:
+            return super(Mailer, self).expedition_queryset()
+        return Contact.objects.expedition_set(self.newsletter, self.shard)
 
     @property
     def can_send(self):
         """Check if the newsletter can be sent"""
-        if self.newsletter.server.credits() <= 0:
+        if self.credits() <= 0:
             return False
         return super(Mailer, self).can_send
 
@@ -263,77 +526,167 @@ class SMTPMailer(object):
 
     smtp = None
 
-    def __init__(self, server, test=False, verbose=0):
+    def __init__(self, server, test=False, verbose=0,
+                 processes=RENDER_PROCESSES):
         self.start = datetime.now()
         self.server = server
         self.test = test
         self.verbose = verbose
+        self.processes = processes
         self.stop_event = threading.Event()
+        self.wakeup = threading.Event()
+        self.metrics = MailerMetrics(server)
+        # newsletters gone through, left alone until the next idle wait
+        self.finished = set()
 
     def run(self):
         """send mails
         """
+        listener = self.listen()
         sending = dict()
         candidates = self.get_candidates()
         roundrobin = []
+        woken = False
 
-        if not self.smtp:
-            self.smtp_connect()
-
-        delay = self.server.delay()
+        pacer = self.server.pacer()
 
-        i = 1
         sleep_time = 0
-        while (not self.stop_event.wait(sleep_time) and
-               not self.stop_event.is_set()):
-            if not roundrobin:
-                # refresh the list
-                for expedition in candidates:
-                    if expedition.id not in sending and expedition.can_send:
-                        sending[expedition.id] = expedition()
-
-                roundrobin = list(sending.keys())
-
-            if roundrobin:
-                nl_id = roundrobin.pop()
-                nl = sending[nl_id]
-
-                try:
-                    self.smtp.sendmail(*nl.next())
-                except StopIteration:
-                    del sending[nl_id]
-                except Exception, e:
-                    nl.throw(e)
+        try:
+            while (not self.stop_event.wait(sleep_time) and
+                   not self.stop_event.is_set()):
+                self.metrics.update_credits(self.server)
+                if not roundrobin:
+                    if self.wakeup.is_set():
+                        self.wakeup.clear()
+                        self.finished.clear()
+                        candidates = self.get_candidates()
+                    # refresh the list
+                    for expedition in candidates:
+                        if self.can_start(expedition, sending):
+                            sending[expedition.id] = expedition()
+
+                    roundrobin = list(sending.keys())
+                self.metrics.newsletters = len(sending)
+                self.metrics.roundrobin = len(roundrobin)
+
+                if roundrobin:
+                    sleep_time = self.metrics.sleep_time = pacer.wait_time()
+                    if sleep_time:
+                        continue
+
+                    if not self.smtp:
+                        self.smtp_connect()
+
+                    nl_id = roundrobin.pop()
+                    nl = sending[nl_id]
+
+                    try:
+                        envelope = nl.next()
+                    except StopIteration:
+                        del sending[nl_id]
+                        self.finished.add(nl_id)
+                        continue
+
+                    pacer.consume()
+                    try:
+                        with stats.timer('sendmail'):
+                            self.smtp.sendmail(*envelope)
+                    except Exception, e:
+                        nl.throw(e)
+                    else:
+                        nl.next()
+
+                    if RESTART_CONNECTION_BETWEEN_SENDING:
+                        self.smtp.quit()
+                        self.smtp_connect()
+                    sleep_time = pacer.wait_time()
                 else:
-                    nl.next()
-
-                sleep_time = (delay * i -
-                              total_seconds(datetime.now() - self.start))
-                if SLEEP_BETWEEN_SENDING:
-                    sleep_time = max(time.sleep(SLEEP_BETWEEN_SENDING), sleep_time)
-                if RESTART_CONNECTION_BETWEEN_SENDING:
-                    self.smtp.quit()
-                    self.smtp_connect()
-                i += 1
-            else:
-                # no work, sleep a bit and some reset
-                sleep_time = 600
-                i = 1
-                self.start = datetime.now()
-
-            if sleep_time < 0:
-                sleep_time = 0
-
-        self.smtp.quit()
+                    # no work, give back the connection, wait for some
+                    if self.smtp:
+                        self.smtp.quit()
+                        self.smtp = None
+                    woken = self.wait_for_work(candidates, woken)
+                    self.finished.clear()
+                    candidates = self.get_candidates()
+                    sleep_time = 0
+                self.metrics.sleep_time = sleep_time
+        finally:
+            if listener:
+                listener.unregister(self.server.pk, self.wakeup)
+            if self.smtp:
+                self.smtp.quit()
+                self.smtp = None
+            # save the statuses still buffered by the expeditions
+            for nl in sending.values():
+                nl.close()
+
+    def can_start(self, expedition, sending):
+        """Check if the sending of a candidate can start. A newsletter
+        gone through waits for the next idle time, its work left being
+        retries not due yet."""
+        return (expedition.id not in sending and
+                expedition.id not in self.finished and expedition.can_send)
 
     def get_candidates(self):
         """get candidates NL"""
         return [NewsLetterExpedition(nl, self)
                 for nl in Newsletter.objects.filter(server=self.server)]
 
+    def listen(self):
+        """Register the wakeup event of the mailer to the notifications
+        of the newsletters saved for its server"""
+        listener = get_listener()
+        if listener:
+            listener.register(self.server.pk, self.wakeup)
+        return listener
+
+    def idle_time(self, candidates):
+        """Seconds until the next sending date or retry of the
+        candidates, at most IDLE_TIME"""
+        now = datetime.utcnow().replace(tzinfo=utc)
+        dates = []
+        sending = []
+        for expedition in candidates:
+            newsletter = expedition.newsletter
+            if newsletter.status in (Newsletter.WAITING, Newsletter.SENDING):
+                dates.append(newsletter.sending_date)
+                sending.append(newsletter.pk)
+        idle_time = IDLE_TIME
+        if sending:
+            next_attempt = MailingRetry.objects.filter(
+                newsletter__in=sending, attempts__lt=RETRY_MAX_ATTEMPTS
+                ).aggregate(next_attempt=Min('next_attempt'))['next_attempt']
+            if next_attempt is not None:
+                # a retry due meanwhile, or waiting for credits, is
+                # looked at again shortly
+                idle_time = min(idle_time, max(total_seconds(
+                    next_attempt - now), 0) or WAKEUP_RECHECK)
+        for date in dates:
+            if date is not None and date > now:
+                idle_time = min(idle_time, total_seconds(date - now))
+        return idle_time
+
+    def wait_for_work(self, candidates, woken=False):
+        """Wait for a notification, the next sending date or the stop of
+        the mailer. Return whether a notification came, clearing it so
+        the candidates can be fetched again."""
+        timeout = self.idle_time(candidates)
+        if woken:
+            timeout = min(timeout, WAKEUP_RECHECK)
+        self.metrics.sleep_time = timeout
+        deadline = time.time() + timeout
+        while not self.wakeup.is_set() and not self.stop_event.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            self.wakeup.wait(min(remaining, 0.1))
+        woken = self.wakeup.is_set()
+        self.wakeup.clear()
+        return woken
+
     def smtp_connect(self):
-        """Make a connection to the SMTP"""
-        self.smtp = self.server.connect()
+        """Take a connection to the SMTP from the server pool"""
+        self.smtp = self.server.connection_pool().acquire()
 
 
 class NewsLetterExpedition(NewsLetterSender):
@@ -345,13 +698,44 @@ class NewsLetterExpedition(NewsLetterSender):
 
     def __init__(self, newsletter, mailer):
         super(NewsLetterExpedition, self).__init__(
-                        newsletter, test=mailer.test, verbose=mailer.verbose)
+                        newsletter, test=mailer.test, verbose=mailer.verbose,
+                        processes=mailer.processes)
         self.mailer = mailer
         self.id = newsletter.id
 
     def __call__(self):
         """iterator on messages to be sent
         """
+        self.attachments = self.build_attachments()
+
+        try:
+            for contact, envelope in self.envelopes():
+                try:
+                    yield envelope
+                except Exception, e:
+                    exception = e
+                else:
+                    exception = None
+
+                self.update_contact_status(contact, exception)
+                # this one permits us to save to database imediately
+                # and acknoledge eventual exceptions
+                yield None
+        finally:
+            self.update_newsletter_status()
+
+    def update_contact_status(self, contact, exception, server=None):
+        status = super(NewsLetterExpedition, self).update_contact_status(
+            contact, exception, server)
+        self.mailer.metrics.count(status)
+        return status
+
+    def envelopes(self):
+        """iterator on (contact, (sender, recipient, message)) to be sent
+
+        contacts whose message cannot be built get their status saved
+        and are skipped
+        """
         newsletter = self.newsletter
 
         title = 'smtp-%s (%s), nl-%s (%s)' % (
@@ -360,37 +744,188 @@ class NewsLetterExpedition(NewsLetterSender):
         # ajust len
         title = '%-30s' % title
 
-        self.attachments = self.build_attachments()
-
-        expedition_list = self.expedition_list
+        expedition_list = self.iter_expedition_list()
 
-        number_of_recipients = len(expedition_list)
         if self.verbose:
+            number_of_recipients = self.expedition_count()
             print '%s %s: %i emails will be sent' % (
                     datetime.now().strftime('%Y-%m-%d'),
                     title, number_of_recipients)
 
-        try:
-            i = 1
-            for contact in expedition_list:
-                if self.verbose:
-                    print '%s %s: processing %s/%s (%s)' % (
-                        datetime.now().strftime('%H:%M:%S'),
-                        title, i, number_of_recipients, contact.pk)
-                try:
-                    message = self.build_message(contact)
-                    yield (smart_str(self.newsletter.header_sender),
-                                       contact.email,
-                                       message.as_string())
-                except Exception, e:
-                    exception = e
-                else:
-                    exception = None
-
+        i = 1
+        for contact, envelope, exception in self.build_envelopes(
+                expedition_list):
+            if self.verbose:
+                print '%s %s: processing %s/%s (%s)' % (
+                    datetime.now().strftime('%H:%M:%S'),
+                    title, i, number_of_recipients, contact.pk)
+            i += 1
+            if exception is not None:
                 self.update_contact_status(contact, exception)
-                i += 1
-                # this one permits us to save to database imediately
-                # and acknoledge eventual exceptions
-                yield None
+            else:
+                yield contact, envelope
+
+
+class AsyncSMTPMailer(SMTPMailer):
+    """for generating and sending newsletters with concurrent sessions
+
+    AsyncSMTPMailer works like SMTPMailer, but instead of sending one
+    message at a time through a blocking smtplib connection, it keeps
+    up to `sessions` SMTP sessions busy at once, all of them driven by
+    a single asyncore loop. The pace of the messages given to the
+    sessions still follows the pacer of the server.
+
+    Servers using TLS are not supported."""
+
+    def __init__(self, server, test=False, verbose=0,
+                 processes=RENDER_PROCESSES, sessions=ASYNC_SMTP_SESSIONS):
+        super(AsyncSMTPMailer, self).__init__(server, test=test,
+                                              verbose=verbose,
+                                              processes=processes)
+        self.sessions = sessions
+        self.socket_map = {}
+        self.pool = []
+        self.next_connect = 0
+
+    def run(self):
+        """send mails
+        """
+        listener = self.listen()
+        sending = dict()
+        candidates = self.get_candidates()
+        roundrobin = []
+        woken = False
+
+        pacer = self.server.pacer()
+
+        try:
+            while not self.stop_event.is_set():
+                self.metrics.update_credits(self.server)
+                if not roundrobin:
+                    if self.wakeup.is_set():
+                        self.wakeup.clear()
+                        self.finished.clear()
+                        candidates = self.get_candidates()
+                    # refresh the list
+                    for expedition in candidates:
+                        if self.can_start(expedition, sending):
+                            sending[expedition.id] = AsyncExpedition(expedition)
+
+                    roundrobin = [nl_id for nl_id, nl in sending.items()
+                                  if not nl.exhausted]
+                self.metrics.newsletters = len(sending)
+
+                if not sending:
+                    # no work, close the sessions and wait for some
+                    self.close_sessions()
+                    woken = self.wait_for_work(candidates, woken)
+                    self.finished.clear()
+                    candidates = self.get_candidates()
+                    continue
+
+                now = time.time()
+                idle = self.idle_sessions(now)
+                while idle and roundrobin and not pacer.wait_time(now):
+                    nl_id = roundrobin.pop()
+                    nl = sending[nl_id]
+                    try:
+                        contact, envelope = nl.envelopes.next()
+                    except StopIteration:
+                        nl.exhausted = True
+                        self.acknowledge(sending, nl_id)
+                    else:
+                        nl.in_flight += 1
+                        pacer.consume(now)
+                        idle.pop().sendmail(*envelope, callback=partial(
+                            self.acknowledge, sending, nl_id, contact,
+                            started=now))
+                    if not roundrobin:
+                        roundrobin = [nl_id for nl_id, nl in sending.items()
+                                      if not nl.exhausted]
+
+                timeout = 1.0
+                if idle and roundrobin:
+                    timeout = min(pacer.wait_time(now), timeout)
+                self.metrics.sleep_time = timeout
+                self.metrics.roundrobin = len(roundrobin)
+                self.metrics.in_flight = sum(nl.in_flight
+                                             for nl in sending.values())
+                self.poll(timeout)
         finally:
-            self.update_newsletter_status()
+            if listener:
+                listener.unregister(self.server.pk, self.wakeup)
+            self.drain()
+            for nl in sending.values():
+                nl.expedition.update_newsletter_status()
+            self.close_sessions()
+
+    def acknowledge(self, sending, nl_id, contact=None, exception=None,
+                    started=None):
+        """Save the outcome of a message, and the newsletter status
+        when it was the last one"""
+        if started is not None:
+            stats.record('sendmail', time.time() - started)
+        nl = sending.get(nl_id)
+        if nl is None:
+            return
+        if contact is not None:
+            nl.in_flight -= 1
+            nl.expedition.update_contact_status(contact, exception)
+        if nl.exhausted and not nl.in_flight:
+            del sending[nl_id]
+            self.finished.add(nl_id)
+            nl.expedition.update_newsletter_status()
+
+    def idle_sessions(self, now):
+        """Open the missing sessions and return the idle ones"""
+        for session in self.pool:
+            session.check_timeout(now)
+            if session.dead and not session.opened:
+                # the server refuses us, do not hammer it
+                self.next_connect = now + ASYNC_SMTP_TIMEOUT
+        self.pool = [session for session in self.pool if not session.dead]
+
+        if len(self.pool) < self.sessions and now >= self.next_connect:
+            try:
+                while len(self.pool) < self.sessions:
+                    self.pool.append(AsyncSMTPSession(self.server,
+                                                      self.socket_map))
+            except Exception, e:
+                print >>sys.stderr, 'smtp connection raises %s' % e
+                self.next_connect = now + ASYNC_SMTP_TIMEOUT
+
+        return [session for session in self.pool if session.idle]
+
+    def poll(self, timeout):
+        """Run the asyncore loop for one round"""
+        if self.socket_map:
+            asyncore.loop(timeout=timeout, map=self.socket_map, count=1)
+        else:
+            self.stop_event.wait(timeout)
+
+    def drain(self):
+        """Wait for the messages in progress"""
+        deadline = time.time() + ASYNC_SMTP_TIMEOUT
+        while time.time() < deadline and \
+                  [s for s in self.pool if s.callback is not None]:
+            self.poll(0.1)
+            for session in self.pool:
+                session.check_timeout(time.time())
+
+    def close_sessions(self):
+        """Quit all the sessions"""
+        for session in self.pool:
+            session.quit()
+        while self.socket_map:
+            asyncore.loop(timeout=0.1, map=self.socket_map, count=1)
+        self.pool = []
+
+
+class AsyncExpedition(object):
+    """State of a NewsLetterExpedition sent by AsyncSMTPMailer"""
+
+    def __init__(self, expedition):
+        self.expedition = expedition
+        self.envelopes = expedition.envelopes()
+        self.exhausted = False
+        self.in_flight = 0
@@ -0,0 +1,251 @@
+"""Command for benchmarking the sending of the newsletters"""
+import sys
+import time
+import platform
+import resource
+import multiprocessing
+from datetime import datetime
+from threading import Thread
+from optparse import make_option
+
+import django
+from django.db import connection
+from django.utils import simplejson
+from django.utils.timezone import utc
+from django.core.management.base import NoArgsCommand
+from django.core.management.base import CommandError
+
+from dry_newsletter.newsletter.mailer import Mailer
+from dry_newsletter.newsletter.mailer import SMTPMailer
+from dry_newsletter.newsletter.mailer import AsyncSMTPMailer
+from dry_newsletter.newsletter.models import Contact
+from dry_newsletter.newsletter.models import SMTPServer
+from dry_newsletter.newsletter.models import Newsletter
+from dry_newsletter.newsletter.models import MailingList
+from dry_newsletter.newsletter.models import ContactMailingStatus
+from dry_newsletter.newsletter.utils.sink import SMTPSink
+from dry_newsletter.newsletter.utils.pool import close_pools
+from dry_newsletter.newsletter.utils.stats import stats
+from dry_newsletter.newsletter.settings import RENDER_PROCESSES
+from dry_newsletter.newsletter.settings import ASYNC_SMTP_SESSIONS
+
+ENGINES = ('mailer', 'thread', 'async')
+BATCH_SIZE = 1000
+
+
+def percentile(values, ratio):
+    """Return the value under which ratio of the sorted values are"""
+    if not values:
+        return None
+    return values[min(int(len(values) * ratio), len(values) - 1)]
+
+
+class Command(NoArgsCommand):
+    """Measure the sending throughput of the engines"""
+    help = ('Send synthetic newsletters to a local SMTP sink and report the '
+            'throughput, latency, memory and queries of each sending engine '
+            'as JSON. Contacts are created for the run and deleted after, '
+            'use a scratch database.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--scales', default='1000',
+                    help='Comma separated numbers of contacts, '
+                    'like 1000,100000,1000000.'),
+        make_option('--engines', default=','.join(ENGINES),
+                    help='Comma separated engines among %s.' % ', '.join(ENGINES)),
+        make_option('--processes', type='int', default=RENDER_PROCESSES,
+                    help='Render the messages in a pool of processes.'),
+        make_option('--sessions', type='int', default=ASYNC_SMTP_SESSIONS,
+                    help='Concurrent SMTP sessions of the async engine.'),
+        make_option('--timeout', type='int', default=3600,
+                    help='Maximum seconds for a sending.'),
+        make_option('--output', default=None,
+                    help='Write the results to this JSON file.'),
+        make_option('--keep', action='store_true', default=False,
+                    help='Keep the contacts and newsletters created.'),
+        )
+
+    def handle_noargs(self, **options):
+        self.verbose = int(options['verbosity'])
+        self.options = options
+        try:
+            scales = [int(scale) for scale in options['scales'].split(',')]
+        except ValueError:
+            raise CommandError('Invalid scales %r' % options['scales'])
+        engines = options['engines'].split(',')
+        for engine in engines:
+            if engine not in ENGINES:
+                raise CommandError('Unknown engine %r' % engine)
+
+        self.tag = 'benchmark-%d' % time.time()
+        self.sink = SMTPSink(record_recipients=False)
+        self.sink.start()
+        self.server = SMTPServer.objects.create(
+            name=self.tag, host=self.sink.host, port=self.sink.port,
+            mails_hour=10 ** 9)
+
+        results = []
+        try:
+            for scale in scales:
+                mailing_list = self.create_contacts(scale)
+                for engine in engines:
+                    results.append(self.run(engine, scale, mailing_list))
+        finally:
+            close_pools()
+            self.sink.stop()
+            if not options['keep']:
+                self.clean()
+
+        report = simplejson.dumps(
+            {'date': datetime.utcnow().replace(tzinfo=utc).isoformat(),
+             'python': platform.python_version(),
+             'django': django.get_version(),
+             'database': connection.vendor,
+             'processes': options['processes'],
+             'sessions': options['sessions'],
+             'results': results}, indent=2)
+        if options['output']:
+            output = open(options['output'], 'w')
+            output.write(report)
+            output.close()
+        else:
+            print report
+
+    def log(self, message):
+        if self.verbose:
+            print >>sys.stderr, message
+
+    def create_contacts(self, scale):
+        """Create a mailing list of scale new contacts"""
+        self.log('Creating %s contacts' % scale)
+        domain = '%s-%s.invalid' % (self.tag, scale)
+        for start in xrange(0, scale, BATCH_SIZE):
+            Contact.objects.bulk_create([
+                Contact(email='contact%d@%s' % (i, domain),
+                        first_name='First %d' % i, last_name='Last')
+                for i in xrange(start, min(start + BATCH_SIZE, scale))])
+
+        mailing_list = MailingList.objects.create(name='%s-%s' % (self.tag, scale))
+        Subscription = MailingList.subscribers.through
+        contact_ids = Contact.objects.filter(email__endswith='@' + domain
+                                             ).values_list('pk', flat=True)
+        batch = []
+        for contact_id in contact_ids.iterator():
+            batch.append(Subscription(mailinglist=mailing_list,
+                                      contact_id=contact_id))
+            if len(batch) >= BATCH_SIZE:
+                Subscription.objects.bulk_create(batch)
+                batch = []
+        Subscription.objects.bulk_create(batch)
+        return mailing_list
+
+    def run(self, engine, scale, mailing_list):
+        """Send a newsletter to the mailing list with an engine, in a
+        process of its own so its peak memory is not the one of the
+        previous runs"""
+        self.log('Sending to %s contacts with the %s engine' % (scale, engine))
+        newsletter = Newsletter.objects.create(
+            title='Benchmark {{ contact.first_name }}',
+            article_1_title='Benchmark', article_1_text='Benchmark content',
+            slug='%s-%s-%s' % (self.tag, scale, engine),
+            server=self.server, status=Newsletter.WAITING,
+            sending_date=datetime.utcnow().replace(tzinfo=utc))
+        newsletter.mailing_lists.add(mailing_list)
+
+        received = self.sink.received
+        arrivals = len(self.sink.arrivals)
+        done = multiprocessing.Event()
+        results = multiprocessing.Queue()
+        # the process must not share the database connection
+        connection.close()
+        process = multiprocessing.Process(
+            target=self.send, args=(engine, newsletter, done, results))
+        process.start()
+
+        # the sink is served by this process, which tells the sending
+        # one when every message arrived
+        deadline = time.time() + self.options['timeout']
+        while process.is_alive() and not done.is_set():
+            if self.sink.received >= received + scale or time.time() > deadline:
+                # let the last acknowledgement be saved
+                time.sleep(0.5)
+                done.set()
+            time.sleep(0.1)
+        result = results.get()
+        process.join()
+        # even unfinished, it must not be sent again by the next runs
+        Newsletter.objects.filter(pk=newsletter.pk).update(status=Newsletter.SENT)
+
+        sent = self.sink.received - received
+        times = self.sink.arrivals[arrivals:]
+        seconds = result.pop('seconds')
+        if times:
+            # up to the last message, not to the end of the watcher
+            seconds = times[-1] - result.pop('start')
+        result.update({'engine': engine,
+                       'contacts': scale,
+                       'sent': sent,
+                       'seconds': round(seconds, 3),
+                       'messages_per_second': seconds and round(sent / seconds, 1)})
+        return result
+
+    def send(self, engine, newsletter, done, results):
+        """Run the sending, in its own process"""
+        stats.enable()
+        stats.keep_samples('sendmail')
+        processes = self.options['processes']
+        if engine == 'mailer':
+            mailer = Mailer(newsletter, processes=processes)
+        elif engine == 'thread':
+            mailer = SMTPMailer(self.server, processes=processes)
+        else:
+            mailer = AsyncSMTPMailer(self.server, processes=processes,
+                                     sessions=self.options['sessions'])
+
+        watcher = Thread(target=self.stop_when_done, args=(mailer, done))
+        watcher.daemon = True
+        watcher.start()
+
+        connection.use_debug_cursor = True
+        connection.queries = []
+        start = time.time()
+        try:
+            mailer.run()
+        finally:
+            seconds = time.time() - start
+            queries = len(connection.queries)
+            connection.use_debug_cursor = None
+            connection.queries = []
+            done.set()
+
+        # from the submission of each message to its acknowledgement
+        latencies = sorted(latency * 1000 for latency in stats.samples['sendmail'])
+        results.put({'start': start,
+                     'seconds': seconds,
+                     'statuses': ContactMailingStatus.objects.filter(
+                         newsletter=newsletter,
+                         status=ContactMailingStatus.SENT).count(),
+                     'latency_p50_ms': percentile(latencies, 0.5),
+                     'latency_p99_ms': percentile(latencies, 0.99),
+                     'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                     'children_peak_rss_kb': resource.getrusage(
+                         resource.RUSAGE_CHILDREN).ru_maxrss,
+                     'queries': queries})
+        close_pools()
+        connection.close()
+
+    def stop_when_done(self, mailer, done):
+        done.wait()
+        mailer.stop_event.set()
+
+    def clean(self):
+        """Delete the objects created by the benchmark"""
+        self.log('Deleting the benchmark data')
+        newsletters = Newsletter.objects.filter(server=self.server)
+        ContactMailingStatus.objects.filter(newsletter__in=newsletters).delete()
+        newsletters.delete()
+        mailing_lists = MailingList.objects.filter(name__startswith=self.tag)
+        MailingList.subscribers.through.objects.filter(
+            mailinglist__in=mailing_lists).delete()
+        mailing_lists.delete()
+        Contact.objects.filter(email__contains='@%s-' % self.tag).delete()
+        self.server.delete()
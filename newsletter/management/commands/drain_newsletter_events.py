@@ -0,0 +1,39 @@
+"""Command for writing the events left in the spool"""
+import sys
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from dry_newsletter.newsletter.utils.events import write_spool
+from dry_newsletter.newsletter.utils.events import orphan_spools
+from dry_newsletter.newsletter.settings import EVENT_SPOOL_DIR
+
+
+class Command(NoArgsCommand):
+    """Write the events spooled by the processes which are gone"""
+    help = ('Write the open and unsubscription events left in the spool by '
+            'the processes which stopped before flushing them.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--spool-dir', default=EVENT_SPOOL_DIR,
+                    help='Directory of the spool files.'),
+        )
+
+    def handle_noargs(self, **options):
+        verbose = int(options['verbosity'])
+        written = 0
+        failed = 0
+        for path in orphan_spools(options['spool_dir']):
+            try:
+                count = write_spool(path)
+            except Exception, e:
+                print >>sys.stderr, 'events of %s not written: %s' % (path, e)
+                failed += 1
+                continue
+            written += count
+            if verbose > 1:
+                print '%s events written from %s' % (count, path)
+
+        if verbose:
+            print '%s events written' % written
+        if failed:
+            sys.exit(1)
@@ -0,0 +1,33 @@
+"""Command for rebuilding the statistics of the newsletters"""
+from django.db import transaction
+from django.core.management.base import BaseCommand
+from django.core.management.base import CommandError
+
+from dry_newsletter.newsletter.models import Link
+from dry_newsletter.newsletter.models import Newsletter
+from dry_newsletter.newsletter.models import StatusCount
+
+
+class Command(BaseCommand):
+    """Count again the statuses of the newsletters"""
+    args = '[slug slug ...]'
+    help = ('Rebuild the statistics of the newsletters given, or of all of '
+            'them, from their statuses. The statuses written during the '
+            'rebuild of a newsletter may be counted twice or not at all.')
+
+    def handle(self, *slugs, **options):
+        verbose = int(options['verbosity'])
+        newsletters = Newsletter.objects.all()
+        if slugs:
+            newsletters = newsletters.filter(slug__in=slugs)
+            unknown = set(slugs) - set(newsletters.values_list('slug', flat=True))
+            if unknown:
+                raise CommandError('Unknown newsletters: %s' %
+                                   ', '.join(sorted(unknown)))
+
+        for newsletter in newsletters:
+            with transaction.commit_on_success():
+                StatusCount.objects.rebuild(newsletter.pk)
+                Link.objects.rebuild_clicks(newsletter.pk)
+            if verbose:
+                print 'Statistics of %s rebuilt' % newsletter.title
@@ -1,31 +1,175 @@
 """Command for sending the newsletter"""
+import signal
+from threading import Event
+from threading import Thread
+from optparse import make_option
+from collections import OrderedDict
+from multiprocessing import Process
+
 from django.conf import settings
+from django.db import connection
 from django.utils.translation import activate
 from django.core.management.base import NoArgsCommand
 
 from dry_newsletter.newsletter.mailer import Mailer
 from dry_newsletter.newsletter.models import Newsletter
+from dry_newsletter.newsletter.settings import RENDER_PROCESSES
+from dry_newsletter.newsletter.utils.stats import stats
 
 
 class Command(NoArgsCommand):
     """Send the newsletter in queue"""
     help = 'Send the newsletter in queue'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--processes', type='int', default=RENDER_PROCESSES,
+                    help='Render the messages in a pool of processes.'),
+        make_option('--workers', type='int', default=1,
+                    help='Split the recipients of each newsletter in shards '
+                    'sent by this number of processes.'),
+        make_option('--concurrency', type='int', default=0,
+                    help='Number of servers sending at the same time, '
+                    'all of them by default.'),
+        make_option('--stats', action='store_true', default=False,
+                    help='Time the stages of the sending and print a '
+                    'summary at the end, or on SIGUSR1.'),
+        )
 
     def handle_noargs(self, **options):
-        verbose = int(options['verbosity'])
+        verbose = self.verbose = int(options['verbosity'])
+        self.workers = max(options.get('workers') or 1, 1)
+        self.processes = options['processes']
+        self.stopping = Event()
 
         if verbose:
             print 'Starting sending newsletters...'
 
         activate(settings.LANGUAGE_CODE)
 
-        for newsletter in Newsletter.objects.exclude(
-            status=Newsletter.DRAFT).exclude(status=Newsletter.SENT):
-            mailer = Mailer(newsletter, verbose=verbose)
-            if mailer.can_send:
-                if verbose:
-                    print 'Start emailing %s' % newsletter.title.encode('ascii', 'ignore')
-                mailer.run()
+        # unwind the mailer so the buffered statuses are saved
+        signal.signal(signal.SIGTERM, exit_handler)
+        if options['stats']:
+            stats.enable()
+            signal.signal(signal.SIGUSR1, stats_handler)
+
+        queues = server_queues(Newsletter.objects.exclude(
+            status=Newsletter.DRAFT).exclude(status=Newsletter.SENT))
+        # the shards fork processes, which does not mix with threads
+        if self.workers > 1 or len(queues) < 2:
+            for newsletters in queues:
+                self.send_queue(newsletters)
+        else:
+            # and no pool of processes is forked from the threads either
+            self.processes = 1
+            self.send_queues(queues, options.get('concurrency') or len(queues))
 
         if verbose:
             print 'End session sending'
+        if options['stats']:
+            print stats.report()
+
+    def send_queue(self, newsletters):
+        """Send the newsletters of a server one after another"""
+        for newsletter in newsletters:
+            if self.stopping.is_set():
+                return
+            mailer = Mailer(newsletter, verbose=self.verbose,
+                            processes=self.processes)
+            mailer.stop_event = self.stopping
+            if mailer.can_send:
+                if self.verbose:
+                    print 'Start emailing %s' % newsletter.title.encode('ascii', 'ignore')
+                if self.workers > 1:
+                    send_shards(mailer, self.workers, self.verbose,
+                                self.processes)
+                else:
+                    mailer.run()
+
+    def send_queues(self, queues, concurrency):
+        """Send the queues of the servers at the same time, with at most
+        concurrency threads"""
+        queues = list(reversed(queues))
+        threads = [Thread(target=self.send_queues_thread, args=(queues,))
+                   for i in range(min(concurrency, len(queues)))]
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                # a join with a timeout lets the signals be handled
+                while thread.is_alive():
+                    thread.join(1)
+        except BaseException:
+            self.stopping.set()
+            for thread in threads:
+                if thread.is_alive():
+                    thread.join()
+            raise
+
+    def send_queues_thread(self, queues):
+        activate(settings.LANGUAGE_CODE)
+        try:
+            while not self.stopping.is_set():
+                try:
+                    newsletters = queues.pop()
+                except IndexError:
+                    return
+                self.send_queue(newsletters)
+        finally:
+            connection.close()
+
+
+def server_queues(newsletters):
+    """Group the newsletters by server, in their order"""
+    queues = OrderedDict()
+    for newsletter in newsletters:
+        queues.setdefault(newsletter.server_id, []).append(newsletter)
+    return queues.values()
+
+
+def split_credits(credits, count):
+    """Share the credits between count shards"""
+    share, extra = divmod(max(credits, 0), count)
+    return [share + (index < extra) for index in range(count)]
+
+
+def send_shard(newsletter, shard, credits, verbose, processes):
+    Mailer(newsletter, verbose=verbose, processes=processes,
+           shard=shard, credits=credits).run()
+
+
+def send_shards(mailer, workers, verbose, processes):
+    """Send the newsletter of the mailer with a process per shard of the
+    contact ids. The sent contacts are recorded as usual, so a sending
+    interrupted or with a dead worker is resumed by the next run."""
+    newsletter = mailer.newsletter
+    budgets = split_credits(mailer.credits(), workers)
+    # the workers open their own connection to the database
+    connection.close()
+    shards = [Process(target=send_shard,
+                      args=(newsletter, (index, workers), budgets[index],
+                            verbose, processes),
+                      name='shard-%s' % index)
+              for index in range(workers) if budgets[index]]
+    try:
+        for shard in shards:
+            shard.start()
+        for shard in shards:
+            shard.join()
+    finally:
+        for shard in shards:
+            if shard.is_alive():
+                shard.terminate()
+                shard.join()
+
+    failed = [shard.name for shard in shards if shard.exitcode]
+    if failed and verbose:
+        print 'Workers %s failed, their contacts will be sent on the next run' % (
+            ', '.join(failed))
+    mailer.update_newsletter_status()
+
+
+def exit_handler(signum, frame):
+    raise SystemExit('Interrupted by signal %s' % signum)
+
+
+def stats_handler(signum, frame):
+    print stats.report()
@@ -1,5 +1,7 @@
 """Command for sending the newsletter"""
+from optparse import make_option
 from threading import Thread
+from threading import Event
 import signal
 import sys
 
@@ -9,15 +11,40 @@ from django.core import signals
 from django.core.management.base import NoArgsCommand
 
 from dry_newsletter.newsletter.mailer import SMTPMailer
+from dry_newsletter.newsletter.mailer import AsyncSMTPMailer
+from dry_newsletter.newsletter.settings import RENDER_PROCESSES
+from dry_newsletter.newsletter.settings import ASYNC_SMTP_SESSIONS
 from dry_newsletter.newsletter.models import SMTPServer
+from dry_newsletter.newsletter.utils.pool import close_pools
+from dry_newsletter.newsletter.utils.stats import stats
+from dry_newsletter.newsletter.utils.metrics import MetricsServer
 
 
 class Command(NoArgsCommand):
     """Send the newsletter in queue"""
     help = 'Send the newsletter in queue'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--engine', choices=['thread', 'async'], default='thread',
+                    help='Sending engine: "thread" sends one message at a '
+                    'time per server, "async" keeps several SMTP sessions '
+                    'per server busy (servers using TLS stay threaded).'),
+        make_option('--sessions', type='int', default=ASYNC_SMTP_SESSIONS,
+                    help='Concurrent SMTP sessions per server with the '
+                    'async engine.'),
+        make_option('--processes', type='int', default=RENDER_PROCESSES,
+                    help='Ignored, the mailers run in threads which render '
+                    'the messages themselves. Kept for compatibility.'),
+        make_option('--metrics-port', type='int', default=None,
+                    help='Serve the metrics of the mailers in the Prometheus '
+                    'text format on this port of localhost.'),
+        make_option('--stats', action='store_true', default=False,
+                    help='Time the stages of the sending and print a '
+                    'summary at the end, or on SIGUSR1.'),
+        )
 
     def handle_noargs(self, **options):
         verbose = int(options['verbosity'])
+        engine = options.get('engine', 'thread')
 
         if verbose:
             print 'Starting sending newsletters...'
@@ -27,14 +54,31 @@ class Command(NoArgsCommand):
         senders = SMTPServer.objects.all()
         workers = []
 
+        # a pool of processes forked from the threads of the mailers
+        # would copy the locks held by the other threads
         for sender in senders:
-            worker = SMTPMailer(sender, verbose=verbose)
+            if engine == 'async' and not sender.tls:
+                worker = AsyncSMTPMailer(sender, verbose=verbose, processes=1,
+                                         sessions=options['sessions'])
+            else:
+                worker = SMTPMailer(sender, verbose=verbose, processes=1)
             thread = Thread(target=worker.run, name=sender.name)
             workers.append((worker, thread))
 
-        handler = term_handler(workers)
+        stopping = Event()
+        handler = term_handler(workers, stopping)
         for s in [signal.SIGTERM, signal.SIGINT]:
             signal.signal(s, handler)
+        if options['stats']:
+            stats.enable()
+            signal.signal(signal.SIGUSR1, stats_handler)
+
+        metrics_server = None
+        if options.get('metrics_port'):
+            metrics_server = MetricsServer(
+                [worker.metrics for worker, thread in workers],
+                options['metrics_port'])
+            metrics_server.start()
 
         # first close current connection
         signals.request_finished.send(sender=self.__class__)
@@ -42,19 +86,30 @@ class Command(NoArgsCommand):
         for worker, thread in workers:
             thread.start()
 
-        signal.pause()  # wait for sigterm
+        while not stopping.is_set():
+            signal.pause()  # wait for sigterm
 
         for worker, thread in workers:
             if thread.is_alive():
                 thread.join()
 
+        close_pools()
+        if metrics_server is not None:
+            metrics_server.stop()
+        if options['stats']:
+            print stats.report()
         sys.exit(0)
 
 
-def term_handler(workers):
+def term_handler(workers, stopping):
 
     def handler(signum, frame):
+        stopping.set()
         for worker, thread in workers:
             worker.stop_event.set()
 
     return handler
+
+
+def stats_handler(signum, frame):
+    print stats.report()
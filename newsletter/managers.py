@@ -1,5 +1,20 @@
 """Managers for emencia.django.newsletter"""
+from datetime import datetime
+from datetime import timedelta
+
 from django.db import models
+from django.db import connection
+from django.db import transaction
+from django.db import IntegrityError
+from django.db.models import F
+from django.db.models import Sum
+from django.db.models import Count
+from django.utils.timezone import utc
+from django.utils.encoding import smart_unicode
+
+from dry_newsletter.newsletter.utils.bitmap import Bitmap
+from dry_newsletter.newsletter.settings import RETRY_DELAY
+from dry_newsletter.newsletter.settings import RETRY_MAX_ATTEMPTS
 
 
 class ContactManager(models.Manager):
@@ -20,3 +35,257 @@ class ContactManager(models.Manager):
     def valid_subscribers(self):
         """Return only valid subscribers"""
         return self.subscribers().filter(valid=True)
+
+    def expedition_set(self, newsletter, shard=None):
+        """Return in a single query the valid subscribers of any mailing
+        list of the newsletter, who did not unsubscribe from that list.
+        shard is an optional (index, count) keeping only the contacts
+        whose id modulo count is index"""
+        from dry_newsletter.newsletter.models import MailingList
+        from dry_newsletter.newsletter.models import Newsletter
+
+        qn = connection.ops.quote_name
+        subscribers = MailingList.subscribers.field
+        unsubscribers = MailingList.unsubscribers.field
+        mailing_lists = Newsletter.mailing_lists.field
+        where = """EXISTS (
+            SELECT 1 FROM %(subscribers)s s
+            INNER JOIN %(mailing_lists)s n
+                ON n.%(nl_mailing_list)s = s.%(mailing_list)s
+            WHERE s.%(contact)s = %(contact_table)s.%(contact_pk)s
+            AND n.%(newsletter)s = %%s
+            AND NOT EXISTS (
+                SELECT 1 FROM %(unsubscribers)s u
+                WHERE u.%(unsub_mailing_list)s = s.%(mailing_list)s
+                AND u.%(unsub_contact)s = s.%(contact)s))""" % {
+            'subscribers': qn(subscribers.m2m_db_table()),
+            'mailing_list': qn(subscribers.m2m_column_name()),
+            'contact': qn(subscribers.m2m_reverse_name()),
+            'unsubscribers': qn(unsubscribers.m2m_db_table()),
+            'unsub_mailing_list': qn(unsubscribers.m2m_column_name()),
+            'unsub_contact': qn(unsubscribers.m2m_reverse_name()),
+            'mailing_lists': qn(mailing_lists.m2m_db_table()),
+            'newsletter': qn(mailing_lists.m2m_column_name()),
+            'nl_mailing_list': qn(mailing_lists.m2m_reverse_name()),
+            'contact_table': qn(self.model._meta.db_table),
+            'contact_pk': qn(self.model._meta.pk.column)}
+        queryset = self.valid_subscribers().extra(where=[where],
+                                                  params=[newsletter.pk])
+        if shard is not None:
+            index, count = shard
+            queryset = queryset.extra(
+                where=['%s.%s %%%% %%s = %%s' % (
+                    qn(self.model._meta.db_table),
+                    qn(self.model._meta.pk.column))],
+                params=[count, index])
+        return queryset
+
+
+class SMTPServerUsageManager(models.Manager):
+    """Manager for the sliding window of messages sent by the servers"""
+
+    def record(self, server_id, count, when=None):
+        """Add count messages sent by a server in the current minute"""
+        when = when or datetime.utcnow().replace(tzinfo=utc)
+        minute = when.replace(second=0, microsecond=0)
+        bucket = self.filter(server=server_id, minute=minute)
+        if bucket.update(sent=F('sent') + count):
+            return
+
+        sid = transaction.savepoint()
+        try:
+            self.create(server_id=server_id, minute=minute, sent=count)
+        except IntegrityError:
+            # created meanwhile by another process
+            transaction.savepoint_rollback(sid)
+            bucket.update(sent=F('sent') + count)
+        else:
+            transaction.savepoint_commit(sid)
+            self.filter(server=server_id,
+                        minute__lt=minute - timedelta(hours=1)).delete()
+
+    def sent_last_hour(self, server):
+        """Number of messages sent by a server during the last hour,
+        counting the whole minute an hour ago, as its messages could
+        have been sent in the last hour"""
+        last_hour = datetime.utcnow().replace(tzinfo=utc) - timedelta(hours=1)
+        return self.filter(server=server, minute__gte=last_hour.replace(
+            second=0, microsecond=0)).aggregate(sent=Sum('sent'))['sent'] or 0
+
+
+class SentBitmapManager(models.Manager):
+    """Manager for the bitmaps of the contacts a newsletter was sent to"""
+
+    def sent_statuses(self, newsletter_id):
+        from dry_newsletter.newsletter.models import ContactMailingStatus
+        return ContactMailingStatus.objects.filter(
+            newsletter=newsletter_id, status=ContactMailingStatus.SENT)
+
+    def build(self, newsletter_id):
+        """Build the bitmap of a newsletter from its statuses"""
+        return Bitmap(self.sent_statuses(newsletter_id).values_list(
+            'contact', flat=True).iterator())
+
+    def bitmap(self, newsletter):
+        """Return the Bitmap of the contacts a newsletter was sent to,
+        built from the statuses the first time. The rows added by the
+        flushes are merged into one."""
+        rows = list(self.filter(newsletter=newsletter).values_list('pk', 'data'))
+        if not rows:
+            if not self.sent_statuses(newsletter.pk).exists():
+                return Bitmap()
+            bitmap = self.build(newsletter.pk)
+            self.create(newsletter=newsletter, data=bitmap.dumps())
+            return bitmap
+
+        bitmap = Bitmap()
+        for pk, data in rows:
+            bitmap.merge(Bitmap.loads(data))
+        if len(rows) > 1:
+            # the rows added meanwhile are kept, a contact can be twice
+            self.create(newsletter=newsletter, data=bitmap.dumps())
+            self.filter(pk__in=[pk for pk, data in rows]).delete()
+        return bitmap
+
+    def add(self, newsletter_id, contact_ids):
+        """Add a row with contacts reached by a newsletter, without
+        locking the other senders. The first row is built from the
+        statuses, for the sendings started before the bitmaps."""
+        if self.filter(newsletter=newsletter_id).exists():
+            bitmap = Bitmap(contact_ids)
+        else:
+            bitmap = self.build(newsletter_id)
+            bitmap.update(contact_ids)
+        self.create(newsletter_id=newsletter_id, data=bitmap.dumps())
+
+
+class MailingRetryManager(models.Manager):
+    """Manager for the messages to send again after a temporary failure"""
+
+    def pending(self, newsletter):
+        """Retries of a newsletter which have attempts left"""
+        return self.filter(newsletter=newsletter,
+                           attempts__lt=RETRY_MAX_ATTEMPTS)
+
+    def exhausted(self, newsletter):
+        """Retries of a newsletter which used all their attempts"""
+        return self.filter(newsletter=newsletter,
+                           attempts__gte=RETRY_MAX_ATTEMPTS)
+
+    def due(self, newsletter, now=None, shard=None):
+        """Pending retries of a newsletter whose time has come, the
+        longest overdue first. shard is an optional (index, count)
+        keeping only the contacts whose id modulo count is index, like
+        in Contact.objects.expedition_set"""
+        now = now or datetime.utcnow().replace(tzinfo=utc)
+        queryset = self.pending(newsletter).filter(
+            next_attempt__lte=now).select_related('contact').order_by(
+            'next_attempt')
+        if shard is not None:
+            index, count = shard
+            qn = connection.ops.quote_name
+            queryset = queryset.extra(
+                where=['%s.%s %%%% %%s = %%s' % (
+                    qn(self.model._meta.db_table),
+                    qn(self.model._meta.get_field('contact').column))],
+                params=[count, index])
+        return queryset
+
+    def schedule(self, newsletter, contact, error, now=None):
+        """Count a failed attempt to send a newsletter to a contact and
+        plan the next one, each delay doubling the previous. Return
+        False when the attempts are exhausted."""
+        now = now or datetime.utcnow().replace(tzinfo=utc)
+        retry, created = self.get_or_create(
+            newsletter=newsletter, contact=contact,
+            defaults={'next_attempt': now})
+        retry.attempts += 1
+        retry.next_attempt = now + timedelta(
+            seconds=RETRY_DELAY * 2 ** (retry.attempts - 1))
+        retry.last_error = smart_unicode(error)[:255]
+        retry.save()
+        return retry.attempts < RETRY_MAX_ATTEMPTS
+
+
+class LinkManager(models.Manager):
+    """Manager for the tracked links of the newsletters"""
+
+    def table(self, newsletter_id):
+        """Return the urls of the links of a newsletter by id"""
+        return dict(self.filter(newsletter=newsletter_id).values_list(
+            'id', 'url'))
+
+    def ids(self, newsletter_id, urls):
+        """Return the ids of the links of a newsletter by url, saving
+        the urls which are not yet"""
+        ids = dict(self.filter(newsletter=newsletter_id).values_list(
+            'url', 'id'))
+        missing = set(urls) - set(ids)
+        if not missing:
+            return ids
+
+        sid = transaction.savepoint()
+        try:
+            self.bulk_create([self.model(newsletter_id=newsletter_id, url=url)
+                              for url in missing])
+        except IntegrityError:
+            # saved meanwhile by another mailer of the newsletter
+            transaction.savepoint_rollback(sid)
+        else:
+            transaction.savepoint_commit(sid)
+        return dict(self.filter(newsletter=newsletter_id).values_list(
+            'url', 'id'))
+
+    def rebuild_clicks(self, newsletter_id):
+        """Count again the clicks on the links of a newsletter from its
+        statuses"""
+        from dry_newsletter.newsletter.models import ContactMailingStatus
+        self.filter(newsletter=newsletter_id).update(clicks=0)
+        clicks = ContactMailingStatus.objects.filter(
+            newsletter=newsletter_id, status=ContactMailingStatus.LINK_OPENED,
+            link__isnull=False).values_list('link').annotate(
+            clicks=Count('id')).order_by()
+        for link_id, count in clicks:
+            self.filter(pk=link_id).update(clicks=count)
+
+
+class StatusCountManager(models.Manager):
+    """Manager for the statuses of the newsletters counted by hour"""
+
+    def record(self, newsletter_id, status, hour, count):
+        """Add count statuses of a newsletter written during an hour"""
+        bucket = self.filter(newsletter=newsletter_id, status=status, hour=hour)
+        if bucket.update(count=F('count') + count):
+            return
+
+        sid = transaction.savepoint()
+        try:
+            self.create(newsletter_id=newsletter_id, status=status,
+                        hour=hour, count=count)
+        except IntegrityError:
+            # created meanwhile by another process
+            transaction.savepoint_rollback(sid)
+            bucket.update(count=F('count') + count)
+        else:
+            transaction.savepoint_commit(sid)
+
+    def totals(self, newsletter):
+        """Return the number of statuses of a newsletter by status"""
+        return dict(self.filter(newsletter=newsletter).values_list(
+            'status').annotate(total=Sum('count')).order_by())
+
+    def rebuild(self, newsletter_id):
+        """Count again the statuses of a newsletter, reading them all"""
+        from dry_newsletter.newsletter.models import ContactMailingStatus
+        counts = {}
+        statuses = ContactMailingStatus.objects.filter(
+            newsletter=newsletter_id).values_list(
+            'status', 'creation_date').order_by()
+        for status, when in statuses.iterator():
+            key = (status, when.replace(minute=0, second=0, microsecond=0))
+            counts[key] = counts.get(key, 0) + 1
+
+        self.filter(newsletter=newsletter_id).delete()
+        self.bulk_create([self.model(newsletter_id=newsletter_id, status=status,
+                                     hour=hour, count=count)
+                          for (status, hour), count in counts.items()])
@@ -4,9 +4,11 @@ import os
 from smtplib import SMTP
 from smtplib import SMTPHeloError
 from datetime import datetime
-from datetime import timedelta
 
 from django.db import models
+from django.db.models import F
+from django.db.models.signals import post_save
+from django.db.models.signals import post_init
 from django.utils.encoding import smart_str
 from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _
@@ -14,11 +16,23 @@ from django.contrib.contenttypes import generic
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.auth.models import Group
 from django.utils.encoding import force_unicode
+from django.utils import timezone
 from django.utils.timezone import utc
 
 from dry_newsletter.newsletter.managers import ContactManager
+from dry_newsletter.newsletter.managers import SMTPServerUsageManager
+from dry_newsletter.newsletter.managers import SentBitmapManager
+from dry_newsletter.newsletter.managers import MailingRetryManager
+from dry_newsletter.newsletter.managers import LinkManager
+from dry_newsletter.newsletter.managers import StatusCountManager
+from dry_newsletter.newsletter.signals import statuses_created
+from dry_newsletter.newsletter.utils.pool import get_pool
+from dry_newsletter.newsletter.utils.pacing import get_pacer
+from dry_newsletter.newsletter.utils.stats import stats
+from dry_newsletter.newsletter.utils.wakeup import notify
 from dry_newsletter.newsletter.settings import BASE_PATH
 from dry_newsletter.newsletter.settings import MAILER_HARD_LIMIT
+from dry_newsletter.newsletter.settings import SLEEP_BETWEEN_SENDING
 from dry_newsletter.newsletter.settings import DEFAULT_HEADER_REPLY
 from dry_newsletter.newsletter.settings import DEFAULT_HEADER_SENDER
 
@@ -47,6 +61,15 @@ class SMTPServer(models.Model):
             smtp.login(smart_str(self.user), smart_str(self.password))
         return smtp
 
+    def connection_pool(self):
+        """Return the pool of long-lived connections to the server"""
+        return get_pool(self)
+
+    def pacer(self):
+        """Return the pacer spreading the mails sent by the server,
+        never faster than one mail per NEWSLETTER_SLEEP_BETWEEN_SENDING"""
+        return get_pacer(self, SLEEP_BETWEEN_SENDING)
+
     def delay(self):
         """compute the delay (in seconds) between mails to ensure mails
         per hour limit is not reached
@@ -63,13 +86,8 @@ class SMTPServer(models.Model):
         if not self.mails_hour:
             return MAILER_HARD_LIMIT
 
-        last_hour = datetime.utcnow().replace(tzinfo=utc) - timedelta(hours=1)
-        sent_last_hour = ContactMailingStatus.objects.filter(
-            models.Q(status=ContactMailingStatus.SENT) |
-            models.Q(status=ContactMailingStatus.SENT_TEST),
-            newsletter__server=self,
-            creation_date__gte=last_hour).count()
-        return self.mails_hour - sent_last_hour
+        with stats.timer('credits'):
+            return self.mails_hour - SMTPServerUsage.objects.sent_last_hour(self)
 
     @property
     def custom_headers(self):
@@ -223,6 +241,9 @@ class Newsletter(models.Model):
     mailing_lists = models.ManyToManyField(MailingList, verbose_name=_('mailing list'), related_name=('newsletters'),)
     test_contacts = models.ManyToManyField(Contact, verbose_name=_('test contacts'), blank=True, null=True)
     server = models.ForeignKey(SMTPServer, verbose_name=_('smtp server'), default=1)
+    servers = models.ManyToManyField(SMTPServer, verbose_name=_('other smtp servers'),
+                                     related_name='pooled_newsletters', blank=True,
+                                     help_text=_('Servers sharing the sending with the smtp server.'))
     header_sender = models.CharField(_('sender'), max_length=255, default=DEFAULT_HEADER_SENDER)
     header_reply = models.CharField(_('reply to'), max_length=255, default=DEFAULT_HEADER_REPLY)
     status = models.IntegerField(_('status'), choices=STATUS_CHOICES, default=DRAFT)
@@ -234,6 +255,10 @@ class Newsletter(models.Model):
     def mails_sent(self):
         return self.contactmailingstatus_set.filter(status=ContactMailingStatus.SENT).count()
 
+    def smtp_servers(self):
+        """The smtp server followed by the other servers of the newsletter"""
+        return [self.server] + list(self.servers.exclude(pk=self.server_id))
+
     @models.permalink
     def get_absolute_url(self):
         return ('newsletter_newsletter_preview', (self.slug,))
@@ -248,6 +273,48 @@ class Newsletter(models.Model):
         permissions = (('can_change_status', 'Can change status'),)
 
 
+def get_newsletter_storage_path(instance, filename):
+    filename = force_unicode(filename)
+    return '/'.join([BASE_PATH, instance.newsletter.slug, filename])
+
+
+class Attachment(models.Model):
+    """Attachment file in a newsletter"""
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'))
+    title = models.CharField(_('title'), max_length=255)
+    file_attachment = models.FileField(_('file to attach'), max_length=255,
+                                       upload_to=get_newsletter_storage_path)
+
+    class Meta:
+        verbose_name = _('attachment')
+        verbose_name_plural = _('attachments')
+
+    def __unicode__(self):
+        return self.title
+
+    def get_absolute_url(self):
+        return self.file_attachment.url
+
+
+class Link(models.Model):
+    """Link of a newsletter, replaced in the mails by a tracking url"""
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'),
+                                   related_name='links')
+    url = models.CharField(_('url'), max_length=255)
+    clicks = models.IntegerField(_('clicks'), default=0)
+    creation_date = models.DateTimeField(_('creation date'), auto_now_add=True)
+
+    objects = LinkManager()
+
+    def __unicode__(self):
+        return self.url
+
+    class Meta:
+        unique_together = (('newsletter', 'url'),)
+        verbose_name = _('link')
+        verbose_name_plural = _('links')
+
+
 class ContactMailingStatus(models.Model):
     """Status of the reception"""
     SENT_TEST = -1
@@ -272,8 +339,13 @@ class ContactMailingStatus(models.Model):
     newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'))
     contact = models.ForeignKey(Contact, verbose_name=_('contact'))
     status = models.IntegerField(_('status'), choices=STATUS_CHOICES)
+    server = models.ForeignKey(SMTPServer, verbose_name=_('smtp server'),
+                               null=True, blank=True,
+                               help_text=_('Server of the message, when not the one of the newsletter.'))
+    link = models.ForeignKey(Link, verbose_name=_('link'), null=True, blank=True)
 
-    creation_date = models.DateTimeField(_('creation date'), auto_now_add=True)
+    # not auto_now_add, the buffered events keep the date they happened
+    creation_date = models.DateTimeField(_('creation date'), default=timezone.now)
 
     def __unicode__(self):
         return '%s : %s : %s' % (self.newsletter.__unicode__(),
@@ -283,4 +355,146 @@ class ContactMailingStatus(models.Model):
     class Meta:
         ordering = ('-creation_date',)
         verbose_name = _('contact mailing status')
-        verbose_name_plural = _('contact mailing statuses')
\ No newline at end of file
+        verbose_name_plural = _('contact mailing statuses')
+
+
+class MailingRetry(models.Model):
+    """Message of a newsletter to send again to a contact after a
+    temporary failure"""
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'))
+    contact = models.ForeignKey(Contact, verbose_name=_('contact'))
+    attempts = models.PositiveIntegerField(_('attempts'), default=0)
+    next_attempt = models.DateTimeField(_('next attempt'), db_index=True)
+    last_error = models.CharField(_('last error'), max_length=255, blank=True)
+    creation_date = models.DateTimeField(_('creation date'), auto_now_add=True)
+
+    objects = MailingRetryManager()
+
+    def __unicode__(self):
+        return '%s : %s : %s' % (self.newsletter.__unicode__(),
+                                 self.contact.__unicode__(),
+                                 self.attempts)
+
+    class Meta:
+        ordering = ('next_attempt',)
+        unique_together = (('newsletter', 'contact'),)
+        verbose_name = _('mailing retry')
+        verbose_name_plural = _('mailing retries')
+
+
+class SMTPServerUsage(models.Model):
+    """Messages sent by a SMTP server during a minute, the last hour
+    of them giving the server credits"""
+    server = models.ForeignKey(SMTPServer, verbose_name=_('smtp server'))
+    minute = models.DateTimeField(_('minute'))
+    sent = models.IntegerField(_('sent'), default=0)
+
+    objects = SMTPServerUsageManager()
+
+    class Meta:
+        unique_together = (('server', 'minute'),)
+        verbose_name = _('SMTP server usage')
+        verbose_name_plural = _('SMTP server usages')
+
+
+class StatusCount(models.Model):
+    """Statuses of a newsletter written during an hour, counted as they
+    are written for the statistics"""
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'))
+    status = models.IntegerField(_('status'),
+                                 choices=ContactMailingStatus.STATUS_CHOICES)
+    hour = models.DateTimeField(_('hour'))
+    count = models.IntegerField(_('count'), default=0)
+
+    objects = StatusCountManager()
+
+    class Meta:
+        ordering = ('hour',)
+        unique_together = (('newsletter', 'status', 'hour'),)
+        verbose_name = _('status count')
+        verbose_name_plural = _('status counts')
+
+
+class SentBitmap(models.Model):
+    """Contacts a newsletter was sent to, as compressed bitmaps of
+    their ids, for resuming a sending without reading the statuses.
+    Each flush of statuses adds a row, merged when the bitmap is read"""
+    newsletter = models.ForeignKey(Newsletter, verbose_name=_('newsletter'),
+                                   related_name='sent_bitmaps')
+    data = models.TextField(_('data'), blank=True)
+    modification_date = models.DateTimeField(_('modification date'), auto_now=True)
+
+    objects = SentBitmapManager()
+
+    class Meta:
+        verbose_name = _('sent bitmap')
+        verbose_name_plural = _('sent bitmaps')
+
+
+def status_post_save(sender, instance, created, raw, **kwargs):
+    """Statuses saved one by one are announced like the bulk ones"""
+    if created and not raw:
+        statuses_created.send(sender=ContactMailingStatus, statuses=[instance])
+
+
+def record_server_usage(sender, statuses, **kwargs):
+    """Count the sent messages in the usage of their server"""
+    sent = {}
+    for status in statuses:
+        if status.status in (ContactMailingStatus.SENT,
+                             ContactMailingStatus.SENT_TEST):
+            server_id = status.server_id or status.newsletter.server_id
+            sent[server_id] = sent.get(server_id, 0) + 1
+    for server_id, count in sent.items():
+        SMTPServerUsage.objects.record(server_id, count)
+
+
+def record_sent_contacts(sender, statuses, **kwargs):
+    """Add the contacts reached to the bitmaps of the newsletters"""
+    sent = {}
+    for status in statuses:
+        if status.status == ContactMailingStatus.SENT:
+            sent.setdefault(status.newsletter_id, []).append(status.contact_id)
+    for newsletter_id, contact_ids in sent.items():
+        SentBitmap.objects.add(newsletter_id, contact_ids)
+
+def record_status_counts(sender, statuses, **kwargs):
+    """Count the statuses by hour and the clicks on the links"""
+    counts = {}
+    clicks = {}
+    for status in statuses:
+        hour = status.creation_date.replace(minute=0, second=0, microsecond=0)
+        key = (status.newsletter_id, status.status, hour)
+        counts[key] = counts.get(key, 0) + 1
+        if status.link_id:
+            clicks[status.link_id] = clicks.get(status.link_id, 0) + 1
+    for (newsletter_id, status, hour), count in counts.items():
+        StatusCount.objects.record(newsletter_id, status, hour, count)
+    for link_id, count in clicks.items():
+        Link.objects.filter(pk=link_id).update(clicks=F('clicks') + count)
+
+def sending_state(newsletter):
+    return (newsletter.status, newsletter.sending_date, newsletter.server_id)
+
+
+def newsletter_post_init(sender, instance, **kwargs):
+    """Remember the sending state of a newsletter as loaded"""
+    instance._sending_state = sending_state(instance)
+
+
+def newsletter_post_save(sender, instance, created, raw, **kwargs):
+    """Wake up the mailers of the server of a newsletter to send, when
+    its status, sending date or server changed"""
+    state = sending_state(instance)
+    changed = created or state != instance._sending_state
+    instance._sending_state = state
+    if not raw and changed and \
+           instance.status in (Newsletter.WAITING, Newsletter.SENDING):
+        notify(instance.server_id)
+
+post_save.connect(status_post_save, sender=ContactMailingStatus)
+post_init.connect(newsletter_post_init, sender=Newsletter)
+post_save.connect(newsletter_post_save, sender=Newsletter)
+statuses_created.connect(record_server_usage, sender=ContactMailingStatus)
+statuses_created.connect(record_sent_contacts, sender=ContactMailingStatus)
+statuses_created.connect(record_status_counts, sender=ContactMailingStatus)
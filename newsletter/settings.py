@@ -1,5 +1,7 @@
 """Settings for emencia.django.newsletter"""
+import os
 import string
+import tempfile
 from django.conf import settings
 
 BASE64_IMAGES = {
@@ -28,6 +30,7 @@ DEFAULT_HEADER_REPLY = getattr(settings, 'NEWSLETTER_DEFAULT_HEADER_REPLY',
                                DEFAULT_HEADER_SENDER)
 
 TRACKING_LINKS = getattr(settings, 'NEWSLETTER_TRACKING_LINKS', True)
+TRACKING_OPENS = getattr(settings, 'NEWSLETTER_TRACKING_OPENS', True)
 TRACKING_IMAGE_FORMAT = getattr(settings, 'NEWSLETTER_TRACKING_IMAGE_FORMAT', 'jpg')
 TRACKING_IMAGE = getattr(settings, 'NEWSLETTER_TRACKING_IMAGE',
                          BASE64_IMAGES[TRACKING_IMAGE_FORMAT])
@@ -38,3 +41,46 @@ RESTART_CONNECTION_BETWEEN_SENDING = getattr(
     settings, 'NEWSLETTER_RESTART_CONNECTION_BETWEEN_SENDING', False)
 
 BASE_PATH = getattr(settings, 'NEWSLETTER_BASE_PATH', 'uploads/newsletter')
+
+SMTP_POOL_SIZE = getattr(settings, 'NEWSLETTER_SMTP_POOL_SIZE', 4)
+SMTP_POOL_MAX_MESSAGES = getattr(
+    settings, 'NEWSLETTER_SMTP_POOL_MAX_MESSAGES', 100)
+SMTP_POOL_MAX_AGE = getattr(settings, 'NEWSLETTER_SMTP_POOL_MAX_AGE', 300)
+SMTP_POOL_NOOP_INTERVAL = getattr(
+    settings, 'NEWSLETTER_SMTP_POOL_NOOP_INTERVAL', 30)
+SMTP_POOL_TIMEOUT = getattr(settings, 'NEWSLETTER_SMTP_POOL_TIMEOUT', 60)
+
+ASYNC_SMTP_SESSIONS = getattr(settings, 'NEWSLETTER_ASYNC_SMTP_SESSIONS', 4)
+ASYNC_SMTP_TIMEOUT = getattr(settings, 'NEWSLETTER_ASYNC_SMTP_TIMEOUT', 60)
+
+RENDER_PROCESSES = getattr(settings, 'NEWSLETTER_RENDER_PROCESSES', 0)
+RENDER_CHUNK_SIZE = getattr(settings, 'NEWSLETTER_RENDER_CHUNK_SIZE', 100)
+RENDER_QUEUE_SIZE = getattr(settings, 'NEWSLETTER_RENDER_QUEUE_SIZE', 8)
+RENDER_TIMEOUT = getattr(settings, 'NEWSLETTER_RENDER_TIMEOUT', 600)
+
+EXPEDITION_CHUNK_SIZE = getattr(settings, 'NEWSLETTER_EXPEDITION_CHUNK_SIZE', 1000)
+
+STATUS_BATCH_SIZE = getattr(settings, 'NEWSLETTER_STATUS_BATCH_SIZE', 100)
+STATUS_FLUSH_INTERVAL = getattr(settings, 'NEWSLETTER_STATUS_FLUSH_INTERVAL', 5)
+
+PACING_BURST = getattr(settings, 'NEWSLETTER_PACING_BURST', 1)
+
+ATTACHMENT_CACHE_SIZE = getattr(
+    settings, 'NEWSLETTER_ATTACHMENT_CACHE_SIZE', 64 * 1024 * 1024)
+
+WAKEUP_ADDRESS = getattr(settings, 'NEWSLETTER_WAKEUP_ADDRESS', ('127.0.0.1', 8765))
+
+BALANCER_FAILURES = getattr(settings, 'NEWSLETTER_BALANCER_FAILURES', 3)
+BALANCER_COOLDOWN = getattr(settings, 'NEWSLETTER_BALANCER_COOLDOWN', 60)
+
+RETRY_MAX_ATTEMPTS = getattr(settings, 'NEWSLETTER_RETRY_MAX_ATTEMPTS', 5)
+RETRY_DELAY = getattr(settings, 'NEWSLETTER_RETRY_DELAY', 300)
+
+TOKEN_LEGACY = getattr(settings, 'NEWSLETTER_TOKEN_LEGACY', True)
+TOKEN_CACHE_SIZE = getattr(settings, 'NEWSLETTER_TOKEN_CACHE_SIZE', 10000)
+TOKEN_CACHE_TTL = getattr(settings, 'NEWSLETTER_TOKEN_CACHE_TTL', 300)
+
+EVENT_SPOOL_DIR = getattr(settings, 'NEWSLETTER_EVENT_SPOOL_DIR', os.path.join(
+    tempfile.gettempdir(), 'dry_newsletter_events'))
+EVENT_FLUSH_INTERVAL = getattr(settings, 'NEWSLETTER_EVENT_FLUSH_INTERVAL', 5)
+EVENT_BATCH_SIZE = getattr(settings, 'NEWSLETTER_EVENT_BATCH_SIZE', 500)
@@ -0,0 +1,5 @@
+"""Signals for dry_newsletter.newsletter"""
+from django.dispatch import Signal
+
+# sent when ContactMailingStatus are written, one by one or in bulk
+statuses_created = Signal(providing_args=['statuses'])
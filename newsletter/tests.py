@@ -1,25 +1,104 @@
 """Unit tests for dry_newsletter.newsletter"""
+import os
+import shutil
+import socket
+import urllib2
+import time
+import email.charset
+from email.charset import Charset
+from email.charset import CHARSETS
+from hashlib import sha1
+from decimal import Decimal
 from datetime import datetime
 from datetime import timedelta
+from threading import Event
+from threading import Thread
+from threading import Lock
+from threading import current_thread
+from StringIO import StringIO
+from email.generator import Generator
 from tempfile import NamedTemporaryFile
+from tempfile import mkdtemp
 from smtplib import SMTP
+from smtplib import SMTPException
+from smtplib import SMTPServerDisconnected
+from smtplib import SMTPDataError
+from smtplib import SMTPRecipientsRefused
 
+from django.conf import settings
 from django.test import TestCase
 from django.http import Http404
 from django.db import IntegrityError
+from django.db import connections
+from django.db import DEFAULT_DB_ALIAS
 from django.core.files import File
 from django.utils.encoding import smart_str
+from django.utils.http import int_to_base36
 from django.utils.timezone import utc
 from django.contrib.admin.sites import AdminSite
-
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.utils import simplejson
+from django.template import Context
+from django.template import Template
+
+from dry_newsletter.newsletter import models
+from dry_newsletter.newsletter import managers
 from dry_newsletter.newsletter.mailer import Mailer
+from dry_newsletter.newsletter.mailer import SMTPMailer
+from dry_newsletter.newsletter.mailer import AsyncSMTPMailer
+from dry_newsletter.newsletter.mailer import NewsLetterExpedition
 from dry_newsletter.newsletter.models import Contact
 from dry_newsletter.newsletter.models import MailingList
 from dry_newsletter.newsletter.models import SMTPServer
 from dry_newsletter.newsletter.models import Newsletter
 from dry_newsletter.newsletter.models import ContactMailingStatus
+from dry_newsletter.newsletter.models import SMTPServerUsage
+from dry_newsletter.newsletter.models import SentBitmap
+from dry_newsletter.newsletter.models import MailingRetry
+from dry_newsletter.newsletter.models import Link
+from dry_newsletter.newsletter.models import StatusCount
 from dry_newsletter.newsletter.utils.tokens import tokenize
 from dry_newsletter.newsletter.utils.tokens import untokenize
+from dry_newsletter.newsletter.utils.events import EventBuffer
+from dry_newsletter.newsletter.utils.events import encode_event
+from dry_newsletter.newsletter.utils.events import event_buffer
+from dry_newsletter.newsletter.utils.links import link_table
+from dry_newsletter.newsletter.utils.statistics import get_newsletter_statistics
+from dry_newsletter.newsletter.utils.statistics import get_newsletter_top_links
+from dry_newsletter.newsletter.views import newsletter as newsletter_views
+from dry_newsletter.newsletter.views.newsletter import view_newsletter_tracking_link
+from dry_newsletter.newsletter.utils.tokens import contact_cache
+from dry_newsletter.newsletter.utils.tokens import ContactCache
+from dry_newsletter.newsletter.utils.pool import SMTPConnectionPool
+from dry_newsletter.newsletter.utils.pool import get_pool
+from dry_newsletter.newsletter.utils.pool import _pools
+from dry_newsletter.newsletter.utils.pacing import Pacer
+from dry_newsletter.newsletter.utils.balancer import ServerBalancer
+from dry_newsletter.newsletter.utils.balancer import NoServerAvailable
+from dry_newsletter.newsletter.utils.retries import is_transient
+from dry_newsletter.newsletter.settings import RETRY_DELAY
+from dry_newsletter.newsletter.settings import RETRY_MAX_ATTEMPTS
+from dry_newsletter.newsletter.utils.wakeup import WakeupListener
+from dry_newsletter.newsletter.utils.wakeup import notify
+from dry_newsletter.newsletter.utils.stats import Stats
+from dry_newsletter.newsletter.utils.stats import stats
+from dry_newsletter.newsletter.utils.metrics import MetricsServer
+from dry_newsletter.newsletter.utils.metrics import exposition
+from dry_newsletter.newsletter.utils.bitmap import Bitmap
+from dry_newsletter.newsletter.utils.attachments import AttachmentCache
+from dry_newsletter.newsletter.utils.attachments import build_attachment
+from dry_newsletter.newsletter.utils.attachments import encode_attachment
+from dry_newsletter.newsletter.utils.sink import SMTPSink
+from dry_newsletter.newsletter.utils.asyncsmtp import AsyncSMTPSession
+from dry_newsletter.newsletter.management.commands.send_newsletter import split_credits
+from dry_newsletter.newsletter.management.commands.send_newsletter import server_queues
+from dry_newsletter.newsletter.management.commands.send_newsletter import Command as SendNewsletterCommand
+from dry_newsletter.newsletter.utils.pipeline import RenderPipeline
+from dry_newsletter.newsletter.utils.render import RenderPlan
+from dry_newsletter.newsletter.utils.render import html2text
+from dry_newsletter.newsletter.utils.statuses import StatusWriter
 from dry_newsletter.newsletter.models import ContactMailingStatus
 
 # TEST ALBERTO
@@ -161,6 +240,134 @@ class FakeSMTP(object):
         pass
 
 
+class FakePoolSMTP(FakeSMTP):
+    connections = 0
+    disconnect = False
+    alive = True
+
+    def __init__(self):
+        FakePoolSMTP.connections += 1
+        self.closed = False
+
+    def sendmail(self, *ka, **kw):
+        if FakePoolSMTP.disconnect:
+            FakePoolSMTP.disconnect = False
+            raise SMTPServerDisconnected()
+        return super(FakePoolSMTP, self).sendmail(*ka, **kw)
+
+    def noop(self):
+        return (self.alive and 250 or 421, '')
+
+    def quit(self):
+        self.closed = True
+
+    def close(self):
+        self.closed = True
+
+
+class FakePoolServer(object):
+    pk = None
+
+    def connect(self):
+        return FakePoolSMTP()
+
+
+class FakeSettingsServer(FakePoolServer):
+    pk = -1
+    port = 25
+    user = 'user'
+    tls = False
+
+    def __init__(self, host='smtp.example.com', password='secret'):
+        self.host = host
+        self.password = password
+
+
+class SMTPConnectionPoolTestCase(TestCase):
+    """Tests for the SMTPConnectionPool"""
+
+    def setUp(self):
+        FakePoolSMTP.connections = 0
+        FakePoolSMTP.disconnect = False
+        self.pool = SMTPConnectionPool(FakePoolServer(), size=2,
+                                       max_messages=3, max_age=0,
+                                       noop_interval=30)
+
+    def test_reuse(self):
+        connection = self.pool.acquire()
+        connection.sendmail('from', 'to', 'message')
+        connection.quit()
+        connection.quit()
+        self.assertEquals(self.pool.in_use, 0)
+        self.assertEquals(self.pool.acquire(), connection)
+        self.assertEquals(FakePoolSMTP.connections, 1)
+
+    def test_size(self):
+        connection_1 = self.pool.acquire()
+        connection_2 = self.pool.acquire()
+        self.assertNotEquals(connection_1, connection_2)
+        self.assertEquals(self.pool.in_use, 2)
+        connection_1.quit()
+        connection_2.quit()
+        self.assertEquals(len(self.pool.idle), 2)
+        self.pool.close()
+        self.assertEquals(self.pool.idle, [])
+        self.assertTrue(connection_1.smtp is None)
+
+    def test_timeout(self):
+        self.pool.timeout = 0.1
+        connection = self.pool.acquire()
+        self.pool.acquire()
+        start = time.time()
+        self.assertRaises(SMTPException, self.pool.acquire)
+        self.assertTrue(0.1 <= time.time() - start < 1)
+        self.assertEquals(self.pool.in_use, 2)
+        connection.quit()
+        self.assertEquals(self.pool.acquire(), connection)
+
+    def test_recycling(self):
+        connection = self.pool.acquire()
+        for i in range(3):
+            connection.sendmail('from', 'to', 'message')
+        smtp = connection.smtp
+        connection.quit()
+        self.assertTrue(smtp.closed)
+        self.assertEquals(self.pool.idle, [])
+        self.pool.acquire()
+        self.assertEquals(FakePoolSMTP.connections, 2)
+
+    def test_health_check(self):
+        connection = self.pool.acquire()
+        connection.quit()
+        connection.smtp.alive = False
+        connection.last_used -= 60
+        self.pool.acquire()
+        self.assertEquals(FakePoolSMTP.connections, 2)
+
+    def test_reconnect(self):
+        connection = self.pool.acquire()
+        FakePoolSMTP.disconnect = True
+        connection.sendmail('from', 'to', 'message')
+        self.assertEquals(connection.smtp.mails_sent, 1)
+        self.assertEquals(FakePoolSMTP.connections, 2)
+
+    def test_get_pool(self):
+        pool = get_pool(FakeSettingsServer())
+        try:
+            pool.acquire().quit()
+            self.assertEquals(get_pool(FakeSettingsServer()), pool)
+            self.assertEquals(len(pool.idle), 1)
+            self.assertEquals(get_pool(FakeSettingsServer(password='new')), pool)
+            self.assertEquals(pool.idle, [])
+            self.assertEquals(pool.server.password, 'new')
+            pool.acquire().quit()
+            self.assertEquals(get_pool(FakeSettingsServer(host='new')), pool)
+            self.assertEquals(pool.idle, [])
+            self.assertEquals(FakePoolSMTP.connections, 2)
+        finally:
+            del _pools[FakeSettingsServer.pk]
+
+
 class SMTPServerTestCase(TestCase):
     """Tests for the SMTPServer model"""
 
@@ -220,12 +427,342 @@ class SMTPServerTestCase(TestCase):
                                             status=ContactMailingStatus.SENT)
         self.assertEquals(self.server.credits(), 39)
 
+    def test_credits_window(self):
+        self.server.mails_hour = 42
+        now = datetime.utcnow().replace(tzinfo=utc)
+        SMTPServerUsage.objects.record(self.server.pk, 5,
+                                       now - timedelta(minutes=90))
+        SMTPServerUsage.objects.record(self.server.pk, 3,
+                                       now - timedelta(minutes=30))
+        SMTPServerUsage.objects.record(self.server.pk, 2,
+                                       now - timedelta(minutes=30))
+        self.assertEquals(self.server.credits(), 37)
+        SMTPServerUsage.objects.record(self.server.pk, 1, now)
+        self.assertEquals(self.server.credits(), 36)
+        # the buckets out of the window are dropped
+        self.assertEquals(SMTPServerUsage.objects.filter(
+            server=self.server).count(), 2)
+
+        # the minute an hour ago is in the window
+        SMTPServerUsage.objects.record(self.server.pk, 4,
+                                       now - timedelta(hours=1))
+        self.assertEquals(self.server.credits(), 32)
+
     def test_custom_headers(self):
         self.assertEquals(self.server.custom_headers, {})
         self.server.headers = 'key_1: val_1\r\nkey_2   :   val_2'
         self.assertEquals(len(self.server.custom_headers), 2)
 
 
+class FakeBalancerPool(object):
+
+    def __init__(self, smtp_class):
+        self.smtp_class = smtp_class
+
+    def acquire(self):
+        return self.smtp_class()
+
+
+class FailingSMTP(FakeSMTP):
+
+    def sendmail(self, *ka, **kw):
+        raise SMTPServerDisconnected()
+
+    def close(self):
+        pass
+
+
+class TransientSMTP(FakeSMTP):
+    """Refuse temporarily the messages to the failing recipients"""
+    failing = ()
+
+    def sendmail(self, sender, recipient, message):
+        if recipient in self.failing:
+            raise SMTPDataError(451, 'Try again later')
+        return super(TransientSMTP, self).sendmail(sender, recipient, message)
+
+
+class RefusingSMTP(FakeSMTP):
+    """Refuse every message for good"""
+
+    def sendmail(self, *ka, **kw):
+        raise SMTPDataError(554, 'Message rejected')
+
+
+class ServerBalancerTestCase(TestCase):
+    """Tests for the ServerBalancer object"""
+
+    def setUp(self):
+        self.servers = [SMTPServer.objects.create(name='SMTP %s' % i,
+                                                  host='smtp.domain.com',
+                                                  mails_hour=100)
+                        for i in range(2)]
+        self.servers[0].connection_pool = lambda: FakeBalancerPool(FakeSMTP)
+        self.servers[1].connection_pool = lambda: FakeBalancerPool(FailingSMTP)
+
+    def test_credits(self):
+        balancer = ServerBalancer(self.servers, share=0.5)
+        self.assertEquals(balancer.credits(), 100)
+        first, second = balancer.states
+        first.credits = 0
+        self.assertEquals(balancer.choose(), second)
+        self.assertEquals(balancer.choose(exclude=[second]), None)
+        second.credits = 0
+        self.assertEquals(balancer.choose(), None)
+        self.assertEquals(balancer.wait_time(), None)
+
+    def test_failures(self):
+        balancer = ServerBalancer(self.servers, threshold=2, cooldown=0.2)
+        first, second = balancer.states
+        for i in range(20):
+            self.assertEquals(balancer.sendmail(('from', 'to', 'message')),
+                              self.servers[0])
+        self.assertEquals(first.credits, 80)
+        self.assertEquals(second.credits, 100)
+        self.assertTrue(first.latency is not None)
+        # put aside after two failures in a row
+        self.assertTrue(second.open_until > time.time())
+        self.assertEquals(balancer.wait_time(), 0)
+
+        # waits for the server put aside to try it again
+        first.credits = 0
+        self.assertTrue(0 < balancer.wait_time() <= 0.2)
+        self.assertRaises(SMTPServerDisconnected, balancer.sendmail,
+                          ('from', 'to', 'message'))
+        balancer.close()
+
+    def test_permanent_errors(self):
+        balancer = ServerBalancer(self.servers, threshold=1, cooldown=60)
+        first, second = balancer.states
+        second.credits = 0
+
+        class ClosingTransientSMTP(TransientSMTP):
+            failing = ['to']
+
+            def close(self):
+                pass
+
+        first.smtp = ClosingTransientSMTP()
+        # a temporary refusal puts the server aside
+        self.assertRaises(SMTPDataError, balancer.sendmail,
+                          ('from', 'to', 'message'))
+        self.assertTrue(first.open_until > time.time())
+
+        # a message refused for good does not
+        first.open_until = 0
+        first.smtp = RefusingSMTP()
+        self.assertRaises(SMTPDataError, balancer.sendmail,
+                          ('from', 'to', 'message'))
+        self.assertEquals(first.open_until, 0)
+        self.assertEquals(first.failures, 0)
+        self.assertTrue(isinstance(first.smtp, RefusingSMTP))
+
+    def test_stop(self):
+        stop_event = Event()
+        balancer = ServerBalancer(self.servers, threshold=1, cooldown=60,
+                                  stop_event=stop_event)
+        for state in balancer.states:
+            state.open_until = time.time() + 60
+        Thread(target=lambda: time.sleep(0.1) or stop_event.set()).start()
+        start = time.time()
+        self.assertRaises(NoServerAvailable, balancer.sendmail,
+                          ('from', 'to', 'message'))
+        self.assertTrue(time.time() - start < 5)
+
+
+class BitmapTestCase(TestCase):
+    """Tests for the Bitmap object"""
+
+    def test_bitmap(self):
+        bitmap = Bitmap([1, 8, 1000])
+        bitmap.add(9)
+        self.assertTrue(8 in bitmap)
+        self.assertTrue(1000 in bitmap)
+        self.assertFalse(0 in bitmap)
+        self.assertFalse(100000 in bitmap)
+        self.assertEquals(len(bitmap), 4)
+
+        bitmap = Bitmap.loads(bitmap.dumps())
+        self.assertEquals([i for i in range(1010) if i in bitmap],
+                          [1, 8, 9, 1000])
+        self.assertEquals(len(Bitmap.loads('')), 0)
+        self.assertFalse(Bitmap.loads(''))
+        self.assertTrue(bitmap)
+
+        bitmap.merge(Bitmap([2, 2000]))
+        bitmap.merge(Bitmap())
+        self.assertEquals([i for i in range(2010) if i in bitmap],
+                          [1, 2, 8, 9, 1000, 2000])
+
+
+class AttachmentCacheTestCase(TestCase):
+    """Tests for the encoding and the cache of the attachments"""
+
+    def setUp(self):
+        self.files = []
+        for suffix, content in (('.png', os.urandom(3000)),
+                                ('.bin', os.urandom(2 * 1024 * 1024) + '\n'),
+                                ('.txt', 'From the team\nhello\n'),
+                                ('.pdf', '')):
+            attachment = NamedTemporaryFile(suffix=suffix)
+            attachment.write(content)
+            attachment.flush()
+            self.files.append(attachment)
+
+    def tearDown(self):
+        for attachment in self.files:
+            attachment.close()
+
+    def test_encode_attachment(self):
+        for attachment in self.files:
+            expected = StringIO()
+            Generator(expected).flatten(build_attachment(attachment.name,
+                                                         'File'))
+            self.assertEquals(encode_attachment(attachment.name, 'File'),
+                              expected.getvalue())
+
+    def test_cache(self):
+        png, binary = self.files[0].name, self.files[1].name
+        cache = AttachmentCache(max_size=10000)
+        part = cache.get(png, 'Image')
+        self.assertTrue(cache.get(png, 'Image') is part)
+        self.assertEquals(cache.size, len(part))
+
+        # too large to be kept
+        cache.get(binary, 'Binary')
+        self.assertEquals(len(cache.parts), 1)
+
+        cache.max_size = len(part) * 2 + 100
+        cache.get(png, 'Other title')
+        cache.get(png, 'Image')
+        cache.get(self.files[2].name, 'Text')
+        self.assertEquals(len(cache.parts), 2)
+        self.assertTrue(cache.get(png, 'Image') is part)
+
+
+class StatsTestCase(TestCase):
+    """Tests for the Stats object"""
+
+    def test_disabled(self):
+        timings = Stats()
+        with timings.timer('render'):
+            pass
+        timings.record('sendmail', 1)
+        self.assertEquals(timings.histograms, {})
+
+    def test_histograms(self):
+        timings = Stats()
+        timings.enable()
+        for i in range(98):
+            timings.record('sendmail', 0.001)
+        timings.record('sendmail', 0.5)
+        timings.record('sendmail', 2)
+        with timings.timer('render'):
+            pass
+
+        histogram = timings.histograms['sendmail']
+        self.assertEquals(histogram.count, 100)
+        self.assertEquals(histogram.max, 2)
+        self.assertTrue(0.001 <= histogram.percentile(0.5) < 0.002)
+        self.assertTrue(0.5 <= histogram.percentile(0.99) < 1)
+        report = timings.report().splitlines()
+        self.assertEquals(len(report), 3)
+        self.assertTrue(report[2].startswith('sendmail'))
+
+
+class WakeupTestCase(TestCase):
+    """Tests for the wake-up of the mailers"""
+
+    def test_notify(self):
+        listener = WakeupListener(('127.0.0.1', 0))
+        first, second = Event(), Event()
+        listener.register(1, first)
+        listener.register(2, second)
+        try:
+            notify(1, listener.address)
+            self.assertTrue(first.wait(2))
+            self.assertFalse(second.is_set())
+
+            first.clear()
+            notify(None, listener.address)
+            self.assertTrue(first.wait(2))
+            self.assertTrue(second.wait(2))
+
+            first.clear()
+            listener.unregister(1, first)
+            notify(1, listener.address)
+            notify(2, listener.address)
+            self.assertTrue(second.wait(2))
+            self.assertFalse(first.is_set())
+        finally:
+            listener.close()
+
+    def test_newsletter_save(self):
+        servers = []
+        notify = models.notify
+        models.notify = servers.append
+        try:
+            server = SMTPServer.objects.create(name='Test SMTP',
+                                               host='smtp.domain.com')
+            newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                   slug='test-newsletter',
+                                                   server=server)
+            self.assertEquals(servers, [])
+            newsletter.status = Newsletter.WAITING
+            newsletter.save()
+            self.assertEquals(servers, [server.pk])
+
+            # the counters of a sending do not wake up the mailers
+            newsletter.save()
+            newsletter = Newsletter.objects.get(pk=newsletter.pk)
+            newsletter.save()
+            self.assertEquals(servers, [server.pk])
+
+            newsletter.sending_date += timedelta(hours=1)
+            newsletter.save()
+            newsletter.status = Newsletter.SENDING
+            newsletter.save()
+            newsletter.status = Newsletter.SENT
+            newsletter.save()
+            self.assertEquals(servers, [server.pk] * 3)
+        finally:
+            models.notify = notify
+
+
+class PacerTestCase(TestCase):
+    """Tests for the Pacer object"""
+
+    def test_burst(self):
+        pacer = Pacer(1.0, burst=3)
+        for i in range(3):
+            self.assertEquals(pacer.wait_time(100.0), 0)
+            pacer.consume(100.0)
+        self.assertEquals(pacer.wait_time(100.0), 1.0)
+        self.assertEquals(pacer.wait_time(100.5), 0.5)
+        self.assertEquals(pacer.wait_time(101.0), 0)
+
+    def test_sustained_rate(self):
+        # the round-trips of the sendings do not slow down the pace
+        pacer = Pacer(3600.0 / 1000)
+        now = 0.0
+        for i in range(1000):
+            now += pacer.wait_time(now)
+            pacer.consume(now)
+            now += 0.4 + (i % 7) * 0.3
+        self.assertTrue(3600 * 0.97 < now < 3600 * 1.03)
+
+    def test_server_pacer(self):
+        server = SMTPServer.objects.create(name='Test SMTP',
+                                           host='smtp.domain.com',
+                                           mails_hour=3600)
+        pacer = server.pacer()
+        self.assertEquals(pacer.interval, 1.0)
+        self.assertTrue(server.pacer() is pacer)
+        server.mails_hour = 7200
+        self.assertTrue(server.pacer() is pacer)
+        self.assertEquals(pacer.interval, 0.5)
+
+
 class ContactTestCase(TestCase):
     """Tests for the Contact model"""
 
@@ -321,17 +858,449 @@ class NewsletterTestCase(TestCase):
         self.assertEquals(self.newsletter.mails_sent(), 1)
 
 
+    def test_expedition_set(self):
+        contacts = [Contact.objects.create(email='test%s@domain.com' % i)
+                    for i in range(4)]
+        contacts[3].valid = False
+        contacts[3].save()
+        mailinglist_2 = MailingList.objects.create(name='Test MailingList 2')
+        self.newsletter.mailing_lists.add(mailinglist_2)
+        MailingList.objects.create(name='Other').subscribers.add(self.contact)
+
+        self.assertEquals(Contact.objects.expedition_set(self.newsletter).count(), 0)
+        self.mailinglist.subscribers.add(self.contact, *contacts)
+        mailinglist_2.subscribers.add(contacts[0], contacts[1])
+        self.mailinglist.unsubscribers.add(contacts[0], contacts[2])
+        mailinglist_2.unsubscribers.add(contacts[1])
+
+        expedition_set = Contact.objects.expedition_set(self.newsletter)
+        self.assertEquals(expedition_set.count(), 3)
+        self.assertEquals(set(expedition_set),
+                          set([self.contact, contacts[0], contacts[1]]))
+
+
+class StatusWriterTestCase(TestCase):
+    """Tests for the StatusWriter object"""
+
+    def setUp(self):
+        self.server = SMTPServer.objects.create(name='Test SMTP',
+                                                host='smtp.domain.com')
+        self.contacts = [Contact.objects.create(email='test%s@domain.com' % i)
+                         for i in range(3)]
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    server=self.server,
+                                                    slug='test-newsletter')
+
+    def test_flush(self):
+        writer = StatusWriter(size=2, interval=60)
+        statuses = ContactMailingStatus.objects.filter(newsletter=self.newsletter)
+
+        writer.add(self.newsletter, self.contacts[0], ContactMailingStatus.SENT)
+        self.assertEquals(statuses.count(), 0)
+        writer.add(self.newsletter, self.contacts[1], ContactMailingStatus.INVALID)
+        self.assertEquals(statuses.count(), 2)
+        self.assertFalse(Contact.objects.get(pk=self.contacts[1].pk).valid)
+        self.assertTrue(Contact.objects.get(pk=self.contacts[0].pk).valid)
+
+        writer.add(self.newsletter, self.contacts[2], ContactMailingStatus.ERROR)
+        self.assertEquals(statuses.count(), 2)
+        writer.flush()
+        self.assertEquals(statuses.count(), 3)
+        writer.flush()
+        self.assertEquals(statuses.count(), 3)
+        self.assertEquals(SMTPServerUsage.objects.sent_last_hour(self.server), 1)
+
+    def test_interval(self):
+        writer = StatusWriter(size=100, interval=0)
+        writer.add(self.newsletter, self.contacts[0], ContactMailingStatus.SENT)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            newsletter=self.newsletter).count(), 1)
+
+
+class EventBufferTestCase(TestCase):
+    """Tests for the EventBuffer object"""
+
+    def setUp(self):
+        self.spool_dir = mkdtemp()
+        self.contact = Contact.objects.create(email='test@domain.com')
+        self.server = SMTPServer.objects.create(name='Test SMTP',
+                                                host='smtp.domain.com')
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    slug='test-newsletter',
+                                                    server=self.server)
+
+    def tearDown(self):
+        shutil.rmtree(self.spool_dir)
+
+    def test_flush(self):
+        events = EventBuffer(self.spool_dir, interval=3600, batch_size=100)
+        for i in range(3):
+            events.add(self.newsletter, self.contact,
+                       ContactMailingStatus.OPENED)
+        opened = datetime.utcnow().replace(tzinfo=utc)
+        self.assertEquals(ContactMailingStatus.objects.count(), 0)
+        self.assertEquals(len(open(events.path()).readlines()), 3)
+
+        time.sleep(0.01)
+        self.assertEquals(events.flush(), 3)
+        statuses = ContactMailingStatus.objects.filter(
+            newsletter=self.newsletter, contact=self.contact,
+            status=ContactMailingStatus.OPENED)
+        self.assertEquals(statuses.count(), 3)
+        for status in statuses:
+            self.assertTrue(status.creation_date <= opened)
+        self.assertEquals(os.listdir(self.spool_dir), [])
+        self.assertEquals(events.flush(), 0)
+
+    def test_close(self):
+        events = EventBuffer(self.spool_dir, interval=3600, batch_size=100)
+        events.add(self.newsletter, self.contact, ContactMailingStatus.OPENED)
+        self.assertTrue(events.registered)
+
+        # a forked process leaves the events of its parent
+        pid, events.pid = events.pid, -1
+        events.close()
+        self.assertEquals(ContactMailingStatus.objects.count(), 0)
+        events.pid = pid
+        events.close()
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.OPENED).count(), 1)
+
+    def test_unbuffered(self):
+        events = EventBuffer(None)
+        events.add(self.newsletter, self.contact,
+                   ContactMailingStatus.UNSUBSCRIPTION)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.UNSUBSCRIPTION).count(), 1)
+
+    def test_drain(self):
+        # the spool of a process killed while writing an event
+        line = encode_event(self.newsletter.pk, self.contact.pk,
+                            ContactMailingStatus.OPENED,
+                            datetime.utcnow().replace(tzinfo=utc), {})
+        path = os.path.join(self.spool_dir, 'events-%s.spool' % 2 ** 22)
+        spool = open(path, 'w')
+        spool.write(line + line[:10])
+        spool.close()
+        open(os.path.join(self.spool_dir, 'events-%s.spool' % os.getpid()),
+             'w').write(line)
+
+        call_command('drain_newsletter_events', spool_dir=self.spool_dir,
+                     verbosity=0)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.OPENED).count(), 1)
+        self.assertEquals(os.listdir(self.spool_dir),
+                          ['events-%s.spool' % os.getpid()])
+
+
 class TokenizationTestCase(TestCase):
     """Tests for the tokenization process"""
 
     def setUp(self):
         self.contact = Contact.objects.create(email='test@domain.com')
+        contact_cache.clear()
 
     def test_tokenize_untokenize(self):
         uidb36, token = tokenize(self.contact)
         self.assertEquals(untokenize(uidb36, token), self.contact)
         self.assertRaises(Http404, untokenize, 'toto', token)
         self.assertRaises(Http404, untokenize, uidb36, 'toto')
+        # the keyed state is shared, not the tokens
+        other = Contact.objects.create(email='other@domain.com')
+        self.assertNotEquals(tokenize(other)[1], token)
+
+    def test_legacy_token(self):
+        token = sha1(settings.SECRET_KEY + unicode(self.contact.id) +
+                     self.contact.email).hexdigest()[::2]
+        self.assertNotEquals(tokenize(self.contact)[1], token)
+        self.assertEquals(untokenize(tokenize(self.contact)[0], token),
+                          self.contact)
+
+    def test_cache(self):
+        uidb36, token = tokenize(self.contact)
+        untokenize(uidb36, token)
+        with self.assertNumQueries(0):
+            contact = untokenize(uidb36, token)
+            self.assertEquals(contact, self.contact)
+            self.assertRaises(Http404, untokenize, uidb36, 'toto')
+
+        # the token of the old email is refused once the contact changed
+        self.contact.email = 'changed@domain.com'
+        self.contact.save()
+        self.assertRaises(Http404, untokenize, uidb36, token)
+        self.assertEquals(untokenize(*tokenize(self.contact)).email,
+                          'changed@domain.com')
+
+        cache = ContactCache(size=1, ttl=0)
+        cache.set(self.contact)
+        self.assertEquals(cache.get(self.contact.pk), None)
+
+
+class TrackingTestCase(TestCase):
+    """Tests for the tracking image"""
+    urls = 'dry_newsletter.newsletter.urls'
+
+    def setUp(self):
+        self.contact = Contact.objects.create(email='test@domain.com')
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    slug='test-newsletter')
+        self.spool_dir = event_buffer.spool_dir
+        event_buffer.spool_dir = None
+        newsletter_views._tracked_newsletters.clear()
+
+    def tearDown(self):
+        event_buffer.spool_dir = self.spool_dir
+
+    def tracking_url(self, uidb36, token, slug='test-newsletter'):
+        return reverse('newsletter_newsletter_tracking',
+                       kwargs={'slug': slug, 'uidb36': uidb36, 'token': token})
+
+    def test_tracking_image(self):
+        response = self.client.get(self.tracking_url(*tokenize(self.contact)))
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(response.content, newsletter_views.TRACKING_IMAGE_DATA)
+        self.assertEquals(response['Content-Type'], 'image/jpeg')
+        self.assertEquals(int(response['Content-Length']), len(response.content))
+        self.assertTrue('no-store' in response['Cache-Control'])
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            newsletter=self.newsletter, contact=self.contact,
+            status=ContactMailingStatus.OPENED).count(), 1)
+
+        # the newsletter and the contact are known now, only the status
+        # and its count are written
+        with self.assertNumQueries(2):
+            self.client.get(self.tracking_url(*tokenize(self.contact)))
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.OPENED).count(), 2)
+
+    def test_tracking_image_invalid(self):
+        uidb36, token = tokenize(self.contact)
+        for url in (self.tracking_url(uidb36, 'abc123'),
+                    self.tracking_url(uidb36, token, slug='unknown')):
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            self.assertEquals(response.content, newsletter_views.TRACKING_IMAGE_DATA)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.OPENED).count(), 0)
+
+    def test_tracking_link(self):
+        link_table.clear()
+        link = Link.objects.create(newsletter=self.newsletter,
+                                   url='http://example.com/?a=1&b=2')
+        uidb36, token = tokenize(self.contact)
+        url = reverse('newsletter_newsletter_tracking_link', kwargs={
+            'slug': 'test-newsletter', 'uidb36': uidb36, 'token': token,
+            'link_id': int_to_base36(link.pk)})
+        response = self.client.get(url)
+        self.assertEquals(response.status_code, 302)
+        self.assertEquals(response['Location'], link.url)
+        self.assertEquals(ContactMailingStatus.objects.get(
+            status=ContactMailingStatus.LINK_OPENED).link, link)
+
+        # the link table does not read the statuses, the status and the
+        # counts of the status and of the link are written
+        with self.assertNumQueries(3):
+            self.client.get(url)
+
+        response = self.client.get(url.replace(token, 'abc123'))
+        self.assertEquals(response['Location'], link.url)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.LINK_OPENED).count(), 2)
+        # an unknown link does not reload a table loaded recently
+        with self.assertNumQueries(0):
+            for i in range(3):
+                self.assertRaises(Http404, view_newsletter_tracking_link, None,
+                                  'test-newsletter', uidb36, token,
+                                  int_to_base36(link.pk + 1))
+        other = Link.objects.create(newsletter=self.newsletter,
+                                    url='http://example.com/other')
+        self.assertEquals(link_table.url(self.newsletter.pk, other.pk), None)
+        link_table.tables[self.newsletter.pk] = (
+            link_table.tables[self.newsletter.pk][0], 0)
+        self.assertEquals(link_table.url(self.newsletter.pk, other.pk),
+                          other.url)
+
+
+class StatisticsTestCase(TestCase):
+    """Tests for the statistics rollups"""
+    urls = 'dry_newsletter.newsletter.urls'
+
+    def setUp(self):
+        self.contacts = [Contact.objects.create(email='test%s@domain.com' % i)
+                         for i in range(3)]
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    slug='test-newsletter')
+        self.link = Link.objects.create(newsletter=self.newsletter,
+                                        url='http://example.com/')
+        StatusWriter().write([ContactMailingStatus(
+            newsletter=self.newsletter, contact=contact,
+            status=ContactMailingStatus.SENT) for contact in self.contacts], set())
+        ContactMailingStatus.objects.create(
+            newsletter=self.newsletter, contact=self.contacts[0],
+            status=ContactMailingStatus.OPENED)
+        for contact in self.contacts[:2]:
+            ContactMailingStatus.objects.create(
+                newsletter=self.newsletter, contact=contact,
+                status=ContactMailingStatus.LINK_OPENED, link=self.link)
+
+    def test_status_counts(self):
+        self.assertEquals(StatusCount.objects.totals(self.newsletter), {
+            ContactMailingStatus.SENT: 3, ContactMailingStatus.OPENED: 1,
+            ContactMailingStatus.LINK_OPENED: 2})
+        self.assertEquals(StatusCount.objects.get(
+            status=ContactMailingStatus.SENT).hour.minute, 0)
+        self.assertEquals(Link.objects.get(pk=self.link.pk).clicks, 2)
+
+    def test_rebuild(self):
+        totals = StatusCount.objects.totals(self.newsletter)
+        StatusCount.objects.all().delete()
+        Link.objects.update(clicks=0)
+        call_command('rebuild_newsletter_statistics', 'test-newsletter',
+                     verbosity=0)
+        self.assertEquals(StatusCount.objects.totals(self.newsletter), totals)
+        self.assertEquals(Link.objects.get(pk=self.link.pk).clicks, 2)
+
+    def test_statistics(self):
+        # only the rollups are read
+        ContactMailingStatus.objects.all().delete()
+        statistics = get_newsletter_statistics(self.newsletter)
+        self.assertEquals(statistics['mails_sent'], 3)
+        self.assertEquals(statistics['openings_percent'], 33.33)
+        self.assertEquals(statistics['clicked_links_percent'], 66.67)
+        self.assertEquals(get_newsletter_top_links(self.newsletter),
+                          [{'link': self.link, 'total_clicks': 2}])
+
+        User.objects.create_user('admin', 'admin@domain.com', 'password')
+        self.client.login(username='admin', password='password')
+        response = self.client.get(reverse('newsletter_newsletter_statistics',
+                                           args=['test-newsletter']))
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('http://example.com/' in response.content)
+
+        response = self.client.get(reverse('newsletter_newsletter_charts',
+                                           args=['test-newsletter']))
+        chart = simplejson.loads(response.content)
+        self.assertEquals([element['values'] for element in chart['elements']],
+                          [[1], [0], [2], [0]])
+        self.assertEquals(chart['y_axis']['grid-colour'], '#ededed')
+
+        response = self.client.get(reverse('newsletter_newsletter_density',
+                                           args=['test-newsletter']))
+        self.assertEquals(response.status_code, 200)
+        self.assertTrue('top_links_score["http://example.com/"] = "2"'
+                        in response.content)
+
+
+class RenderPlanTestCase(TestCase):
+    """Tests for the RenderPlan object"""
+
+    def setUp(self):
+        self.contact = Contact.objects.create(email='test@domain.com',
+                                              first_name='Toto <&>',
+                                              last_name='Titi')
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    article_1_title='Title',
+                                                    article_1_text='<b>Content</b>',
+                                                    slug='test-newsletter')
+
+    def render(self, template_string, plan=True):
+        template = Template(template_string)
+        uidb36, token = tokenize(self.contact)
+        context = {'newsletter': self.newsletter, 'domain': 'domain.com'}
+        render_plan = RenderPlan(template, context)
+        if not plan:
+            return render_plan.usable
+        self.assertTrue(render_plan.usable)
+        values = {'contact': self.contact, 'uidb36': uidb36, 'token': token}
+        context.update(values)
+        html = template.render(Context(context))
+        self.assertEquals(render_plan.render(values), (html, html2text(html)))
+        return render_plan.render(values)
+
+    def test_newsletter_template(self):
+        self.newsletter.article_1_text = '<p>%s</p>' % ' '.join(['word'] * 40)
+        mailer = Mailer(self.newsletter)
+        self.assertTrue(mailer.render_plan.usable)
+        html, text = mailer.build_email_contents(self.contact)
+        self.assertEquals(html, mailer.build_email_content(self.contact))
+        self.assertEquals(text, html2text(html))
+        self.assertTrue('word word' in text)
+        uidb36, token = tokenize(self.contact)
+        tracking_url = reverse('newsletter_newsletter_tracking', kwargs={
+            'slug': self.newsletter.slug, 'uidb36': uidb36, 'token': token})
+        self.assertTrue(tracking_url in html)
+        self.assertFalse(tracking_url in text)
+
+    def test_links(self):
+        self.newsletter.article_1_text = ('<a href="http://example.com/?a=1&amp;b=2">'
+                                          'Example</a> <a href="mailto:a@b.com">Mail</a>')
+        mailer = Mailer(self.newsletter)
+        self.assertTrue(mailer.render_plan.usable)
+        html, text = mailer.build_email_contents(self.contact)
+        self.assertEquals(html, mailer.build_email_content(self.contact))
+        link = Link.objects.get(newsletter=self.newsletter,
+                                url='http://example.com/?a=1&b=2')
+        uidb36, token = tokenize(self.contact)
+        tracking_url = reverse('newsletter_newsletter_tracking_link', kwargs={
+            'slug': self.newsletter.slug, 'uidb36': uidb36, 'token': token,
+            'link_id': int_to_base36(link.pk)})
+        self.assertTrue(tracking_url in html)
+        self.assertTrue(tracking_url in text)
+        self.assertFalse('example.com/?a=1' in html)
+        self.assertTrue('mailto:a@b.com' in html)
+
+        # the links with the token are personal, the others saved once
+        contact = Contact.objects.create(email='other@domain.com')
+        links = Link.objects.count()
+        html, text = mailer.build_email_contents(contact)
+        self.assertEquals(Link.objects.count(), links)
+        self.assertTrue(tokenize(contact)[1] in html)
+        self.assertFalse(Link.objects.filter(url__contains=token).exists())
+
+    def test_slots(self):
+        html, text = self.render('{{ newsletter.title }} {{ contact.first_name }} '
+                                 '{{ contact.mail_format }} {{ contact }}')
+        self.assertEquals(text.strip(),
+                          u'Test Newsletter Toto <&> Titi Toto <&> <test@domain.com> '
+                          'Titi Toto <&>')
+        html, text = self.render('<a href="http://{{ domain }}{% url '
+                                 'newsletter_newsletter_contact slug=newsletter.slug,'
+                                 'uidb36=uidb36,token=token %}">{{ uidb36 }}</a>')
+        self.assertTrue(tokenize(self.contact)[1] in text)
+
+        # the text does not depend on the length of the values
+        self.contact.first_name = 'A  much\nlonger first name'
+        html, text = self.render('<p>%s {{ contact.first_name }} %s</p>' % (
+            ' '.join(['word'] * 15), ' '.join(['word'] * 15)))
+        self.assertTrue('word A much longer first name word' in text)
+
+    def test_markdown_escapes(self):
+        template = ('<p>{{ contact.first_name }}</p><p>Hi {{ contact.first_name }}</p>'
+                    '<p>{{ contact.last_name }}. item</p><pre>{{ contact.first_name }}</pre>'
+                    '<a href="http://{{ domain }}/{{ contact.first_name }}">link</a>')
+        for first_name, last_name in (('1. Toto', '12'), ('- Toto', ''),
+                                      ('+ Toto', '-'), ('a\\*b', '1')):
+            self.contact.first_name = first_name
+            self.contact.last_name = last_name
+            html, text = self.render(template)
+        self.assertTrue('Hi a\\\\*b' in text)
+        self.contact.first_name = '- Toto'
+        html, text = self.render(template)
+        self.assertTrue('\\- Toto\n' in text)
+        self.assertTrue('Hi - Toto' in text)
+
+    def test_fallback(self):
+        self.assertFalse(self.render('{% if contact.first_name %}Hi{% endif %}', False))
+        self.assertFalse(self.render('{{ contact.first_name|upper }}', False))
+        self.assertFalse(self.render('{% with name=contact.first_name %}'
+                                     '{{ name }}{% endwith %}', False))
+        self.assertFalse(self.render('{% for x in contact.subscriptions %}'
+                                     '{% endfor %}', False))
+        self.assertFalse(self.render('{% autoescape off %}{{ contact }}'
+                                     '{% endautoescape %}', False))
+        self.assertFalse(self.render('{% url newsletter_newsletter_contact '
+                                     'slug=newsletter.slug,uidb36=contact.email,'
+                                     'token=token %}', False))
 
 
 class MailerTestCase(TestCase):
@@ -380,6 +1349,218 @@ class MailerTestCase(TestCase):
         self.assertEquals(len(mailer.expedition_list), 2)
         self.assertFalse(self.contacts[0] in mailer.expedition_list)
 
+    def test_iter_expedition_list(self):
+        mailinglist = MailingList.objects.create(name='Test MailingList 2')
+        mailinglist.subscribers.add(*self.contacts[1:])
+        mailinglist.unsubscribers.add(self.contacts[0])
+        self.newsletter.mailing_lists.add(mailinglist)
+
+        mailer = Mailer(self.newsletter)
+        self.assertEquals(list(mailer.iter_expedition_list(chunk_size=3)),
+                          sorted(self.contacts, key=lambda c: c.pk))
+        self.assertEquals(mailer.expedition_count(), 4)
+
+        self.server.mails_hour = 3
+        self.assertEquals(len(list(mailer.iter_expedition_list(chunk_size=1))), 3)
+        self.assertEquals(mailer.expedition_count(), 3)
+
+    def test_message_skeleton(self):
+        self.server.headers = 'X-Campaign: \xe9t\xe9\r\nPrecedence: bulk'
+        self.newsletter.title = u'Newsletter d\xe9j\xe0 vue {{ contact.first_name }}'
+        self.newsletter.article_1_text = 'From the team\n\xe9t\xe9'
+        contact = Contact.objects.create(email='test5@domain.com',
+                                         first_name=u'J\xe9r\xf4me ' * 6,
+                                         last_name='Toto')
+        mailer = Mailer(self.newsletter)
+        skeleton = mailer.message_skeleton
+
+        utf8 = CHARSETS['utf-8']
+        try:
+            # 8bit bodies as registered by django.core.mail, or base64
+            for encodings in ((email.charset.SHORTEST, None),
+                              (email.charset.BASE64, email.charset.BASE64)):
+                CHARSETS['utf-8'] = encodings + ('utf-8',)
+                skeleton.charset = Charset('UTF-8')
+                message = mailer.build_message(contact)
+                message.set_boundary(skeleton.mixed)
+                message.get_payload(0).set_boundary(skeleton.alternative)
+                self.assertEquals(mailer.build_envelope(contact)[2],
+                                  message.as_string())
+                if encodings[1] is None:
+                    self.assertTrue('\n>From the team' in skeleton.render(
+                        'Title', 'test@domain.com', 'From the team', ''))
+        finally:
+            CHARSETS['utf-8'] = utf8
+
+        self.assertEquals(skeleton.render('Title', 'test@domain.com',
+                                          '--' + skeleton.mixed, ''), None)
+
+    def test_message_skeleton_attachments(self):
+        image = NamedTemporaryFile(suffix='.png')
+        image.write(os.urandom(1000))
+        image.flush()
+
+        mailer = Mailer(self.newsletter)
+        mailer.attachments = [encode_attachment(image.name, 'Image')]
+        skeleton = mailer.message_skeleton
+        message = mailer.build_message(self.contacts[0])
+        message.attach(build_attachment(image.name, 'Image'))
+        message.set_boundary(skeleton.mixed)
+        message.get_payload(0).set_boundary(skeleton.alternative)
+        self.assertEquals(mailer.build_envelope(self.contacts[0])[2],
+                          message.as_string())
+        image.close()
+
+    def test_sent_bitmap(self):
+        # statuses written before the bitmap existed
+        ContactMailingStatus.objects.bulk_create([ContactMailingStatus(
+            newsletter=self.newsletter, contact=self.contacts[0],
+            status=ContactMailingStatus.SENT)])
+        self.assertEquals(SentBitmap.objects.count(), 0)
+
+        # the count reads the bitmap, built from the statuses
+        mailer = Mailer(self.newsletter)
+        self.assertEquals(mailer.expedition_count(), 3)
+        self.assertEquals(SentBitmap.objects.count(), 1)
+
+        # the flushes only add rows, merged when the bitmap is read
+        mailer.update_contact_status(self.contacts[2], None)
+        mailer.status_writer.flush()
+        self.assertEquals(SentBitmap.objects.count(), 2)
+        mailer.update_contact_status(self.contacts[3], None)
+        with self.assertNumQueries(2):
+            SentBitmap.objects.add(self.newsletter.pk, [self.contacts[3].pk])
+        self.assertEquals(SentBitmap.objects.count(), 3)
+        self.assertEquals(list(mailer.iter_expedition_list()),
+                          [self.contacts[1]])
+        self.assertEquals(SentBitmap.objects.count(), 1)
+        mailer.status_writer.flush()
+        self.assertEquals(mailer.expedition_count(), 1)
+
+    def test_shards(self):
+        self.assertEquals(split_credits(10, 3), [4, 3, 3])
+        self.assertEquals(split_credits(-2, 2), [0, 0])
+
+        mailers = [Mailer(self.newsletter, shard=(index, 3), credits=credits)
+                   for index, credits in enumerate([2, 1, 0])]
+        for index, mailer in enumerate(mailers):
+            shard = [contact for contact in self.contacts
+                     if contact.pk % 3 == index]
+            self.assertEquals(list(mailer.iter_expedition_list()),
+                              shard[:mailer.budget])
+        self.assertFalse(mailers[2].can_send)
+
+        for mailer in mailers:
+            mailer.smtp = FakeSMTP()
+            mailer.run()
+        # a second run of the shards sends the contacts left
+        for index in range(3):
+            mailer = Mailer(self.newsletter, shard=(index, 3), credits=10)
+            mailer.smtp = FakeSMTP()
+            mailer.run()
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 4)
+        self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                          Newsletter.SENT)
+
+    def test_server_queues(self):
+        server = SMTPServer.objects.create(name='Other SMTP',
+                                           host='smtp.domain.com')
+        other = Newsletter.objects.create(title='Other', slug='other',
+                                          server=server)
+        last = Newsletter.objects.create(title='Last', slug='last',
+                                         server=self.server)
+        self.assertEquals(server_queues([self.newsletter, other, last]),
+                          [[self.newsletter, last], [other]])
+
+    def test_is_transient(self):
+        self.assertTrue(is_transient(SMTPDataError(451, 'Try again')))
+        self.assertTrue(is_transient(SMTPServerDisconnected()))
+        self.assertTrue(is_transient(socket.timeout()))
+        self.assertTrue(is_transient(SMTPRecipientsRefused(
+            {'test1@domain.com': (450, 'Greylisted')})))
+        self.assertFalse(is_transient(SMTPRecipientsRefused(
+            {'test1@domain.com': (550, 'Unknown user')})))
+        self.assertFalse(is_transient(SMTPDataError(554, 'Rejected')))
+        self.assertFalse(is_transient(UnicodeError()))
+
+    def test_retries(self):
+        mailer = Mailer(self.newsletter)
+        smtp = mailer.smtp = TransientSMTP()
+        smtp.failing = [self.contacts[1].email]
+        mailer.run()
+        self.assertEquals(smtp.mails_sent, 3)
+        self.assertFalse(ContactMailingStatus.objects.filter(
+            contact=self.contacts[1]).exists())
+        retry = MailingRetry.objects.get(newsletter=self.newsletter)
+        self.assertEquals(retry.contact, self.contacts[1])
+        self.assertEquals(retry.attempts, 1)
+        self.assertTrue(retry.next_attempt > datetime.utcnow().replace(tzinfo=utc))
+        self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                          Newsletter.SENDING)
+
+        # not due yet
+        mailer = Mailer(self.newsletter)
+        self.assertEquals(list(mailer.iter_expedition_list()), [])
+
+        # only the failed message is sent again
+        retry.next_attempt = datetime.utcnow().replace(tzinfo=utc)
+        retry.save()
+        mailer = Mailer(self.newsletter)
+        smtp = mailer.smtp = TransientSMTP()
+        mailer.run()
+        self.assertEquals(smtp.mails_sent, 1)
+        self.assertEquals(MailingRetry.objects.count(), 0)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 4)
+        self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                          Newsletter.SENT)
+
+    def test_retries_exhausted(self):
+        for i in range(RETRY_MAX_ATTEMPTS - 1):
+            self.assertTrue(MailingRetry.objects.schedule(
+                self.newsletter, self.contacts[0], 'Try again'))
+        retry = MailingRetry.objects.get()
+        delay = retry.next_attempt - datetime.utcnow().replace(tzinfo=utc)
+        self.assertTrue(delay > timedelta(seconds=RETRY_DELAY * 2 ** (
+            RETRY_MAX_ATTEMPTS - 2) - 10))
+        retry.next_attempt = datetime.utcnow().replace(tzinfo=utc)
+        retry.save()
+
+        mailer = Mailer(self.newsletter)
+        smtp = mailer.smtp = TransientSMTP()
+        smtp.failing = [self.contacts[0].email]
+        mailer.run()
+        self.assertEquals(MailingRetry.objects.exhausted(self.newsletter).count(), 1)
+        self.assertEquals(ContactMailingStatus.objects.get(
+            contact=self.contacts[0]).status, ContactMailingStatus.ERROR)
+        self.assertEquals(list(Mailer(self.newsletter).iter_expedition_list()), [])
+        self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                          Newsletter.SENT)
+
+    def test_retries_shards(self):
+        now = datetime.utcnow().replace(tzinfo=utc)
+        for contact in self.contacts:
+            MailingRetry.objects.schedule(self.newsletter, contact,
+                                          'Try again', now=now - timedelta(days=1))
+        recipients = []
+
+        class RecordingSMTP(FakeSMTP):
+            def sendmail(self, sender, recipient, message):
+                recipients.append(recipient)
+                return super(RecordingSMTP, self).sendmail(sender, recipient, message)
+
+        for index in range(2):
+            mailer = Mailer(self.newsletter, shard=(index, 2), credits=10)
+            smtp = mailer.smtp = RecordingSMTP()
+            mailer.run()
+            self.assertEquals(sorted(recipients[-smtp.mails_sent:]),
+                              [contact.email for contact in self.contacts
+                               if contact.pk % 2 == index])
+        self.assertEquals(sorted(recipients),
+                          sorted(contact.email for contact in self.contacts))
+        self.assertEquals(MailingRetry.objects.count(), 0)
+
     def test_can_send(self):
         mailer = Mailer(self.newsletter)
 
@@ -414,22 +1595,57 @@ class MailerTestCase(TestCase):
 
     def test_run(self):
         mailer = Mailer(self.newsletter)
-        mailer.smtp = FakeSMTP()
+        smtp = mailer.smtp = FakeSMTP()
         mailer.run()
-        self.assertEquals(mailer.smtp.mails_sent, 4)
+        self.assertEquals(smtp.mails_sent, 4)
+        self.assertEquals(mailer.smtp, None)
         self.assertEquals(ContactMailingStatus.objects.filter(
             status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 4)
 
         mailer = Mailer(self.newsletter, test=True)
-        mailer.smtp = FakeSMTP()
+        smtp = mailer.smtp = FakeSMTP()
 
         mailer.run()
-        self.assertEquals(mailer.smtp.mails_sent, 2)
+        self.assertEquals(smtp.mails_sent, 2)
         self.assertEquals(ContactMailingStatus.objects.filter(
             status=ContactMailingStatus.SENT_TEST, newsletter=self.newsletter).count(), 2)
 
         mailer.smtp = None
 
+    def test_run_stats(self):
+        stats.enable()
+        try:
+            mailer = Mailer(self.newsletter)
+            mailer.smtp = FakeSMTP()
+            mailer.run()
+            for stage in ('render', 'mime', 'sendmail', 'status', 'credits',
+                          'contacts'):
+                self.assertTrue(stage in stats.histograms)
+            self.assertEquals(stats.histograms['sendmail'].count, 4)
+        finally:
+            stats.enabled = False
+            stats.histograms = {}
+
+    def test_run_with_processes(self):
+        mailer = Mailer(self.newsletter, processes=2)
+        smtp = mailer.smtp = FakeSMTP()
+        mailer.run()
+        self.assertEquals(smtp.mails_sent, 4)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 4)
+
+    def test_render_pipeline(self):
+        mailer = Mailer(self.newsletter)
+        pipeline = RenderPipeline(mailer, processes=2, chunk_size=1,
+                                  queue_size=2)
+        envelopes = list(pipeline.envelopes(self.contacts))
+        self.assertEquals([contact for contact, envelope, exception
+                           in envelopes], self.contacts)
+        for contact, envelope, exception in envelopes:
+            self.assertEquals(exception, None)
+            self.assertEquals(envelope[1], contact.email)
+            self.assertTrue('Test Newsletter Content' in envelope[2])
+
     def test_update_newsletter_status(self):
         mailer = Mailer(self.newsletter, test=True)
         self.assertEquals(self.newsletter.status, Newsletter.WAITING)
@@ -453,11 +1669,11 @@ class MailerTestCase(TestCase):
         self.server.save()
 
         mailer = Mailer(self.newsletter)
-        mailer.smtp = FakeSMTP()
+        smtp = mailer.smtp = FakeSMTP()
 
         mailer.run()
 
-        self.assertEquals(mailer.smtp.mails_sent, 2)
+        self.assertEquals(smtp.mails_sent, 2)
         self.assertEquals(ContactMailingStatus.objects.filter(
             status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 2)
         self.assertEquals(self.newsletter.status, Newsletter.SENDING)
@@ -466,10 +1682,10 @@ class MailerTestCase(TestCase):
         self.server.save()
 
         mailer = Mailer(self.newsletter)
-        mailer.smtp = FakeSMTP()
+        smtp = mailer.smtp = FakeSMTP()
         mailer.run()
 
-        self.assertEquals(mailer.smtp.mails_sent, 2)
+        self.assertEquals(smtp.mails_sent, 2)
         self.assertEquals(ContactMailingStatus.objects.filter(
             status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 4)
         self.assertEquals(self.newsletter.status, Newsletter.SENT)
@@ -491,4 +1707,262 @@ class MailerTestCase(TestCase):
 
         self.assertEquals(Contact.objects.get(email='thisisaninvalidemail').valid, False)
         self.assertEquals(ContactMailingStatus.objects.filter(
-            status=ContactMailingStatus.INVALID, newsletter=self.newsletter).count(), 1)
\ No newline at end of file
+            status=ContactMailingStatus.INVALID, newsletter=self.newsletter).count(), 1)
+
+class ThreadedSendNewsletterCommand(SendNewsletterCommand):
+    """send_newsletter giving the connection of the test to its threads,
+    an in-memory database is only seen by its own connection. The
+    threads take turns on it, sqlite does not share a connection."""
+
+    def handle_noargs(self, **options):
+        self.connection = connections[DEFAULT_DB_ALIAS]
+        self.connection.allow_thread_sharing = True
+        self.lock = Lock()
+        self.threads = set()
+        self.processes_used = set()
+        try:
+            super(ThreadedSendNewsletterCommand, self).handle_noargs(**options)
+        finally:
+            self.connection.allow_thread_sharing = False
+
+    def send_queues_thread(self, queues):
+        connections[DEFAULT_DB_ALIAS] = self.connection
+        super(ThreadedSendNewsletterCommand, self).send_queues_thread(queues)
+
+    def send_queue(self, newsletters):
+        self.threads.add(current_thread().name)
+        self.processes_used.add(self.processes)
+        self.lock.acquire()
+        try:
+            super(ThreadedSendNewsletterCommand, self).send_queue(newsletters)
+        finally:
+            self.lock.release()
+
+
+class AsyncSMTPMailerTestCase(TestCase):
+    """Tests for the AsyncSMTPMailer object"""
+
+    def setUp(self):
+        self.sink = SMTPSink()
+        self.sink.start()
+        self.server = SMTPServer.objects.create(name='Local SMTP',
+                                                host=self.sink.host,
+                                                port=self.sink.port)
+        self.contacts = [Contact.objects.create(email='test%s@domain.com' % i)
+                         for i in range(10)]
+        self.mailinglist = MailingList.objects.create(name='Test MailingList')
+        self.mailinglist.subscribers.add(*self.contacts)
+        self.newsletter = Newsletter.objects.create(title='Test Newsletter',
+                                                    article_1_text='Test Newsletter Content',
+                                                    slug='test-newsletter',
+                                                    server=self.server,
+                                                    status=Newsletter.WAITING)
+        self.newsletter.mailing_lists.add(self.mailinglist)
+
+    def tearDown(self):
+        self.sink.stop()
+
+    def run_mailer(self, mailer, expected):
+        def stop_when_received():
+            deadline = time.time() + 10
+            while self.sink.received < expected and time.time() < deadline:
+                time.sleep(0.05)
+            mailer.stop_event.set()
+
+        watcher = Thread(target=stop_when_received)
+        watcher.start()
+        mailer.run()
+        watcher.join()
+
+    def test_run(self):
+        mailer = AsyncSMTPMailer(self.server, sessions=3)
+        self.run_mailer(mailer, 10)
+
+        self.assertEquals(self.sink.received, 10)
+        self.assertEquals(sorted(self.sink.recipients),
+                          sorted([c.email for c in self.contacts]))
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, newsletter=self.newsletter).count(), 10)
+        self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                          Newsletter.SENT)
+        self.assertEquals(mailer.pool, [])
+        self.assertEquals(mailer.socket_map, {})
+
+    def test_session_socket(self):
+        socket_map = {}
+        session = AsyncSMTPSession(self.server, socket_map)
+        try:
+            self.assertTrue(session.socket.getsockopt(socket.IPPROTO_TCP,
+                                                      socket.TCP_NODELAY))
+            self.assertEquals(session.ac_out_buffer_size, 65536)
+        finally:
+            session.close()
+        self.assertEquals(socket_map, {})
+
+    def test_metrics(self):
+        mailer = AsyncSMTPMailer(self.server, sessions=3)
+        self.run_mailer(mailer, 10)
+        self.assertEquals(mailer.metrics.sent, 10)
+        self.assertEquals(mailer.metrics.errors, 0)
+        self.assertEquals(mailer.metrics.credits, 10000)
+
+        mailer.metrics.server_name = 'Local "SMTP"'
+        server = MetricsServer([mailer.metrics], 0)
+        server.start()
+        try:
+            response = urllib2.urlopen('http://127.0.0.1:%s/metrics' %
+                                       server.server_address[1])
+            self.assertTrue(response.info()['Content-Type'].startswith(
+                'text/plain; version=0.0.4'))
+            lines = response.read().splitlines()
+        finally:
+            server.stop()
+        self.assertTrue('# TYPE newsletter_messages_sent_total counter' in lines)
+        self.assertTrue('newsletter_messages_sent_total'
+                        '{server="Local \\"SMTP\\""} 10' in lines)
+        self.assertTrue('newsletter_credits{server="Local \\"SMTP\\""} 10000'
+                        in lines)
+
+        # the credits computed from a Sum, on PostgreSQL or MySQL
+        for credits, sample in ((9990L, '9990'), (Decimal('9990'), '9990.0'),
+                                (0.5, '0.5')):
+            mailer.metrics.credits = credits
+            self.assertTrue('newsletter_credits{server="Local \\"SMTP\\""} %s'
+                            % sample in exposition([mailer.metrics]).splitlines())
+
+    def test_balanced_servers(self):
+        sink = SMTPSink()
+        sink.start()
+        try:
+            self.server.mails_hour = 1000
+            self.server.save()
+            server = SMTPServer.objects.create(name='Other SMTP',
+                                               host=sink.host, port=sink.port,
+                                               mails_hour=1000)
+            self.newsletter.servers.add(server)
+            mailer = Mailer(self.newsletter)
+            self.assertEquals(mailer.credits(), 2000)
+            mailer.run()
+        finally:
+            sink.stop()
+
+        self.assertEquals(self.sink.received + sink.received, 10)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, server=server).count(),
+                          sink.received)
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            status=ContactMailingStatus.SENT, server=None).count(),
+                          self.sink.received)
+        self.assertEquals(self.server.credits(), 1000 - self.sink.received)
+        self.assertEquals(server.credits(), 1000 - sink.received)
+        self.assertEquals(Newsletter.objects.get(pk=self.newsletter.pk).status,
+                          Newsletter.SENT)
+
+    def test_concurrency(self):
+        server = SMTPServer.objects.create(name='Other SMTP',
+                                           host=self.sink.host,
+                                           port=self.sink.port)
+        newsletter = Newsletter.objects.create(title='Other Newsletter',
+                                               slug='other-newsletter',
+                                               server=server,
+                                               status=Newsletter.WAITING)
+        newsletter.mailing_lists.add(self.mailinglist)
+
+        command = ThreadedSendNewsletterCommand()
+        command.handle_noargs(verbosity=0, processes=4, workers=1,
+                              concurrency=2, stats=False)
+        self.assertFalse(current_thread().name in command.threads)
+        self.assertEquals(command.processes_used, set([1]))
+        self.assertEquals(self.sink.received, 20)
+        for newsletter in (self.newsletter, newsletter):
+            self.assertEquals(Newsletter.objects.get(pk=newsletter.pk).status,
+                              Newsletter.SENT)
+
+    def test_sending_date(self):
+        self.newsletter.sending_date = datetime.utcnow().replace(
+            tzinfo=utc) + timedelta(seconds=1)
+        self.newsletter.save()
+        mailer = SMTPMailer(self.server)
+        start = time.time()
+        self.run_mailer(mailer, 10)
+        self.assertEquals(self.sink.received, 10)
+        self.assertTrue(1 <= time.time() - start < 5)
+
+    def test_retry_continuous(self):
+        failing = [self.contacts[1].email]
+        runs = []
+
+        class FlakySMTP(FakeSMTP):
+            def sendmail(self, sender, recipient, message):
+                if recipient in failing:
+                    failing.remove(recipient)
+                    raise SMTPDataError(451, 'Try again later')
+                return super(FlakySMTP, self).sendmail(sender, recipient, message)
+
+        class CountingExpedition(NewsLetterExpedition):
+            def iter_expedition_list(self, *ka, **kw):
+                runs.append(self.id)
+                return super(CountingExpedition, self).iter_expedition_list(
+                    *ka, **kw)
+
+        class FlakySMTPMailer(SMTPMailer):
+            def smtp_connect(self):
+                self.smtp = FlakySMTP()
+
+            def get_candidates(self):
+                return [CountingExpedition(nl, self) for nl in
+                        Newsletter.objects.filter(server=self.server)]
+
+            def wait_for_work(self, candidates, woken=False):
+                if Newsletter.objects.get(pk=newsletter.pk).status == \
+                       Newsletter.SENT or time.time() > deadline:
+                    self.stop_event.set()
+                    return False
+                return super(FlakySMTPMailer, self).wait_for_work(
+                    candidates, woken)
+
+        newsletter = self.newsletter
+        deadline = time.time() + 10
+        retry_delay = managers.RETRY_DELAY
+        managers.RETRY_DELAY = 0.2
+        try:
+            FlakySMTPMailer(self.server).run()
+        finally:
+            managers.RETRY_DELAY = retry_delay
+
+        # a run for the contacts, one for the retry when it is due, and
+        # one woken up by the newsletter becoming SENDING
+        self.assertTrue(len(runs) <= 3)
+        self.assertTrue(time.time() < deadline)
+        self.assertEquals(MailingRetry.objects.count(), 0)
+        self.assertEquals(ContactMailingStatus.objects.get(
+            contact=self.contacts[1]).status, ContactMailingStatus.SENT)
+        self.assertEquals(Newsletter.objects.get(pk=newsletter.pk).status,
+                          Newsletter.SENT)
+
+    def test_benchmark(self):
+        # the sinks would share the asyncore map of the process
+        self.sink.stop()
+        output = NamedTemporaryFile(suffix='.json')
+        call_command('benchmark_newsletter', scales='15', output=output.name,
+                     timeout=60, verbosity=0)
+        report = simplejson.load(open(output.name))
+        self.assertEquals([(result['engine'], result['sent'], result['statuses'])
+                           for result in report['results']],
+                          [('mailer', 15, 15), ('thread', 15, 15),
+                           ('async', 15, 15)])
+        for result in report['results']:
+            self.assertTrue(0 < result['latency_p50_ms'] <= result['latency_p99_ms'])
+            self.assertTrue(result['peak_rss_kb'] > 0)
+        self.assertEquals(Contact.objects.count(), 10)
+        output.close()
+
+    def test_server_down(self):
+        self.server.port = self.sink.port
+        self.sink.stop()
+        mailer = AsyncSMTPMailer(self.server, sessions=2)
+        Thread(target=lambda: time.sleep(0.5) or
+               mailer.stop_event.set()).start()
+        mailer.run()
+        self.assertEquals(ContactMailingStatus.objects.filter(
+            newsletter=self.newsletter).count(), 0)
@@ -5,5 +5,6 @@ from django.conf.urls.defaults import patterns
 
 urlpatterns = patterns('',
                        url(r'^mailing/', include('dry_newsletter.newsletter.urls.mailing_list')),
+                       url(r'^statistics/', include('dry_newsletter.newsletter.urls.statistics')),
                        url(r'^', include('dry_newsletter.newsletter.urls.newsletter')),
                        )
@@ -2,8 +2,14 @@
 from django.conf.urls.defaults import url
 from django.conf.urls.defaults import patterns
 
+from dry_newsletter.newsletter.settings import TRACKING_IMAGE_FORMAT
+
 urlpatterns = patterns('dry_newsletter.newsletter.views.newsletter',
     url(r'^preview/(?P<slug>[-\w]+)/$', 'view_newsletter_preview', name='newsletter_newsletter_preview'),
     url(r'^online_version/(?P<slug>[-\w]+)/$', 'view_newsletter_online_version', name='newsletter_newsletter_online_version'),
+    url(r'^tracking/(?P<slug>[-\w]+)/(?P<uidb36>[0-9A-Za-z]+)-(?P<token>[0-9A-Za-z]+)\.%s$' % TRACKING_IMAGE_FORMAT,
+        'view_newsletter_tracking', name='newsletter_newsletter_tracking'),
+    url(r'^tracking/(?P<slug>[-\w]+)/(?P<uidb36>[0-9A-Za-z]+)-(?P<token>[0-9A-Za-z]+)/(?P<link_id>[0-9a-z]{1,13})/$',
+        'view_newsletter_tracking_link', name='newsletter_newsletter_tracking_link'),
     url(r'^(?P<slug>[-\w]+)/(?P<uidb36>[0-9A-Za-z]+)-(?P<token>.+)/$', 'view_newsletter_contact', name='newsletter_newsletter_contact'),
 )
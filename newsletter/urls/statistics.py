@@ -0,0 +1,9 @@
+"""Urls for the dry_newsletter.newsletter statistics"""
+from django.conf.urls.defaults import url
+from django.conf.urls.defaults import patterns
+
+urlpatterns = patterns('dry_newsletter.newsletter.views.statistics',
+    url(r'^(?P<slug>[-\w]+)/$', 'view_newsletter_statistics', name='newsletter_newsletter_statistics'),
+    url(r'^charts/(?P<slug>[-\w]+)/$', 'view_newsletter_charts', name='newsletter_newsletter_charts'),
+    url(r'^density/(?P<slug>[-\w]+)/$', 'view_newsletter_density', name='newsletter_newsletter_density'),
+)
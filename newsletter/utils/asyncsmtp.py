@@ -0,0 +1,259 @@
+"""Asynchronous SMTP client for dry_newsletter.newsletter"""
+import sys
+import time
+import base64
+import socket
+import asynchat
+from smtplib import CRLF
+from smtplib import quoteaddr
+from smtplib import quotedata
+from smtplib import SMTPException
+from smtplib import SMTPDataError
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPResponseException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPServerDisconnected
+from smtplib import SMTPAuthenticationError
+
+from django.utils.encoding import smart_str
+
+from dry_newsletter.newsletter.settings import ASYNC_SMTP_TIMEOUT
+
+_local_hostname = None
+
+
+def local_hostname():
+    """Name used in EHLO, computed once as it can be slow"""
+    global _local_hostname
+    if _local_hostname is None:
+        _local_hostname = socket.getfqdn()
+    return _local_hostname
+
+
+class AsyncSMTPSession(asynchat.async_chat):
+    """SMTP session driven by an asyncore loop.
+
+    The session connects, greets and logs in the SMTPServer by itself,
+    then it is ready and sends the messages given to sendmail() one at
+    a time. The callback of sendmail() is called with None on success
+    or with the same exception smtplib would have raised.
+
+    STARTTLS is not supported, servers using TLS must be handled with
+    the threaded SMTPMailer."""
+
+    # write the messages in large chunks
+    ac_out_buffer_size = 65536
+
+    def __init__(self, server, socket_map, timeout=ASYNC_SMTP_TIMEOUT):
+        asynchat.async_chat.__init__(self, map=socket_map)
+        self.server = server
+        self.timeout = timeout
+        self.set_terminator(CRLF)
+        self.incoming = []
+        self.lines = []
+        self.features = {}
+        self.handler = self.on_greeting
+        self.envelope = None
+        self.callback = None
+        self.error = None
+        self.ready = False
+        self.opened = False
+        self.dead = False
+        self.deadline = time.time() + timeout
+
+        if server.tls:
+            raise SMTPException('STARTTLS is not supported by the '
+                                'asynchronous SMTP engine.')
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        # commands are short writes waiting for a reply, do not let
+        # Nagle's algorithm hold them until the previous one is acked
+        self.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            self.connect((smart_str(server.host), int(server.port)))
+        except:
+            self.close()
+            raise
+
+    @property
+    def idle(self):
+        """Check if the session can take a new message"""
+        return self.ready and not self.dead and self.callback is None
+
+    def command(self, line, handler):
+        """Send a command and wait for the reply with handler"""
+        self.handler = handler
+        self.deadline = time.time() + self.timeout
+        self.push(line + CRLF)
+
+    def sendmail(self, from_addr, to_addr, message, callback):
+        """Send a message, callback will receive the outcome"""
+        self.ready = False
+        self.callback = callback
+        self.envelope = (smart_str(from_addr), smart_str(to_addr), message)
+        self.command('MAIL FROM:%s' % quoteaddr(self.envelope[0]),
+                     self.on_mail)
+
+    def quit(self):
+        """Close politely the session"""
+        if self.dead:
+            return
+        self.dead = True
+        self.ready = False
+        self.handler = self.on_quit
+        self.push('QUIT' + CRLF)
+        self.close_when_done()
+
+    def check_timeout(self, now):
+        """Drop the session if the server does not answer anymore"""
+        if not self.dead and not self.ready and now > self.deadline:
+            self.fail(socket.timeout('SMTP session timed out'))
+
+    # asynchat API
+
+    def collect_incoming_data(self, data):
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        line = ''.join(self.incoming)
+        self.incoming = []
+        self.lines.append(line[4:].strip())
+        if line[3:4] == '-':
+            return
+        try:
+            code = int(line[:3])
+        except ValueError:
+            code = -1
+        message = '\n'.join(self.lines)
+        self.lines = []
+        self.handler(code, message)
+
+    def handle_connect(self):
+        pass
+
+    def handle_close(self):
+        self.fail(SMTPServerDisconnected('Connection unexpectedly closed'))
+
+    def handle_error(self):
+        exception = sys.exc_info()[1]
+        print >>sys.stderr, 'asynchronous smtp session raises %s' % exception
+        self.fail(exception)
+
+    # SMTP dialog
+
+    def on_greeting(self, code, message):
+        if code != 220:
+            return self.fail(SMTPResponseException(code, message))
+        self.command('EHLO %s' % local_hostname(), self.on_ehlo)
+
+    def on_ehlo(self, code, message):
+        if code != 250:
+            return self.command('HELO %s' % local_hostname(), self.on_helo)
+        for line in message.split('\n')[1:]:
+            feature = line.split(None, 1)
+            if feature:
+                self.features[feature[0].lower()] = \
+                    len(feature) > 1 and feature[1] or ''
+        self.login()
+
+    def on_helo(self, code, message):
+        if code != 250:
+            return self.fail(SMTPResponseException(code, message))
+        self.login()
+
+    def login(self):
+        if not (self.server.user or self.server.password):
+            return self.on_ready()
+
+        user = smart_str(self.server.user)
+        password = smart_str(self.server.password)
+        methods = self.features.get('auth', '').upper().split()
+        if 'PLAIN' in methods:
+            self.command('AUTH PLAIN %s' % base64.b64encode(
+                '\0%s\0%s' % (user, password)), self.on_auth)
+        elif 'LOGIN' in methods:
+            def on_password(code, message):
+                if code != 334:
+                    return self.on_auth(code, message)
+                self.command(base64.b64encode(password), self.on_auth)
+
+            def on_user(code, message):
+                if code != 334:
+                    return self.on_auth(code, message)
+                self.command(base64.b64encode(user), on_password)
+
+            self.command('AUTH LOGIN', on_user)
+        else:
+            self.fail(SMTPException(
+                'No suitable authentication method found.'))
+
+    def on_auth(self, code, message):
+        if code != 235:
+            return self.fail(SMTPAuthenticationError(code, message))
+        self.on_ready()
+
+    def on_ready(self):
+        self.ready = self.opened = True
+        self.handler = self.on_unexpected
+
+    def on_unexpected(self, code, message):
+        self.fail(SMTPResponseException(code, message))
+
+    def on_mail(self, code, message):
+        if code != 250:
+            return self.reset(SMTPSenderRefused(code, message,
+                                                self.envelope[0]))
+        self.command('RCPT TO:%s' % quoteaddr(self.envelope[1]),
+                     self.on_rcpt)
+
+    def on_rcpt(self, code, message):
+        if code not in (250, 251):
+            return self.reset(SMTPRecipientsRefused(
+                {self.envelope[1]: (code, message)}))
+        self.command('DATA', self.on_data)
+
+    def on_data(self, code, message):
+        if code != 354:
+            return self.reset(SMTPDataError(code, message))
+        data = quotedata(self.envelope[2])
+        if data[-2:] != CRLF:
+            data += CRLF
+        self.handler = self.on_sent
+        self.deadline = time.time() + self.timeout
+        self.push(data + '.' + CRLF)
+
+    def on_sent(self, code, message):
+        if code != 250:
+            return self.reset(SMTPDataError(code, message))
+        self.done(None)
+
+    def reset(self, exception):
+        """Abort the current transaction"""
+        self.error = exception
+        self.command('RSET', self.on_reset)
+
+    def on_reset(self, code, message):
+        if code != 250:
+            return self.fail(self.error)
+        self.done(self.error)
+
+    def on_quit(self, code, message):
+        pass
+
+    def done(self, exception):
+        """Give the outcome of the message and be ready again"""
+        callback = self.callback
+        self.envelope = self.callback = self.error = None
+        self.on_ready()
+        if callback is not None:
+            callback(exception)
+
+    def fail(self, exception):
+        """Kill the session, failing the message in progress"""
+        callback = self.callback
+        self.envelope = self.callback = None
+        self.error = exception
+        self.ready = False
+        self.dead = True
+        self.close()
+        if callback is not None:
+            callback(exception)
@@ -0,0 +1,142 @@
+"""Attachments of the newsletters for dry_newsletter.newsletter"""
+import os
+import mmap
+import base64
+import mimetypes
+import threading
+from StringIO import StringIO
+from collections import OrderedDict
+from email import message_from_file
+from email.generator import Generator
+from email.MIMEBase import MIMEBase
+from email.MIMEText import MIMEText
+from email.MIMEAudio import MIMEAudio
+from email.MIMEImage import MIMEImage
+from email.Encoders import encode_base64
+
+from dry_newsletter.newsletter.utils.mime import encode_header
+from dry_newsletter.newsletter.settings import ATTACHMENT_CACHE_SIZE
+
+# a base64 line encodes 57 bytes, the chunks must be a multiple of it
+CHUNK_SIZE = 57 * 16384
+
+
+def content_type(path):
+    """Return the main type and subtype of a file"""
+    ctype, encoding = mimetypes.guess_type(path)
+    if ctype is None or encoding is not None:
+        ctype = 'application/octet-stream'
+    return ctype.split('/', 1)
+
+
+def build_attachment(path, title):
+    """Build the MIME part of a file attached to a newsletter"""
+    maintype, subtype = content_type(path)
+    fd = open(path, 'rb')
+    try:
+        if maintype == 'text':
+            part = MIMEText(fd.read(), _subtype=subtype)
+        elif maintype == 'message':
+            part = message_from_file(fd)
+        elif maintype == 'image':
+            part = MIMEImage(fd.read(), _subtype=subtype)
+        elif maintype == 'audio':
+            part = MIMEAudio(fd.read(), _subtype=subtype)
+        else:
+            part = MIMEBase(maintype, subtype)
+            part.set_payload(fd.read())
+            encode_base64(part)
+    finally:
+        fd.close()
+    part.add_header('Content-Disposition', 'attachment', filename=title)
+    return part
+
+
+def encode_attachment(path, title):
+    """Serialize the MIME part of a file like the Generator would do
+    with build_attachment(). The files sent in base64 are mapped in
+    memory and encoded by chunks instead of being read at once."""
+    maintype, subtype = content_type(path)
+    if maintype in ('text', 'message'):
+        out = StringIO()
+        Generator(out).flatten(build_attachment(path, title))
+        return out.getvalue()
+
+    part = MIMEBase(maintype, subtype)
+    part['Content-Transfer-Encoding'] = 'base64'
+    part.add_header('Content-Disposition', 'attachment', filename=title)
+    out = [encode_header(header, value) for header, value in part.items()]
+    out.append('\n')
+
+    fd = open(path, 'rb')
+    try:
+        size = os.fstat(fd.fileno()).st_size
+        if not size:
+            return ''.join(out)
+        data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for start in xrange(0, size, CHUNK_SIZE):
+                out.append(base64.encodestring(data[start:start + CHUNK_SIZE]))
+            newline = data[size - 1] == '\n'
+        finally:
+            data.close()
+    finally:
+        fd.close()
+
+    # like email.encoders, no final newline if the file has none
+    if not newline:
+        out[-1] = out[-1][:-1]
+    return ''.join(out)
+
+
+class AttachmentCache(object):
+    """Encoded attachments kept for every message of a sending.
+
+    The least recently used parts are dropped when the cache exceeds
+    max_size bytes. A file is encoded again when it has changed."""
+
+    def __init__(self, max_size=ATTACHMENT_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.parts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, path, title):
+        """Return the serialized MIME part of a file"""
+        stat = os.stat(path)
+        key = (path, title, stat.st_mtime, stat.st_size)
+        self.lock.acquire()
+        try:
+            part = self.parts.pop(key, None)
+            if part is not None:
+                self.parts[key] = part
+                return part
+        finally:
+            self.lock.release()
+
+        part = encode_attachment(path, title)
+        if len(part) > self.max_size:
+            return part
+
+        self.lock.acquire()
+        try:
+            if key not in self.parts:
+                self.parts[key] = part
+                self.size += len(part)
+            while self.size > self.max_size:
+                old_key, old_part = self.parts.popitem(last=False)
+                self.size -= len(old_part)
+        finally:
+            self.lock.release()
+        return part
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.parts.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+
+attachment_cache = AttachmentCache()
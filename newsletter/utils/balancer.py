@@ -0,0 +1,158 @@
+"""Load balancing of a newsletter over SMTP servers for dry_newsletter.newsletter"""
+import time
+import random
+import socket
+import threading
+from smtplib import SMTPException
+from smtplib import SMTPDataError
+from smtplib import SMTPSenderRefused
+from smtplib import SMTPRecipientsRefused
+
+from dry_newsletter.newsletter.settings import BALANCER_FAILURES
+from dry_newsletter.newsletter.settings import BALANCER_COOLDOWN
+from dry_newsletter.newsletter.utils.retries import is_transient
+
+# weight of the last message in the latency average of a server
+LATENCY_ALPHA = 0.2
+
+
+class NoServerAvailable(SMTPException):
+    """Every server of the newsletter is out of credits or failing"""
+
+
+class ServerState(object):
+    """Credits, latency and failures of a server of the balancer"""
+
+    def __init__(self, server, credits):
+        self.server = server
+        self.credits = credits
+        self.latency = None
+        self.failures = 0
+        self.open_until = 0
+        self.smtp = None
+
+    def available(self, now):
+        return self.credits > 0 and self.open_until <= now
+
+
+class ServerBalancer(object):
+    """Dispatch the messages of a newsletter over several servers.
+
+    Each message goes to a server drawn with a weight of its credits
+    left divided by its average latency. A server failing threshold
+    times in a row is put aside for cooldown seconds, then given one
+    message to prove it is back. share is the part of the credits of
+    each server given to this balancer, when several share them.
+
+    Only the connection errors and the temporary replies count as
+    failures, a message refused for good is refused by every server.
+    The waits for a server put aside end when stop_event is set."""
+
+    def __init__(self, servers, share=1.0, threshold=BALANCER_FAILURES,
+                 cooldown=BALANCER_COOLDOWN, stop_event=None):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.stop_event = stop_event or threading.Event()
+        self.states = [ServerState(server, int(server.credits() * share))
+                       for server in servers]
+
+    def credits(self):
+        return sum(max(state.credits, 0) for state in self.states)
+
+    def choose(self, exclude=(), now=None):
+        """Draw an available server state, None if there is none"""
+        now = now or time.time()
+        states = [state for state in self.states
+                  if state not in exclude and state.available(now)]
+        if not states:
+            return None
+        latencies = [state.latency for state in states if state.latency]
+        default = latencies and min(latencies) or 1.0
+        weights = [float(state.credits) / (state.latency or default)
+                   for state in states]
+        draw = random.random() * sum(weights)
+        for state, weight in zip(states, weights):
+            draw -= weight
+            if draw < 0:
+                return state
+        return states[-1]
+
+    def wait_time(self, now=None):
+        """Seconds until a server put aside comes back, None when no
+        server has credits left"""
+        now = now or time.time()
+        waits = [state.open_until - now for state in self.states
+                 if state.credits > 0]
+        if not waits:
+            return None
+        return max(min(waits), 0)
+
+    def success(self, state, seconds):
+        state.credits -= 1
+        state.failures = 0
+        if state.latency is None:
+            state.latency = seconds
+        else:
+            state.latency += LATENCY_ALPHA * (seconds - state.latency)
+
+    def failure(self, state, now=None):
+        state.failures += 1
+        if state.failures >= self.threshold:
+            state.open_until = (now or time.time()) + self.cooldown
+            # a single failure puts it aside again after the cooldown
+            state.failures = self.threshold - 1
+
+    def sendmail(self, envelope):
+        """Send a message, trying the other servers when one fails.
+        Return the server which accepted it."""
+        tried = []
+        error = None
+        while True:
+            state = self.choose(exclude=tried)
+            if state is None:
+                wait = not tried and self.wait_time()
+                if not wait:
+                    raise error or NoServerAvailable(
+                        'No SMTP server available')
+                if self.stop_event.wait(wait):
+                    raise NoServerAvailable('Stopped while waiting for '
+                                            'a SMTP server')
+                continue
+
+            tried.append(state)
+            start = time.time()
+            try:
+                if state.smtp is None:
+                    state.smtp = state.server.connection_pool().acquire()
+                state.smtp.sendmail(*envelope)
+            except (UnicodeError, SMTPRecipientsRefused):
+                # the message or the recipient is the problem
+                raise
+            except (SMTPDataError, SMTPSenderRefused), e:
+                if not is_transient(e):
+                    # refused for good, the server works
+                    raise
+                error = e
+                self.failure(state)
+                self.drop(state)
+            except (SMTPException, socket.error), e:
+                error = e
+                self.failure(state)
+                self.drop(state)
+            else:
+                self.success(state, time.time() - start)
+                return state.server
+
+    def drop(self, state):
+        """Close the session of a server which failed"""
+        if state.smtp is not None:
+            state.smtp.close()
+            state.smtp.quit()
+            state.smtp = None
+
+    def close(self):
+        """Give back the sessions to the pools"""
+        for state in self.states:
+            if state.smtp is not None:
+                state.smtp.quit()
+                state.smtp = None
@@ -0,0 +1,59 @@
+"""Bitmap of ids for dry_newsletter.newsletter"""
+import zlib
+import base64
+from binascii import hexlify
+from binascii import unhexlify
+
+
+class Bitmap(object):
+    """Set of positive integers stored as a bitmap.
+
+    Membership is a bit test, and the bitmap compresses well with
+    zlib as the ids of a table are dense."""
+
+    def __init__(self, ids=()):
+        self.bits = bytearray()
+        self.update(ids)
+
+    def add(self, i):
+        index = i >> 3
+        if index >= len(self.bits):
+            self.bits.extend('\0' * (index + 1 - len(self.bits)))
+        self.bits[index] |= 1 << (i & 7)
+
+    def update(self, ids):
+        for i in ids:
+            self.add(i)
+
+    def merge(self, other):
+        """Add the ids of another bitmap"""
+        if not other.bits:
+            return
+        size = max(len(self.bits), len(other.bits))
+        bits = long(hexlify(self.bits.ljust(size, '\0')), 16) | \
+               long(hexlify(other.bits.ljust(size, '\0')), 16)
+        self.bits = bytearray(unhexlify('%0*x' % (size * 2, bits)))
+
+    def __contains__(self, i):
+        index = i >> 3
+        return index < len(self.bits) and bool(self.bits[index] & (1 << (i & 7)))
+
+    def __len__(self):
+        if not self:
+            return 0
+        return bin(long(hexlify(self.bits), 16)).count('1')
+
+    def __nonzero__(self):
+        return any(self.bits)
+
+    def dumps(self):
+        """Return the bitmap serialized as ascii"""
+        return base64.b64encode(zlib.compress(str(self.bits)))
+
+    @classmethod
+    def loads(cls, data):
+        """Build a bitmap from dumps()"""
+        bitmap = cls()
+        if data:
+            bitmap.bits = bytearray(zlib.decompress(base64.b64decode(data)))
+        return bitmap
@@ -0,0 +1,213 @@
+"""Buffered events of the public views for dry_newsletter.newsletter"""
+import os
+import sys
+import glob
+import time
+import errno
+import atexit
+import threading
+from datetime import datetime
+
+from django.db import connection
+from django.utils import simplejson
+from django.utils import timezone
+
+from dry_newsletter.newsletter.models import ContactMailingStatus
+from dry_newsletter.newsletter.settings import EVENT_SPOOL_DIR
+from dry_newsletter.newsletter.settings import EVENT_BATCH_SIZE
+from dry_newsletter.newsletter.settings import EVENT_FLUSH_INTERVAL
+
+DATE_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_event(newsletter_id, contact_id, status, when, fields):
+    return simplejson.dumps([newsletter_id, contact_id, status,
+                             when.strftime(DATE_FORMAT), fields]) + '\n'
+
+
+def decode_event(line):
+    newsletter_id, contact_id, status, when, fields = simplejson.loads(line)
+    when = datetime.strptime(when, DATE_FORMAT).replace(tzinfo=timezone.utc)
+    fields = dict((str(name), value) for name, value in fields.items())
+    return ContactMailingStatus(newsletter_id=newsletter_id,
+                                contact_id=contact_id, status=status,
+                                creation_date=when, **fields)
+
+
+def write_events(statuses):
+    """Insert statuses like the mailers do"""
+    from dry_newsletter.newsletter.utils.statuses import StatusWriter
+    StatusWriter().write(statuses, set())
+
+
+def write_spool(path):
+    """Insert the events of a spool file in a transaction and remove
+    it. Return the number of events written."""
+    spool = open(path)
+    try:
+        # an event cut by a crash has no end of line
+        statuses = [decode_event(line) for line in spool
+                    if line.endswith('\n')]
+    finally:
+        spool.close()
+    if statuses:
+        write_events(statuses)
+    os.unlink(path)
+    return len(statuses)
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def orphan_spools(spool_dir=EVENT_SPOOL_DIR):
+    """Spool files left by the processes which are gone"""
+    paths = []
+    for path in sorted(glob.glob(os.path.join(spool_dir, 'events-*'))):
+        try:
+            pid = int(os.path.basename(path).split('-')[1].split('.')[0])
+        except ValueError:
+            continue
+        if not pid_alive(pid):
+            paths.append(path)
+    return paths
+
+
+class EventBuffer(object):
+    """Statuses of the public views written by batches from a thread.
+
+    Each event is appended to a spool file of the process before the
+    view returns, so a crash of the process loses none of them, they
+    are saved by the drain_newsletter_events command. The spool is
+    synced to the disk when it is handed to the flusher, a power
+    failure loses at most interval seconds of events.
+
+    The flusher writes the spool every interval seconds, or sooner
+    when it holds batch_size events. A spool failing to be written is
+    tried again at the next flush, or by drain_newsletter_events once
+    the process is gone. Without a spool directory or interval the
+    events are written at once, as before."""
+
+    def __init__(self, spool_dir=EVENT_SPOOL_DIR, interval=EVENT_FLUSH_INTERVAL,
+                 batch_size=EVENT_BATCH_SIZE):
+        self.spool_dir = spool_dir
+        self.interval = interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.pid = None
+        self.spool = None
+        self.count = 0
+        self.batches = 0
+        self.thread = None
+        self.registered = False
+
+    @property
+    def buffered(self):
+        return bool(self.spool_dir and self.interval)
+
+    def add(self, newsletter, contact, status, **fields):
+        """Record an event of a contact on a newsletter, fields being
+        other ContactMailingStatus fields given by id"""
+        when = timezone.now()
+        if not self.buffered:
+            write_events([ContactMailingStatus(
+                newsletter=newsletter, contact=contact, status=status,
+                creation_date=when, **fields)])
+            return
+
+        line = encode_event(newsletter.pk, contact.pk, status, when, fields)
+        self.lock.acquire()
+        try:
+            self.open()
+            self.spool.write(line)
+            self.spool.flush()
+            self.count += 1
+            full = self.count >= self.batch_size
+        finally:
+            self.lock.release()
+        if full:
+            self.wakeup.set()
+
+    def open(self):
+        """Open the spool of the process, and start the flusher"""
+        if self.pid != os.getpid():
+            # a new process, the spool and the thread were its parent's
+            self.pid = os.getpid()
+            self.spool = None
+            self.thread = threading.Thread(target=self.run, name='events')
+            self.thread.daemon = True
+            self.thread.start()
+            if not self.registered:
+                # the daemon flusher is killed at exit, not the events
+                atexit.register(self.close)
+                self.registered = True
+        if self.spool is None:
+            if not os.path.isdir(self.spool_dir):
+                os.makedirs(self.spool_dir)
+            self.spool = open(self.path(), 'a')
+            self.count = 0
+
+    def path(self, batch=None):
+        if batch is None:
+            return os.path.join(self.spool_dir, 'events-%s.spool' % self.pid)
+        return os.path.join(self.spool_dir,
+                            'events-%s.%s.batch' % (self.pid, batch))
+
+    def rotate(self):
+        """Hand the current spool to the flusher, return its path"""
+        self.lock.acquire()
+        try:
+            if self.spool is None or not self.count:
+                return None
+            self.spool.flush()
+            os.fsync(self.spool.fileno())
+            self.spool.close()
+            self.spool = None
+            self.batches += 1
+            # unique even with the batches left by a former process
+            path = self.path('%d-%d' % (time.time() * 1000, self.batches))
+            os.rename(self.path(), path)
+            return path
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """Write the events spooled so far, return their number"""
+        # the flusher and a caller must not write the same batch
+        self.flush_lock.acquire()
+        try:
+            self.rotate()
+            written = 0
+            for path in sorted(glob.glob(self.path('*'))):
+                try:
+                    written += write_spool(path)
+                except Exception, e:
+                    print >>sys.stderr, 'events of %s not written: %s' % (path, e)
+                    break
+            return written
+        finally:
+            self.flush_lock.release()
+
+    def close(self):
+        """Write the events left by the process, when it exits"""
+        if self.pid == os.getpid():
+            self.flush()
+
+    def run(self):
+        pid = self.pid
+        while pid == os.getpid():
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                connection.close()
+
+
+event_buffer = EventBuffer()
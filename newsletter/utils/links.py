@@ -0,0 +1,80 @@
+"""Link tracking for dry_newsletter.newsletter"""
+import re
+import time
+from HTMLParser import HTMLParser
+
+from django.core.urlresolvers import reverse
+from django.utils.http import int_to_base36
+
+from dry_newsletter.newsletter.models import Link
+from dry_newsletter.newsletter.settings import TOKEN_CACHE_TTL
+
+HREF_RE = re.compile(r'(<a\s[^>]*?href\s*=\s*)(["\'])(https?://.+?)\2',
+                     re.IGNORECASE | re.DOTALL)
+URL_MAX_LENGTH = Link._meta.get_field('url').max_length
+
+_unescape = HTMLParser().unescape
+
+
+class LinkRewriter(object):
+    """Replace the links of a rendered newsletter by tracking urls.
+
+    The links are saved at the first rendering, which is done once for
+    the newsletter with the render plan."""
+
+    def __init__(self, newsletter, domain):
+        self.newsletter = newsletter
+        self.domain = domain
+        self.ids = {}
+
+    def link_ids(self, urls):
+        urls = set(url for url in urls if len(url) <= URL_MAX_LENGTH)
+        if not urls.issubset(self.ids):
+            self.ids = Link.objects.ids(self.newsletter.pk, urls)
+        return self.ids
+
+    def rewrite(self, html, uidb36, token, personal=None):
+        """Return the html with the tracking urls of a contact. The
+        links matching the personal regexp, by default the ones with the
+        token, are left as is."""
+        if personal is None:
+            personal = re.compile(re.escape(unicode(token)))
+        urls = [_unescape(match.group(3)) for match in HREF_RE.finditer(html)]
+        ids = self.link_ids([url for url in urls if not personal.search(url)])
+
+        def replace(match):
+            url = _unescape(match.group(3))
+            if url not in ids or personal.search(url):
+                return match.group(0)
+            tracking_url = reverse('newsletter_newsletter_tracking_link', kwargs={
+                'slug': self.newsletter.slug, 'uidb36': unicode(uidb36),
+                'token': unicode(token), 'link_id': int_to_base36(ids[url])})
+            return u'%s%shttp://%s%s%s' % (match.group(1), match.group(2),
+                                           self.domain, tracking_url,
+                                           match.group(2))
+        return HREF_RE.sub(replace, html)
+
+
+class LinkTable(object):
+    """Urls of the links of the newsletters, loaded once per newsletter
+    for the redirections. The links do not change once saved, a table
+    is only loaded again for a link it does not know, at most once in
+    ttl seconds so unknown links do not reload it on every request."""
+
+    def __init__(self, ttl=TOKEN_CACHE_TTL):
+        self.ttl = ttl
+        self.tables = {}
+
+    def url(self, newsletter_id, link_id):
+        links, loaded = self.tables.get(newsletter_id, (None, 0))
+        if links is None or (link_id not in links and
+                             time.time() - loaded >= self.ttl):
+            links = Link.objects.table(newsletter_id)
+            self.tables[newsletter_id] = (links, time.time())
+        return links.get(link_id)
+
+    def clear(self):
+        self.tables.clear()
+
+
+link_table = LinkTable()
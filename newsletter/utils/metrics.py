@@ -0,0 +1,135 @@
+"""Metrics of the SMTP mailers for dry_newsletter.newsletter"""
+import time
+import threading
+from BaseHTTPServer import HTTPServer
+from BaseHTTPServer import BaseHTTPRequestHandler
+
+from django.utils.encoding import smart_str
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# name, type, help, attribute of MailerMetrics
+METRICS = (
+    ('newsletter_messages_sent_total', 'counter',
+     'Messages accepted by the SMTP server.', 'sent'),
+    ('newsletter_messages_errors_total', 'counter',
+     'Messages failed on an SMTP or rendering error.', 'errors'),
+    ('newsletter_messages_invalid_total', 'counter',
+     'Messages refused for an invalid recipient.', 'invalid'),
+    ('newsletter_messages_retried_total', 'counter',
+     'Messages failed temporarily and planned again.', 'retries'),
+    ('newsletter_sleep_seconds', 'gauge',
+     'Seconds the mailer waits before its next message.', 'sleep_time'),
+    ('newsletter_roundrobin_size', 'gauge',
+     'Newsletters waiting for their turn in the round-robin.', 'roundrobin'),
+    ('newsletter_sending_newsletters', 'gauge',
+     'Newsletters being sent by the mailer.', 'newsletters'),
+    ('newsletter_in_flight_messages', 'gauge',
+     'Messages given to the SMTP sessions and not acknowledged yet.',
+     'in_flight'),
+    ('newsletter_credits', 'gauge',
+     'Messages the SMTP server can still send this hour.', 'credits'),
+    )
+
+
+class MailerMetrics(object):
+    """Counters and gauges of a SMTPMailer, updated by its thread and
+    read as they are by the MetricsServer. The credits are fetched at
+    most every credits_interval seconds."""
+
+    def __init__(self, server, credits_interval=30):
+        self.server_name = server.name
+        self.credits_interval = credits_interval
+        self.credits_time = 0
+        self.sent = 0
+        self.errors = 0
+        self.invalid = 0
+        self.retries = 0
+        self.sleep_time = 0.0
+        self.roundrobin = 0
+        self.newsletters = 0
+        self.in_flight = 0
+        self.credits = None
+
+    def count(self, status):
+        """Count a message with its ContactMailingStatus status, None
+        when it will be sent again"""
+        from dry_newsletter.newsletter.models import ContactMailingStatus
+        if status is None:
+            self.retries += 1
+        elif status in (ContactMailingStatus.SENT,
+                      ContactMailingStatus.SENT_TEST):
+            self.sent += 1
+        elif status == ContactMailingStatus.INVALID:
+            self.invalid += 1
+        else:
+            self.errors += 1
+
+    def update_credits(self, server):
+        now = time.time()
+        if now - self.credits_time >= self.credits_interval:
+            self.credits_time = now
+            self.credits = server.credits()
+
+
+def _label(value):
+    return smart_str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def _value(value):
+    """Format a sample, the long and Decimal sums given by some
+    databases have no valid repr for Prometheus"""
+    if isinstance(value, (int, long)):
+        return '%d' % value
+    return repr(float(value))
+
+
+def exposition(metrics):
+    """Return the metrics of the mailers in the Prometheus text format"""
+    lines = []
+    for name, kind, help, attribute in METRICS:
+        lines.append('# HELP %s %s' % (name, help))
+        lines.append('# TYPE %s %s' % (name, kind))
+        for mailer_metrics in metrics:
+            value = getattr(mailer_metrics, attribute)
+            if value is not None:
+                lines.append('%s{server="%s"} %s' % (
+                    name, _label(mailer_metrics.server_name), _value(value)))
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = exposition(self.server.metrics)
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer(HTTPServer):
+    """HTTP server giving the metrics of mailers, in a thread"""
+
+    def __init__(self, metrics, port, host='127.0.0.1'):
+        HTTPServer.__init__(self, (host, port), MetricsHandler)
+        self.metrics = metrics
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='metrics')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,115 @@
+"""Precompiled MIME messages for dry_newsletter.newsletter"""
+import re
+from email.header import Header
+from email.charset import Charset
+from email.generator import _make_boundary
+
+from django.utils.encoding import smart_str
+
+MAX_HEADER_LEN = 78
+FROM_RE = re.compile(r'^From ', re.MULTILINE)
+
+
+def _is8bitstring(value):
+    if isinstance(value, str):
+        try:
+            unicode(value, 'us-ascii')
+        except UnicodeError:
+            return True
+    return False
+
+
+def encode_header(name, value):
+    """Serialize a header line like email.generator.Generator"""
+    if isinstance(value, Header):
+        value = value.encode()
+    elif not _is8bitstring(value):
+        value = Header(value, maxlinelen=MAX_HEADER_LEN,
+                       header_name=name).encode()
+    return '%s: %s\n' % (name, value)
+
+
+class MessageSkeleton(object):
+    """The message of a newsletter serialized once, except the parts
+    depending on the contact.
+
+    It gives the same bytes as NewsLetterSender.build_message() and
+    Message.as_string() would, with the multipart boundaries chosen
+    once for the newsletter. Only the Subject and To headers and the
+    encoded bodies are written per contact."""
+
+    def __init__(self, header_sender, header_reply, custom_headers):
+        self.charset = Charset('UTF-8')
+        self.mixed = _make_boundary()
+        self.alternative = _make_boundary()
+
+        self.head = ''.join([
+            encode_header('Content-Type',
+                          'multipart/mixed; boundary="%s"' % self.mixed),
+            encode_header('MIME-Version', '1.0')])
+        self.senders = ''.join([
+            encode_header('From', smart_str(header_sender)),
+            encode_header('Reply-to', smart_str(header_reply))])
+        self.body_head = ''.join(
+            [encode_header(header, value)
+             for header, value in custom_headers.items()] +
+            ['\n--%s\n' % self.mixed,
+             encode_header('Content-Type', 'multipart/alternative; '
+                           'boundary="%s"' % self.alternative),
+             encode_header('MIME-Version', '1.0'),
+             '\n--%s\n' % self.alternative])
+        self.text_head = self.part_head('plain')
+        self.html_head = self.part_head('html')
+        self.separator = '\n--%s\n' % self.alternative
+        self.alternative_end = '\n--%s--\n' % self.alternative
+        self.part_separator = '\n--%s\n' % self.mixed
+        self.end = '\n--%s--\n' % self.mixed
+
+    def part_head(self, subtype):
+        return ''.join([
+            encode_header('MIME-Version', '1.0'),
+            encode_header('Content-Type', 'text/%s; charset="%s"' % (
+                subtype, self.charset.get_output_charset()))])
+
+    def encode_body(self, payload):
+        """Return the Content-Transfer-Encoding header and the payload
+        encoded like MIMEText does"""
+        encoding = self.charset.get_body_encoding()
+        if isinstance(encoding, basestring):
+            payload = self.charset.body_encode(payload)
+        else:
+            try:
+                payload.decode('ascii')
+            except UnicodeError:
+                encoding = '8bit'
+            else:
+                encoding = '7bit'
+        return (encode_header('Content-Transfer-Encoding', encoding) + '\n',
+                FROM_RE.sub('>From ', payload))
+
+    def render(self, subject, to, content_text, content_html, attachments=()):
+        """Return the message as a string, or None when a content
+        contains a boundary and the message must be built as usual.
+        attachments are MIME parts already serialized."""
+        content_text = smart_str(content_text)
+        content_html = smart_str(content_html)
+        for boundary in (self.mixed, self.alternative):
+            if boundary in content_text or boundary in content_html:
+                return None
+
+        text_encoding, text = self.encode_body(content_text)
+        html_encoding, html = self.encode_body(content_html)
+        out = [self.head,
+               encode_header('Subject', subject),
+               self.senders,
+               encode_header('To', to),
+               self.body_head,
+               self.text_head, text_encoding, text,
+               self.separator,
+               self.html_head, html_encoding, html,
+               self.alternative_end]
+        for attachment in attachments:
+            out.append(self.part_separator)
+            out.append(attachment)
+        out.append(self.end)
+        return ''.join(out)
@@ -0,0 +1,68 @@
+"""Sending pace of the SMTP servers for dry_newsletter.newsletter"""
+import time
+import threading
+
+from dry_newsletter.newsletter.settings import PACING_BURST
+
+
+class Pacer(object):
+    """Spread the messages of a SMTPServer over time.
+
+    It implements the generic cell rate algorithm: each message pushes
+    the theoretical arrival time of the next one by interval seconds,
+    and a message can go as long as it is not more than burst - 1
+    intervals ahead of the schedule. As the schedule does not depend
+    on the time taken by the sendings, the SMTP round-trips are
+    absorbed and the sustained rate is the mails_hour of the server."""
+
+    def __init__(self, interval, burst=PACING_BURST):
+        self.lock = threading.Lock()
+        self.theoretical_arrival = 0.0
+        self.configure(interval, burst)
+
+    def configure(self, interval, burst=PACING_BURST):
+        """Change the interval between messages and the burst size"""
+        self.interval = interval
+        self.burst = max(burst, 1)
+        self.tolerance = interval * (self.burst - 1)
+
+    def wait_time(self, now=None):
+        """Seconds to wait before a message can be sent"""
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            return max(self.theoretical_arrival - self.tolerance - now, 0.0)
+        finally:
+            self.lock.release()
+
+    def consume(self, now=None):
+        """Account a message sent"""
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            self.theoretical_arrival = max(self.theoretical_arrival,
+                                           now) + self.interval
+        finally:
+            self.lock.release()
+
+
+_pacers = {}
+_pacers_lock = threading.Lock()
+
+
+def get_pacer(server, minimum=0.0):
+    """Return the pacer shared by the mailers of a server, following
+    its current mails_hour. minimum is a floor for the interval."""
+    interval = max(server.delay(), minimum)
+    _pacers_lock.acquire()
+    try:
+        pacer = _pacers.get(server.pk)
+        if pacer is None:
+            pacer = _pacers[server.pk] = Pacer(interval)
+        elif pacer.interval != interval:
+            pacer.configure(interval)
+        return pacer
+    finally:
+        _pacers_lock.release()
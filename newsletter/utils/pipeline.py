@@ -0,0 +1,121 @@
+"""Multi-process rendering of messages for dry_newsletter.newsletter"""
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing import TimeoutError
+
+from django.db import connection
+
+from dry_newsletter.newsletter.models import Contact
+from dry_newsletter.newsletter.models import Newsletter
+from dry_newsletter.newsletter.utils.stats import stats
+from dry_newsletter.newsletter.settings import RENDER_TIMEOUT
+from dry_newsletter.newsletter.settings import RENDER_PROCESSES
+from dry_newsletter.newsletter.settings import RENDER_CHUNK_SIZE
+from dry_newsletter.newsletter.settings import RENDER_QUEUE_SIZE
+
+_senders = {}
+
+
+def render_chunk(task):
+    """Build the messages of a chunk of contacts, in a worker process
+
+    Return a list of (contact_id, envelope, exception)"""
+    from dry_newsletter.newsletter.mailer import NewsLetterSender
+
+    newsletter_id, test, contact_ids = task
+    sender = _senders.get((newsletter_id, test))
+    if sender is None:
+        newsletter = Newsletter.objects.get(pk=newsletter_id)
+        sender = _senders[(newsletter_id, test)] = NewsLetterSender(
+            newsletter, test=test)
+
+    contacts = Contact.objects.in_bulk(contact_ids)
+    rendered = []
+    for contact_id in contact_ids:
+        contact = contacts.get(contact_id)
+        if contact is None:
+            continue
+        try:
+            envelope = sender.build_envelope(contact)
+        except Exception, e:
+            rendered.append((contact_id, None, e))
+        else:
+            rendered.append((contact_id, envelope, None))
+    return rendered
+
+
+class RenderPipeline(object):
+    """Render the messages of a NewsLetterSender in a pool of processes
+
+    The contacts are split in chunks of chunk_size, rendered and
+    serialized by the worker processes. At most queue_size chunks are
+    rendered ahead of the consumer, so a slow SMTP server holds back the
+    rendering and the memory stays bounded."""
+
+    def __init__(self, sender, processes=RENDER_PROCESSES,
+                 chunk_size=RENDER_CHUNK_SIZE, queue_size=RENDER_QUEUE_SIZE,
+                 timeout=RENDER_TIMEOUT):
+        self.sender = sender
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.queue_size = max(queue_size, processes)
+        self.timeout = timeout
+
+    def chunks(self, contacts):
+        chunk = []
+        for contact in contacts:
+            chunk.append(contact)
+            if len(chunk) >= self.chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    def envelopes(self, contacts):
+        """iterator on (contact, envelope, exception) in contacts order"""
+        newsletter_id = self.sender.newsletter.pk
+        test = self.sender.test
+
+        # the workers must not share the database connection
+        connection.close()
+        pool = Pool(self.processes)
+        try:
+            pending = deque()
+            chunks = self.chunks(contacts)
+            for chunk in chunks:
+                pending.append((chunk, pool.apply_async(
+                    render_chunk,
+                    ((newsletter_id, test, [c.pk for c in chunk]),))))
+                if len(pending) >= self.queue_size:
+                    break
+
+            while pending:
+                chunk, result = pending.popleft()
+                for chunk_ahead in chunks:
+                    pending.append((chunk_ahead, pool.apply_async(
+                        render_chunk,
+                        ((newsletter_id, test, [c.pk for c in chunk_ahead]),))))
+                    break
+
+                try:
+                    with stats.timer('render_wait'):
+                        rendered = result.get(self.timeout)
+                    rendered = dict((contact_id, (envelope, exception))
+                                    for contact_id, envelope, exception
+                                    in rendered)
+                except TimeoutError:
+                    rendered = {}
+                    failure = TimeoutError('Rendering timed out')
+                except Exception, e:
+                    rendered = {}
+                    failure = e
+                else:
+                    failure = LookupError('Contact not found')
+
+                for contact in chunk:
+                    envelope, exception = rendered.get(contact.pk,
+                                                       (None, failure))
+                    yield contact, envelope, exception
+        finally:
+            pool.terminate()
+            pool.join()
@@ -0,0 +1,200 @@
+"""SMTP connection pool for dry_newsletter.newsletter"""
+import time
+import socket
+import threading
+from smtplib import SMTPException
+from smtplib import SMTPServerDisconnected
+
+from dry_newsletter.newsletter.settings import SMTP_POOL_SIZE
+from dry_newsletter.newsletter.settings import SMTP_POOL_MAX_AGE
+from dry_newsletter.newsletter.settings import SMTP_POOL_MAX_MESSAGES
+from dry_newsletter.newsletter.settings import SMTP_POOL_NOOP_INTERVAL
+from dry_newsletter.newsletter.settings import SMTP_POOL_TIMEOUT
+
+
+class PooledConnection(object):
+    """Authenticated SMTP session lent by a SMTPConnectionPool.
+
+    It can be used like a smtplib.SMTP by the mailers, except that
+    quit() gives the session back to the pool instead of closing it."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.smtp = None
+        self.messages = 0
+        self.created = 0
+        self.last_used = 0
+        self.released = False
+
+    def connect(self):
+        """Open a new session, dropping the current one if any"""
+        self.close()
+        self.smtp = self.pool.server.connect()
+        self.messages = 0
+        self.created = self.last_used = time.time()
+
+    def close(self):
+        """Really close the session"""
+        if self.smtp is None:
+            return
+        try:
+            self.smtp.quit()
+        except (SMTPException, socket.error):
+            self.smtp.close()
+        self.smtp = None
+
+    @property
+    def expired(self):
+        """Check if the session should be recycled"""
+        if self.smtp is None:
+            return True
+        if self.pool.max_messages and \
+               self.messages >= self.pool.max_messages:
+            return True
+        if self.pool.max_age and \
+               time.time() - self.created >= self.pool.max_age:
+            return True
+        return False
+
+    def is_alive(self):
+        """Check with a NOOP a session which was idle for a while"""
+        if time.time() - self.last_used < self.pool.noop_interval:
+            return True
+        try:
+            return self.smtp.noop()[0] == 250
+        except (SMTPException, socket.error):
+            return False
+
+    def sendmail(self, *ka, **kw):
+        """Send a mail, reconnecting once if the server has dropped us"""
+        try:
+            result = self.smtp.sendmail(*ka, **kw)
+        except SMTPServerDisconnected:
+            self.connect()
+            result = self.smtp.sendmail(*ka, **kw)
+        self.messages += 1
+        self.last_used = time.time()
+        return result
+
+    def quit(self):
+        """Give the session back to the pool"""
+        if not self.released:
+            self.pool.release(self)
+
+
+class SMTPConnectionPool(object):
+    """Keep several authenticated sessions alive for a SMTPServer.
+
+    At most size sessions are lent at the same time, acquire()
+    blocks until one is released, for timeout seconds. Sessions are recycled after
+    max_messages mails or max_age seconds, and checked with a NOOP
+    when they were idle more than noop_interval seconds."""
+
+    def __init__(self, server, size=SMTP_POOL_SIZE,
+                 max_messages=SMTP_POOL_MAX_MESSAGES,
+                 max_age=SMTP_POOL_MAX_AGE,
+                 noop_interval=SMTP_POOL_NOOP_INTERVAL,
+                 timeout=SMTP_POOL_TIMEOUT):
+        self.server = server
+        self.size = size
+        self.max_messages = max_messages
+        self.max_age = max_age
+        self.noop_interval = noop_interval
+        self.timeout = timeout
+        self.idle = []
+        self.in_use = 0
+        self.condition = threading.Condition(threading.Lock())
+
+    def acquire(self):
+        """Return a connected PooledConnection"""
+        deadline = time.time() + self.timeout
+        self.condition.acquire()
+        try:
+            while not self.idle and self.size and self.in_use >= self.size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise SMTPException('No SMTP session released in %s '
+                                        'seconds.' % self.timeout)
+                self.condition.wait(remaining)
+            connection = self.idle and self.idle.pop() or None
+            self.in_use += 1
+        finally:
+            self.condition.release()
+
+        try:
+            if connection is None:
+                connection = PooledConnection(self)
+                connection.connect()
+            elif connection.expired or not connection.is_alive():
+                connection.connect()
+        except:
+            self.condition.acquire()
+            self.in_use -= 1
+            self.condition.notify()
+            self.condition.release()
+            raise
+        connection.released = False
+        return connection
+
+    def release(self, connection):
+        """Put back a connection in the pool"""
+        connection.released = True
+        if connection.expired:
+            connection.close()
+
+        self.condition.acquire()
+        try:
+            self.in_use -= 1
+            if connection.smtp is not None:
+                self.idle.append(connection)
+            self.condition.notify()
+        finally:
+            self.condition.release()
+
+    def close(self):
+        """Close all the idle sessions"""
+        self.condition.acquire()
+        try:
+            idle, self.idle = self.idle, []
+        finally:
+            self.condition.release()
+        for connection in idle:
+            connection.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _settings(server):
+    return (server.host, server.port, server.user, server.password, server.tls)
+
+
+def get_pool(server):
+    """Return the connection pool shared by the mailers of a server"""
+    _pools_lock.acquire()
+    try:
+        pool = _pools.get(server.pk)
+        if pool is None:
+            pool = _pools[server.pk] = SMTPConnectionPool(server)
+            return pool
+        changed = _settings(pool.server) != _settings(server)
+        pool.server = server
+    finally:
+        _pools_lock.release()
+
+    if changed:
+        # the idle sessions are logged in elsewhere
+        pool.close()
+    return pool
+
+
+def close_pools():
+    """Close the idle sessions of every pool"""
+    _pools_lock.acquire()
+    try:
+        pools = _pools.values()
+    finally:
+        _pools_lock.release()
+    for pool in pools:
+        pool.close()
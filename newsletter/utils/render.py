@@ -0,0 +1,303 @@
+"""Render plans for dry_newsletter.newsletter"""
+import re
+import random
+from itertools import izip
+from StringIO import StringIO
+
+from html2text import HTML2Text
+from html2text.config import RE_MD_BACKSLASH_MATCHER
+from html2text.utils import escape_md_section
+from django.conf import settings
+from django.template import Context
+from django.template import Variable
+from django.template import VariableDoesNotExist
+from django.template.base import Node
+from django.template.base import NodeList
+from django.template.base import VariableNode
+from django.template.base import FilterExpression
+from django.template.base import _render_value_in_context
+from django.template.defaulttags import URLNode
+from django.template.defaulttags import AutoEscapeControlNode
+from django.template.loader_tags import ExtendsNode
+from django.template.loader_tags import IncludeNode
+from django.template.loader_tags import ConstantIncludeNode
+from django.utils.encoding import force_unicode
+from django.utils.formats import localize
+
+from dry_newsletter.newsletter.settings import TRACKING_IMAGE_FORMAT
+
+LINK_RE = re.compile(r"https?://([^ \n]+\n)+[^ \n]+", re.MULTILINE)
+SPACES_RE = re.compile(r'\s+')
+# html2text escapes the dashes starting a line and the backslashes, but
+# not in the urls or the code, the escapes found tell where a token is
+ESCAPE_PROBE = ur'--\-'
+ESCAPE_PROBES = ((ur'\--\\-', 'line'), (ur'--\\-', 'inline'),
+                 (ESCAPE_PROBE, None))
+TRACKING_IMAGE_RE = re.compile(r'<img [^>]*src="[^"]*/tracking/[^"]+\.%s"[^>]*>'
+                               % re.escape(TRACKING_IMAGE_FORMAT))
+
+def html2text(html):
+    """Use html2text but repair newlines cutting urls.
+    Need to use this hack until
+    https://github.com/aaronsw/html2text/issues/#issue/7 is not fixed
+
+    The lines are not wrapped, the wrapping would depend on the length
+    of the contact values and the text of a render plan would differ.
+    The tracking image is left out, it is only fetched from the HTML."""
+    converter = HTML2Text()
+    converter.body_width = 0
+    txt = converter.handle(TRACKING_IMAGE_RE.sub('', html))
+    links = list(LINK_RE.finditer(txt))
+    out = StringIO()
+    pos = 0
+    for l in links:
+        out.write(txt[pos:l.start()])
+        out.write(l.group().replace('\n', ''))
+        pos = l.end()
+    out.write(txt[pos:])
+    return out.getvalue()
+
+
+SLOTS = ('contact', 'uidb36', 'token')
+URL_SLOTS = (('uidb36',), ('token',))
+
+
+def escape_text(value, following, escape):
+    """Escape a text value as html2text would, following being the
+    text after the value on its line, as the escapes look ahead"""
+    if escape is None:
+        return value
+    text = value + following
+    if escape == 'line':
+        text = escape_md_section(text)
+    else:
+        text = RE_MD_BACKSLASH_MATCHER.sub(r'\\\1', text)
+    return text[:len(text) - len(following)]
+
+
+def _expressions(value, depth=0):
+    """Find the FilterExpression and Variable used by a node"""
+    if depth > 5 or isinstance(value, (Node, NodeList, basestring)):
+        return
+    if isinstance(value, (FilterExpression, Variable)):
+        yield value
+    elif isinstance(value, dict):
+        for item in value.values():
+            for expression in _expressions(item, depth + 1):
+                yield expression
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            for expression in _expressions(item, depth + 1):
+                yield expression
+    elif hasattr(value, '__dict__') and not callable(value):
+        for item in vars(value).values():
+            for expression in _expressions(item, depth + 1):
+                yield expression
+
+
+def _uses_slots(expression):
+    """Check if an expression reads a per-contact variable"""
+    if isinstance(expression, Variable):
+        return bool(expression.lookups) and expression.lookups[0] in SLOTS
+    if isinstance(expression.var, Variable) and _uses_slots(expression.var):
+        return True
+    for func, args in expression.filters:
+        for lookup, arg in args:
+            if lookup and _uses_slots(arg):
+                return True
+    return False
+
+
+def _lookups(expression):
+    if isinstance(expression.var, Variable):
+        return expression.var.lookups
+
+
+class Marker(object):
+    """Stand-in for a per-contact value while the plan is rendered.
+
+    It renders as a token which is replaced later by the contact
+    value. Any other use of the value, like a test in {% if %}, makes
+    the plan unusable."""
+
+    def __init__(self, plan, path):
+        self._plan = plan
+        self._path = path
+        self._children = {}
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        marker = self._children.get(name)
+        if marker is None:
+            marker = self._children[name] = Marker(
+                self._plan, '%s.%s' % (self._path, name))
+        return marker
+
+    def __unicode__(self):
+        return self._plan.token(self._path)
+
+    __str__ = __unicode__
+
+    def _unsafe(self, *ka):
+        self._plan.usable = False
+        return False
+
+    __nonzero__ = __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = \
+        __contains__ = _unsafe
+
+    def __len__(self):
+        self._plan.usable = False
+        return 0
+
+    def __iter__(self):
+        self._plan.usable = False
+        return iter([])
+
+
+class RenderPlan(object):
+    """A template rendered once for a newsletter, leaving slots for
+    the contact, uidb36 and token variables.
+
+    The template is checked to only print these variables, without
+    filters, or to give uidb36 and token to {% url %}. Then it is
+    rendered with markers in their place and split around them, for
+    the HTML and for the text version. Rendering for a contact is then
+    only joining the static segments with the escaped contact values.
+
+    rewrite, when given, is called with the rendered HTML, the uidb36
+    and token markers and a regexp of the markers, and returns the HTML
+    to split, for rewriting the links once for all the contacts.
+
+    The text values are escaped for markdown as html2text does where
+    they are, found with a render of the tokens preceded by a probe.
+
+    When usable is False, the template must be rendered as usual."""
+
+    def __init__(self, template, context, rewrite=None):
+        self.template = template
+        self.rewrite = rewrite
+        self.variables = []
+        self.paths = {}
+        self.nonce = '%06d' % random.randint(0, 999999)
+        self.token_re = re.compile(r'zQ%sS(\d+)Qz' % self.nonce)
+        self.usable = self.check(template.nodelist)
+        if self.usable:
+            self.compile(context)
+
+    def check(self, nodelist):
+        """Check if all the nodes use the slots in a way we can splice"""
+        for node in nodelist.get_nodes_by_type(Node):
+            if isinstance(node, (AutoEscapeControlNode, ExtendsNode,
+                                 IncludeNode)):
+                return False
+            elif isinstance(node, ConstantIncludeNode):
+                if node.template is None or \
+                       not self.check(node.template.nodelist):
+                    return False
+            elif isinstance(node, VariableNode):
+                expression = node.filter_expression
+                if _uses_slots(expression) and expression.filters:
+                    return False
+            elif isinstance(node, URLNode):
+                for expression in node.args + node.kwargs.values():
+                    if _uses_slots(expression) and (
+                        expression.filters or
+                        _lookups(expression) not in URL_SLOTS):
+                        return False
+                if not node.legacy_view_name and \
+                       _uses_slots(node.view_name):
+                    return False
+            else:
+                for expression in _expressions(vars(node)):
+                    if _uses_slots(expression):
+                        return False
+        return True
+
+    def token(self, path):
+        """Return the token standing for a variable path"""
+        index = self.paths.get(path)
+        if index is None:
+            index = self.paths[path] = len(self.variables)
+            self.variables.append(Variable(path))
+        return u'zQ%sS%dQz' % (self.nonce, index)
+
+    def split(self, content):
+        parts = self.token_re.split(content)
+        return parts[0::2], [int(index) for index in parts[1::2]]
+
+    def compile(self, context):
+        context = dict(context)
+        for slot in SLOTS:
+            context[slot] = Marker(self, slot)
+        self.context = Context(context)
+
+        html = force_unicode(self.template.render(self.context))
+        if not self.usable:
+            return
+        if self.rewrite is not None:
+            html = self.rewrite(html, context['uidb36'], context['token'],
+                                self.token_re)
+        self.html = self.split(html)
+        self.text = self.split(force_unicode(html2text(html)))
+        self.escapes = self.find_escapes(html)
+
+        # every value rendered must be found back
+        if set(self.html[1]) != set(range(len(self.variables))) or \
+               self.escapes is None:
+            self.usable = False
+
+    def find_escapes(self, html):
+        """Return how each token of the text is escaped by html2text,
+        or None if it is not found back after the probes"""
+        probed = self.token_re.sub(lambda match: ESCAPE_PROBE + match.group(),
+                                   html)
+        segments, indexes = self.split(force_unicode(html2text(probed)))
+        if indexes != self.text[1]:
+            return None
+        escapes = []
+        for segment in segments[:-1]:
+            for probe, escape in ESCAPE_PROBES:
+                if segment.endswith(probe):
+                    escapes.append(escape)
+                    break
+            else:
+                return None
+        return escapes
+
+    def resolve(self, values):
+        """Return the values of the slots, for the HTML and the text"""
+        html, text = [], []
+        for variable in self.variables:
+            try:
+                value = variable.resolve(values)
+            except VariableDoesNotExist:
+                value = settings.TEMPLATE_STRING_IF_INVALID
+            html.append(_render_value_in_context(value, self.context))
+            # html2text collapses the whitespace of the HTML
+            text.append(SPACES_RE.sub(u' ', force_unicode(localize(value))))
+        return html, text
+
+    def join(self, parts, values):
+        segments, indexes = parts
+        out = [segments[0]]
+        for index, segment in izip(indexes, segments[1:]):
+            out.append(values[index])
+            out.append(segment)
+        return u''.join(out)
+
+    def join_text(self, values):
+        segments, indexes = self.text
+        out = [segments[0]]
+        for index, segment, escape in izip(indexes, segments[1:],
+                                           self.escapes):
+            out.append(escape_text(values[index], segment.split('\n', 1)[0],
+                                   escape))
+            out.append(segment)
+        return u''.join(out)
+
+    def render(self, values):
+        """Return the HTML and text contents for a contact, values
+        giving the contact, uidb36 and token"""
+        html, text = self.resolve(values)
+        return self.join(self.html, html), self.join_text(text)
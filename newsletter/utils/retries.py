@@ -0,0 +1,16 @@
+"""Classification of the sending failures for dry_newsletter.newsletter"""
+import socket
+from smtplib import SMTPResponseException
+from smtplib import SMTPRecipientsRefused
+from smtplib import SMTPServerDisconnected
+
+
+def is_transient(exception):
+    """Check if a failure is temporary and the message worth sending
+    again later: 4xx replies, disconnections and timeouts"""
+    if isinstance(exception, SMTPRecipientsRefused):
+        codes = [code for code, message in exception.recipients.values()]
+        return bool(codes) and all(400 <= code < 500 for code in codes)
+    if isinstance(exception, SMTPResponseException):
+        return 400 <= exception.smtp_code < 500
+    return isinstance(exception, (SMTPServerDisconnected, socket.error))
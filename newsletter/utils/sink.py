@@ -0,0 +1,49 @@
+"""Local SMTP sink for dry_newsletter.newsletter"""
+import time
+import smtpd
+import asyncore
+import threading
+from array import array
+
+
+class SMTPSink(smtpd.SMTPServer):
+    """SMTP server accepting and discarding every message.
+
+    It runs its asyncore loop in a thread, so tests and benchmarks
+    can point a SMTPServer to host:port and send real messages. The
+    arrival time of each message is kept, and its recipients unless
+    record_recipients is False."""
+
+    def __init__(self, host='127.0.0.1', port=0, record_recipients=True):
+        smtpd.SMTPServer.__init__(self, (host, port), None)
+        self.host, self.port = self.socket.getsockname()
+        self.record_recipients = record_recipients
+        self.received = 0
+        self.recipients = []
+        self.arrivals = array('d')
+        self.running = False
+        self.thread = None
+
+    def process_message(self, peer, mailfrom, rcpttos, data):
+        self.received += 1
+        self.arrivals.append(time.time())
+        if self.record_recipients:
+            self.recipients.extend(rcpttos)
+
+    def start(self):
+        """Serve in a thread"""
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, name='smtp-sink')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while self.running:
+            asyncore.loop(timeout=0.05, count=1)
+
+    def stop(self):
+        """Stop serving and close every connection"""
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        asyncore.close_all()
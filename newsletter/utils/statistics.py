@@ -0,0 +1,96 @@
+"""Statistics of the newsletters for dry_newsletter.newsletter
+
+Everything is read from the StatusCount rollups and the clicks of the
+links, never from the ContactMailingStatus, so the cost does not grow
+with the number of messages sent."""
+from datetime import timedelta
+
+from django.utils.translation import ugettext as _
+
+from dry_newsletter.newsletter.models import Link
+from dry_newsletter.newsletter.models import StatusCount
+from dry_newsletter.newsletter.models import ContactMailingStatus
+from dry_newsletter.newsletter.utils.ofc import Chart
+
+# statuses of the contacts acting on a newsletter, with their colour
+ACTIVITY_STATUSES = ((ContactMailingStatus.OPENED, '#3366cc'),
+                     (ContactMailingStatus.OPENED_ON_SITE, '#66aaff'),
+                     (ContactMailingStatus.LINK_OPENED, '#339933'),
+                     (ContactMailingStatus.UNSUBSCRIPTION, '#cc3333'))
+
+
+def percentage(part, total):
+    if not total:
+        return 0.0
+    return round(100.0 * part / total, 2)
+
+
+def get_newsletter_statistics(newsletter):
+    """Return the totals and the rates of a newsletter"""
+    totals = StatusCount.objects.totals(newsletter)
+    sent = totals.get(ContactMailingStatus.SENT, 0)
+    openings = totals.get(ContactMailingStatus.OPENED, 0)
+    on_site_openings = totals.get(ContactMailingStatus.OPENED_ON_SITE, 0)
+    clicks = totals.get(ContactMailingStatus.LINK_OPENED, 0)
+    unsubscriptions = totals.get(ContactMailingStatus.UNSUBSCRIPTION, 0)
+    return {'mails_sent': sent,
+            'tests_sent': totals.get(ContactMailingStatus.SENT_TEST, 0),
+            'errors': totals.get(ContactMailingStatus.ERROR, 0),
+            'invalids': totals.get(ContactMailingStatus.INVALID, 0),
+            'total_openings': openings,
+            'total_on_site_openings': on_site_openings,
+            'total_clicked_links': clicks,
+            'total_unsubscriptions': unsubscriptions,
+            'openings_percent': percentage(openings + on_site_openings, sent),
+            'clicked_links_percent': percentage(clicks, sent),
+            'unsubscriptions_percent': percentage(unsubscriptions, sent)}
+
+
+def get_newsletter_top_links(newsletter, limit=10):
+    """Return the most clicked links of a newsletter"""
+    links = Link.objects.filter(newsletter=newsletter, clicks__gt=0).order_by(
+        '-clicks')[:limit]
+    return [{'link': link, 'total_clicks': link.clicks} for link in links]
+
+
+def get_newsletter_activity(newsletter):
+    """Return the days of activity on a newsletter and the counts of
+    each activity status for these days"""
+    counts = StatusCount.objects.filter(
+        newsletter=newsletter,
+        status__in=[status for status, colour in ACTIVITY_STATUSES]).values_list(
+        'status', 'hour', 'count')
+    days = {}
+    for status, hour, count in counts:
+        day = days.setdefault(hour.date(), {})
+        day[status] = day.get(status, 0) + count
+    if not days:
+        return [], {}
+
+    first, last = min(days), max(days)
+    dates = [first + timedelta(days=i) for i in range((last - first).days + 1)]
+    series = dict((status, [days.get(date, {}).get(status, 0) for date in dates])
+                  for status, colour in ACTIVITY_STATUSES)
+    return dates, series
+
+
+def get_newsletter_chart(newsletter):
+    """Return the Chart of the activity on a newsletter by day"""
+    dates, series = get_newsletter_activity(newsletter)
+    labels = dict(ContactMailingStatus.STATUS_CHOICES)
+
+    chart = Chart()
+    chart.title.text = _('Activity on %s') % newsletter.title
+    chart.title.style = '{font-size: 16px; color: #666666; text-align: center; font-weight: bold;}'
+    chart.elements = [Chart(type='line', text=unicode(labels[status]),
+                            colour=colour, values=series.get(status, []),
+                            dot_style={'type': 'dot'})
+                      for status, colour in ACTIVITY_STATUSES]
+
+    maximum = max([max(values) for values in series.values()] + [1])
+    chart.y_axis = {'min': 0, 'max': maximum, 'steps': max(maximum / 10, 1),
+                    'colour': '#909090', 'grid-colour': '#ededed'}
+    chart.x_axis = {'colour': '#909090', 'grid-colour': '#ededed',
+                    'labels': {'labels': [date.strftime('%d/%m') for date in dates],
+                               'rotate': 60}}
+    return chart
@@ -0,0 +1,125 @@
+"""Timing statistics of the sendings for dry_newsletter.newsletter"""
+import time
+import threading
+from array import array
+
+
+class Histogram(object):
+    """Durations counted in buckets of powers of two microseconds"""
+
+    def __init__(self):
+        self.buckets = [0] * 64
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        index = min(int(seconds * 1000000).bit_length(), 63)
+        self.buckets[index] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, ratio):
+        """Upper bound in seconds of the ratio fastest durations"""
+        rank = ratio * self.count
+        seen = 0
+        for index, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(float(2 ** index) / 1000000, self.max)
+        return self.max
+
+
+class Timer(object):
+    """Context manager recording its duration in a stage"""
+
+    def __init__(self, stats, stage):
+        self.stats = stats
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+
+    def __exit__(self, *exc_info):
+        self.stats.record(self.stage, time.time() - self.start)
+
+
+class NullTimer(object):
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+NULL_TIMER = NullTimer()
+
+
+class Stats(object):
+    """Histograms of the durations of the stages of the sendings.
+
+    Nothing is recorded until enable() is called, the timers are then
+    shared by every thread of the process."""
+
+    def __init__(self):
+        self.enabled = False
+        self.histograms = {}
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def enable(self):
+        self.enabled = True
+
+    def keep_samples(self, stage):
+        """Keep the exact durations of a stage in samples, besides its
+        histogram"""
+        self.lock.acquire()
+        try:
+            self.samples[stage] = array('d')
+        finally:
+            self.lock.release()
+
+    def timer(self, stage):
+        """Return a context manager timing a stage"""
+        if not self.enabled:
+            return NULL_TIMER
+        return Timer(self, stage)
+
+    def record(self, stage, seconds):
+        """Record the duration of a stage"""
+        if not self.enabled:
+            return
+        self.lock.acquire()
+        try:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.add(seconds)
+            samples = self.samples.get(stage)
+            if samples is not None:
+                samples.append(seconds)
+        finally:
+            self.lock.release()
+
+    def report(self):
+        """Return a summary of the stages as a table"""
+        lines = ['%-12s %9s %10s %9s %9s %9s %9s' % (
+            'stage', 'count', 'total s', 'mean ms', 'p50 ms', 'p99 ms',
+            'max ms')]
+        self.lock.acquire()
+        try:
+            for stage, histogram in sorted(self.histograms.items()):
+                lines.append('%-12s %9d %10.3f %9.3f %9.3f %9.3f %9.3f' % (
+                    stage, histogram.count, histogram.total,
+                    histogram.total / histogram.count * 1000,
+                    histogram.percentile(0.5) * 1000,
+                    histogram.percentile(0.99) * 1000,
+                    histogram.max * 1000))
+        finally:
+            self.lock.release()
+        return '\n'.join(lines)
+
+
+stats = Stats()
@@ -0,0 +1,77 @@
+"""Write-behind of the mailing statuses for dry_newsletter.newsletter"""
+import time
+import threading
+
+from django.db import transaction
+from django.utils import timezone
+
+from dry_newsletter.newsletter.models import Contact
+from dry_newsletter.newsletter.models import ContactMailingStatus
+from dry_newsletter.newsletter.signals import statuses_created
+from dry_newsletter.newsletter.utils.stats import stats
+from dry_newsletter.newsletter.settings import STATUS_BATCH_SIZE
+from dry_newsletter.newsletter.settings import STATUS_FLUSH_INTERVAL
+
+
+class StatusWriter(object):
+    """Buffer the ContactMailingStatus of the sent messages and write
+    them with bulk inserts, every size statuses or interval seconds.
+
+    Contacts with an INVALID status are marked as not valid in the
+    same transaction. flush() must be called once the sending is done,
+    nothing is written before."""
+
+    def __init__(self, size=STATUS_BATCH_SIZE, interval=STATUS_FLUSH_INTERVAL):
+        self.size = size
+        self.interval = interval
+        self.statuses = []
+        self.invalid_contacts = set()
+        self.lock = threading.Lock()
+        self.last_flush = time.time()
+
+    def add(self, newsletter, contact, status, server=None):
+        """Record the status of a message, and the server which sent
+        it when it is not the one of the newsletter"""
+        self.lock.acquire()
+        try:
+            self.statuses.append(ContactMailingStatus(
+                newsletter=newsletter, contact=contact, status=status,
+                server=server))
+            if status == ContactMailingStatus.INVALID:
+                self.invalid_contacts.add(contact.pk)
+            should_flush = (len(self.statuses) >= self.size or
+                            time.time() - self.last_flush >= self.interval)
+        finally:
+            self.lock.release()
+
+        if should_flush:
+            self.flush()
+
+    def flush(self):
+        """Write the buffered statuses"""
+        self.lock.acquire()
+        try:
+            statuses, self.statuses = self.statuses, []
+            invalid_contacts, self.invalid_contacts = self.invalid_contacts, set()
+            self.last_flush = time.time()
+
+            if not statuses:
+                return
+            try:
+                with stats.timer('status'):
+                    self.write(statuses, invalid_contacts)
+            except:
+                # keep them for the next try
+                self.statuses[:0] = statuses
+                self.invalid_contacts |= invalid_contacts
+                raise
+        finally:
+            self.lock.release()
+
+    @transaction.commit_on_success
+    def write(self, statuses, invalid_contacts):
+        if invalid_contacts:
+            Contact.objects.filter(pk__in=invalid_contacts).update(
+                valid=False, modification_date=timezone.now())
+        ContactMailingStatus.objects.bulk_create(statuses)
+        statuses_created.send(sender=ContactMailingStatus, statuses=statuses)
@@ -1,32 +1,124 @@
 """Tokens system for dry_newsletter.newsletter"""
+import copy
+import hmac
+import time
+import threading
+from hashlib import sha1
+from collections import OrderedDict
+
 from django.conf import settings
 from django.http import Http404
+from django.db.models.signals import post_save
+from django.db.models.signals import post_delete
+from django.utils.crypto import constant_time_compare
+from django.utils.encoding import smart_str
 from django.utils.http import int_to_base36, base36_to_int
 
 from dry_newsletter.newsletter.models import Contact
+from dry_newsletter.newsletter.settings import TOKEN_LEGACY
+from dry_newsletter.newsletter.settings import TOKEN_CACHE_SIZE
+from dry_newsletter.newsletter.settings import TOKEN_CACHE_TTL
+
+KEY_SALT = 'dry_newsletter.newsletter.utils.tokens.ContactTokenGenerator'
 
 
 class ContactTokenGenerator(object):
     """ContactTokengenerator for the newsletter
     based on the PasswordResetTokenGenerator bundled
-    in django.contrib.auth"""
+    in django.contrib.auth
+
+    The tokens are HMAC-SHA1 of the contact id and email, the keyed
+    state being computed once and copied for each token. The tokens
+    made by the plain SHA1 of the previous versions are still accepted
+    when NEWSLETTER_TOKEN_LEGACY is set."""
+
+    def __init__(self):
+        self.secret = None
+        self.hmac = None
+
+    def keyed_hmac(self):
+        """Return a copy of the HMAC already fed with the key"""
+        if self.secret != settings.SECRET_KEY:
+            key = sha1(KEY_SALT + settings.SECRET_KEY).digest()
+            self.hmac = hmac.new(key, digestmod=sha1)
+            self.secret = settings.SECRET_KEY
+        return self.hmac.copy()
 
     def make_token(self, contact):
         """Method for generating the token"""
-        from django.utils.hashcompat import sha_constructor
+        token = self.keyed_hmac()
+        token.update(smart_str(u'%s-%s' % (contact.id, contact.email)))
+        return token.hexdigest()[::2]
 
-        token = sha_constructor(settings.SECRET_KEY + unicode(contact.id) +
-                                contact.email).hexdigest()[::2]
-        return token
+    def make_legacy_token(self, contact):
+        return sha1(smart_str(settings.SECRET_KEY + unicode(contact.id) +
+                              contact.email)).hexdigest()[::2]
 
     def check_token(self, contact, token):
         """Check if the token is correct for this user"""
-        return token == self.make_token(contact)
+        token = smart_str(token)
+        if constant_time_compare(token, self.make_token(contact)):
+            return True
+        return TOKEN_LEGACY and constant_time_compare(
+            token, self.make_legacy_token(contact))
+
+
+class ContactCache(object):
+    """Contacts whose token was verified, by id, for at most ttl
+    seconds. The least recently used are dropped beyond size."""
+
+    def __init__(self, size=TOKEN_CACHE_SIZE, ttl=TOKEN_CACHE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.contacts = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, contact_id):
+        self.lock.acquire()
+        try:
+            contact, expiry = self.contacts.pop(contact_id, (None, 0))
+            if contact is None or expiry < time.time():
+                return None
+            self.contacts[contact_id] = (contact, expiry)
+        finally:
+            self.lock.release()
+        # the views must not change the cached instance
+        return copy.copy(contact)
+
+    def set(self, contact):
+        if not self.size:
+            return
+        self.lock.acquire()
+        try:
+            self.contacts.pop(contact.pk, None)
+            self.contacts[contact.pk] = (copy.copy(contact),
+                                         time.time() + self.ttl)
+            while len(self.contacts) > self.size:
+                self.contacts.popitem(last=False)
+        finally:
+            self.lock.release()
+
+    def discard(self, contact_id):
+        self.lock.acquire()
+        try:
+            self.contacts.pop(contact_id, None)
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.contacts.clear()
+        finally:
+            self.lock.release()
+
+
+token_generator = ContactTokenGenerator()
+contact_cache = ContactCache()
 
 
 def tokenize(contact):
     """Return the uid in base 36 of a contact, and a token"""
-    token_generator = ContactTokenGenerator()
     return int_to_base36(contact.id), token_generator.make_token(contact)
 
 
@@ -34,11 +126,25 @@ def untokenize(uidb36, token):
     """Retrieve a contact by uidb36 and token"""
     try:
         contact_id = base36_to_int(uidb36)
-        contact = Contact.objects.get(pk=contact_id)
     except:
         raise Http404
 
-    token_generator = ContactTokenGenerator()
+    contact = contact_cache.get(contact_id)
+    if contact is None:
+        try:
+            contact = Contact.objects.get(pk=contact_id)
+        except:
+            raise Http404
+
     if token_generator.check_token(contact, token):
+        contact_cache.set(contact)
         return contact
     raise Http404
+
+
+def contact_changed(sender, instance, **kwargs):
+    """Forget a contact saved or deleted, its email may have changed"""
+    contact_cache.discard(instance.pk)
+
+post_save.connect(contact_changed, sender=Contact)
+post_delete.connect(contact_changed, sender=Contact)
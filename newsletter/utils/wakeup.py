@@ -0,0 +1,102 @@
+"""Wake-up of the idle mailers for dry_newsletter.newsletter"""
+import sys
+import socket
+import threading
+
+from dry_newsletter.newsletter.settings import WAKEUP_ADDRESS
+
+
+def notify(server_id=None, address=WAKEUP_ADDRESS):
+    """Wake up the mailers of a server, or all of them, listening on
+    address. Nothing happens when no mailer is listening."""
+    if address is None:
+        return
+    payload = server_id is not None and str(server_id) or ''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.sendto(payload, tuple(address))
+    except socket.error:
+        pass
+    finally:
+        sock.close()
+
+
+class WakeupListener(object):
+    """UDP socket receiving the notifications in a thread, and setting
+    the events registered for the servers notified"""
+
+    def __init__(self, address):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.bind(tuple(address))
+        self.address = self.socket.getsockname()
+        self.events = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.listen, name='wakeup')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def register(self, server_id, event):
+        self.lock.acquire()
+        try:
+            self.events.setdefault(server_id, set()).add(event)
+        finally:
+            self.lock.release()
+
+    def unregister(self, server_id, event):
+        self.lock.acquire()
+        try:
+            self.events.get(server_id, set()).discard(event)
+        finally:
+            self.lock.release()
+
+    def wake(self, server_id=None):
+        self.lock.acquire()
+        try:
+            if server_id is None:
+                events = [event for server_events in self.events.values()
+                          for event in server_events]
+            else:
+                events = list(self.events.get(server_id, ()))
+        finally:
+            self.lock.release()
+        for event in events:
+            event.set()
+
+    def listen(self):
+        while True:
+            try:
+                payload = self.socket.recv(64)
+            except socket.error:
+                return
+            try:
+                server_id = payload and int(payload) or None
+            except ValueError:
+                server_id = None
+            self.wake(server_id)
+
+    def close(self):
+        self.socket.close()
+
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def get_listener():
+    """Return the listener shared by the mailers of the process, or None
+    when the address is disabled or taken by another process"""
+    global _listener
+    if WAKEUP_ADDRESS is None:
+        return None
+    _listener_lock.acquire()
+    try:
+        if _listener is None:
+            try:
+                _listener = WakeupListener(WAKEUP_ADDRESS)
+            except socket.error, e:
+                print >>sys.stderr, 'wake-up socket %s:%s raises %s' % (
+                    tuple(WAKEUP_ADDRESS) + (e,))
+                _listener = False
+        return _listener or None
+    finally:
+        _listener_lock.release()
@@ -4,6 +4,7 @@ from django.shortcuts import get_object_or_404
 from django.shortcuts import render_to_response
 
 from dry_newsletter.newsletter.utils.tokens import untokenize
+from dry_newsletter.newsletter.utils.events import event_buffer
 from dry_newsletter.newsletter.models import Newsletter
 from dry_newsletter.newsletter.models import MailingList
 from dry_newsletter.newsletter.models import ContactMailingStatus
@@ -20,8 +21,7 @@ def view_mailinglist_unsubscribe(request, slug, uidb36, token):
         newsletter.mailing_list.unsubscribers.add(contact)
         newsletter.mailing_list.save()
         already_unsubscribed = True
-        ContactMailingStatus.objects.create(newsletter=newsletter, contact=contact,
-                                            status=ContactMailingStatus.UNSUBSCRIPTION)
+        event_buffer.add(newsletter, contact, ContactMailingStatus.UNSUBSCRIPTION)
 
     return render_to_response('newsletter/mailing_list_unsubscribe.html',
                               {'email': contact.email,
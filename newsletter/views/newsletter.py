@@ -1,4 +1,11 @@
 """Views for dry_newsletter.newsletter Newsletter"""
+import time
+import base64
+import mimetypes
+
+from django.http import Http404
+from django.http import HttpResponse
+from django.http import HttpResponseRedirect
 from django.template import RequestContext
 from django.shortcuts import get_object_or_404
 from django.shortcuts import render_to_response
@@ -6,11 +13,24 @@ from django.shortcuts import render_to_response
 from django.contrib.sites.models import Site
 from django.contrib.auth.decorators import login_required
 from django.template.loader import render_to_string as render_file
+from django.utils.http import base36_to_int
 
 from dry_newsletter.newsletter.models import Newsletter
 from dry_newsletter.newsletter.models import ContactMailingStatus
 from dry_newsletter.newsletter.utils import render_string
 from dry_newsletter.newsletter.utils.tokens import untokenize
+from dry_newsletter.newsletter.utils.events import event_buffer
+from dry_newsletter.newsletter.utils.links import link_table
+from dry_newsletter.newsletter.settings import TRACKING_IMAGE
+from dry_newsletter.newsletter.settings import TRACKING_IMAGE_FORMAT
+from dry_newsletter.newsletter.settings import TOKEN_CACHE_TTL
+
+# the pixel is decoded once, the view only hands out these bytes
+TRACKING_IMAGE_DATA = base64.b64decode(TRACKING_IMAGE)
+TRACKING_IMAGE_TYPE = mimetypes.guess_type('pixel.%s' % TRACKING_IMAGE_FORMAT)[0]
+
+# newsletters of the tracking view by slug, with their expiry
+_tracked_newsletters = {}
 
 def render_newsletter(request, slug, context):
     """Return a newsletter in HTML format"""
@@ -28,13 +48,61 @@ def view_newsletter_contact(request, slug, uidb36, token):
     """Visualization of a newsletter by an user"""
     newsletter = get_object_or_404(Newsletter, slug=slug)
     contact = untokenize(uidb36, token)
-    ContactMailingStatus.objects.create(newsletter=newsletter,
-                                        contact=contact,
-                                        status=ContactMailingStatus.OPENED_ON_SITE)
+    event_buffer.add(newsletter, contact, ContactMailingStatus.OPENED_ON_SITE)
     context = {'contact': contact, 'uidb36': uidb36, 'token': token}
     return render_newsletter(request, slug, context)
 
 def view_newsletter_online_version(request, slug):
     """View the online version"""
     context = {'contact': request.user}
-    return render_newsletter(request, slug, context)
\ No newline at end of file
+    return render_newsletter(request, slug, context)
+
+def get_tracked_newsletter(slug):
+    """Return the newsletter of a slug, kept for TOKEN_CACHE_TTL seconds
+    as the newsletter of an email is opened many times"""
+    newsletter, expiry = _tracked_newsletters.get(slug, (None, 0))
+    if newsletter is None or expiry < time.time():
+        newsletter = Newsletter.objects.get(slug=slug)
+        _tracked_newsletters[slug] = (newsletter, time.time() + TOKEN_CACHE_TTL)
+    return newsletter
+
+def view_newsletter_tracking(request, slug, uidb36, token):
+    """Record the opening of a newsletter by a contact, returning the
+    tracking image. The image is returned even for an unknown contact,
+    the mail client has nothing to do with the error."""
+    try:
+        newsletter = get_tracked_newsletter(slug)
+        contact = untokenize(uidb36, token)
+    except (Newsletter.DoesNotExist, Http404):
+        pass
+    else:
+        event_buffer.add(newsletter, contact, ContactMailingStatus.OPENED)
+
+    response = HttpResponse(TRACKING_IMAGE_DATA, content_type=TRACKING_IMAGE_TYPE)
+    response['Content-Length'] = len(TRACKING_IMAGE_DATA)
+    # every opening must come back to us, not to a cache
+    response['Cache-Control'] = 'no-cache, no-store, must-revalidate, private, max-age=0'
+    response['Pragma'] = 'no-cache'
+    response['Expires'] = 'Thu, 01 Jan 1970 00:00:00 GMT'
+    return response
+
+def view_newsletter_tracking_link(request, slug, uidb36, token, link_id):
+    """Record the click of a contact on a link of a newsletter, and
+    redirect to the link. The link works even for an unknown contact."""
+    try:
+        newsletter = get_tracked_newsletter(slug)
+    except Newsletter.DoesNotExist:
+        raise Http404
+    link_id = base36_to_int(link_id)
+    url = link_table.url(newsletter.pk, link_id)
+    if url is None:
+        raise Http404
+
+    try:
+        contact = untokenize(uidb36, token)
+    except Http404:
+        pass
+    else:
+        event_buffer.add(newsletter, contact, ContactMailingStatus.LINK_OPENED,
+                         link_id=link_id)
+    return HttpResponseRedirect(url)
@@ -0,0 +1,43 @@
+"""Views for dry_newsletter.newsletter statistics"""
+from django.http import HttpResponse
+from django.template import RequestContext
+from django.shortcuts import get_object_or_404
+from django.shortcuts import render_to_response
+from django.contrib.sites.models import Site
+from django.contrib.auth.decorators import login_required
+from django.template.loader import render_to_string
+
+from dry_newsletter.newsletter.models import Newsletter
+from dry_newsletter.newsletter.utils.statistics import get_newsletter_chart
+from dry_newsletter.newsletter.utils.statistics import get_newsletter_top_links
+from dry_newsletter.newsletter.utils.statistics import get_newsletter_statistics
+
+
+@login_required
+def view_newsletter_statistics(request, slug):
+    """Display the statistics of a newsletter"""
+    newsletter = get_object_or_404(Newsletter, slug=slug)
+    context = {'object': newsletter,
+               'statistics': get_newsletter_statistics(newsletter),
+               'top_links': get_newsletter_top_links(newsletter)}
+    return render_to_response('newsletter/newsletter_statistics.html', context,
+                              context_instance=RequestContext(request))
+
+@login_required
+def view_newsletter_charts(request, slug):
+    """Return the Open Flash Chart of the activity on a newsletter"""
+    newsletter = get_object_or_404(Newsletter, slug=slug)
+    return HttpResponse(get_newsletter_chart(newsletter).render(),
+                        mimetype='application/json')
+
+@login_required
+def view_newsletter_density(request, slug):
+    """Display the newsletter with the clicks on its links"""
+    newsletter = get_object_or_404(Newsletter, slug=slug)
+    content = render_to_string('newsletter/newsletter_detail.html',
+                               {'newsletter': newsletter, 'contact': request.user,
+                                'domain': Site.objects.get_current().domain})
+    context = {'object': newsletter, 'content': content,
+               'top_links': get_newsletter_top_links(newsletter)}
+    return render_to_response('newsletter/newsletter_density.html', context,
+                              context_instance=RequestContext(request))